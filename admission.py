@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict, deque
+
+# 调度线程在没有更准确的唤醒时间时，最长隔多久重新检查一次 key 余量
+MAX_POLL_INTERVAL = 1.0
+
+
+def client_id(auth_header, user=None):
+    """
+    按客户端凭据（Authorization 请求头）区分排队的客户端；所有人共用同一个密码时，
+    再用 OpenAI 请求体中的 user 字段区分终端用户。只保存摘要，不保存密码本身
+    """
+    digest = hashlib.sha256((auth_header or '').encode('utf-8')).hexdigest()[:16]
+    return f"{digest}:{user}" if user else digest
+
+
+class Waiter:
+    def __init__(self, client, acquire, deadline):
+        self.client = client
+        self.acquire = acquire
+        self.deadline = deadline
+        # 出队时调用，唤醒等待中的线程或协程
+        self.notify = None
+        # (key, None) 表示拿到了 key；(None, 秒数) 表示超时，秒数为建议的 Retry-After
+        self.result = None
+        self.last_wait = None
+
+
+class AdmissionQueue:
+    """
+    所有 key 都没有余量时，请求在这里排队等待，而不是立刻失败或各自轮询。
+    每个客户端一个 FIFO，由一个调度线程按客户端轮转分配空出来的 key，
+    单个客户端的突发不会饿死其他客户端；队列总长度和单个请求的等待时间都有上限。
+    同步模式的请求阻塞在 threading.Event 上，异步模式的请求等待 asyncio future，不占用线程。
+    acquire 会访问共享存储（阻塞 I/O）时设置 offload，异步模式的首次尝试放到线程池中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, max_size=100, max_wait=30, next_available=None, offload=False):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.offload = offload
+        # 返回所有 key 中最早恢复可用还需等待的秒数（没有 key 时返回 None）
+        self.next_available = next_available or (lambda: None)
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()
+        self._size = 0
+        self._thread = None
+
+    def __len__(self):
+        return self._size
+
+    def depth_by_client(self):
+        with self._cond:
+            return {(client,): len(queue) for client, queue in self._queues.items()}
+
+    def admit(self, client, acquire, max_wait=None):
+        """
+        同步版本。acquire() 返回 (key, 等待秒数)，与 acquire_key 相同。
+        返回 (key, None)，或 (None, 建议的 Retry-After 秒数)；没有任何 key 时返回 (None, None)
+        """
+        result, waiter = self._submit(client, acquire, max_wait)
+        if waiter is None:
+            return result
+        event = threading.Event()
+        waiter.notify = event.set
+        self._enqueue(waiter)
+        event.wait()
+        return waiter.result
+
+    async def admit_async(self, client, acquire, max_wait=None):
+        """异步版本，排队期间只挂起协程；客户端断开时自动退出队列"""
+        if self.offload:
+            result, waiter = await asyncio.to_thread(self._submit, client, acquire, max_wait)
+        else:
+            result, waiter = self._submit(client, acquire, max_wait)
+        if waiter is None:
+            return result
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            if not future.done():
+                future.set_result(None)
+
+        waiter.notify = lambda: loop.call_soon_threadsafe(wake)
+        self._enqueue(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._cancel(waiter)
+            raise
+        return waiter.result
+
+    def notify(self):
+        """key 余量可能提前恢复时（如 token 估计被修正）唤醒调度线程"""
+        with self._cond:
+            self._cond.notify()
+
+    def _submit(self, client, acquire, max_wait):
+        """没有人排队时直接尝试获取 key；否则返回一个待入队的 Waiter，保证先来的请求先拿到 key"""
+        if max_wait is None:
+            max_wait = self.max_wait
+        max_wait = min(max_wait, self.max_wait)
+        wait_time = None
+        if not self._size:
+            key, wait_time = acquire()
+            if key is not None:
+                return (key, None), None
+            if wait_time is None:
+                return (None, None), None
+        if max_wait <= 0 or self._size >= self.max_size:
+            return (None, self._retry_after(wait_time)), None
+        return None, Waiter(client, acquire, time.monotonic() + max_wait)
+
+    def _retry_after(self, wait_time=None):
+        if wait_time is None:
+            wait_time = self.next_available()
+        return max(wait_time or 0, 1)
+
+    def _enqueue(self, waiter):
+        with self._cond:
+            self._queues.setdefault(waiter.client, deque()).append(waiter)
+            self._size += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch_loop, name="admission-queue", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _cancel(self, waiter):
+        with self._cond:
+            queue = self._queues.get(waiter.client)
+            # 调度线程已经把 key 分给了这个请求时，key 的这次额度只能作废
+            if queue is not None and waiter in queue:
+                self._remove(waiter)
+
+    def _remove(self, waiter):
+        queue = self._queues[waiter.client]
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[waiter.client]
+        self._size -= 1
+
+    def _finish(self, waiter, result):
+        self._remove(waiter)
+        waiter.result = result
+        waiter.notify()
+
+    def _dispatch_loop(self):
+        with self._cond:
+            while True:
+                while not self._size:
+                    self._cond.wait()
+                self._cond.wait(self._dispatch())
+
+    def _dispatch(self):
+        """处理一轮排队请求，返回距下一次需要检查的秒数；调用时已持有锁"""
+        now = time.monotonic()
+        for queue in list(self._queues.values()):
+            for waiter in [waiter for waiter in queue if waiter.deadline <= now]:
+                self._finish(waiter, (None, self._retry_after(waiter.last_wait)))
+
+        next_check = MAX_POLL_INTERVAL
+        served = True
+        while served and self._size:
+            served = False
+            # 按客户端轮转：每个客户端只看队首请求，拿到 key 的客户端移到队尾
+            for client, queue in list(self._queues.items()):
+                waiter = queue[0]
+                key, wait_time = waiter.acquire()
+                if key is not None:
+                    self._finish(waiter, (key, None))
+                    if client in self._queues:
+                        self._queues.move_to_end(client)
+                    served = True
+                    break
+                waiter.last_wait = wait_time
+                if wait_time is not None:
+                    next_check = min(next_check, wait_time)
+
+        for queue in self._queues.values():
+            for waiter in queue:
+                next_check = min(next_check, waiter.deadline - now)
+        return max(next_check, 0.001)
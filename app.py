@@ -1,21 +1,43 @@
-from flask import Flask, request, jsonify, Response, stream_with_context, render_template_string
-from google.generativeai.types import BlockedPromptException, StopCandidateException, generation_types
-from google.api_core.exceptions import InvalidArgument, ResourceExhausted, Aborted, InternalServerError, ServiceUnavailable, PermissionDenied
-import google.generativeai as genai
-import json
+from flask import Flask, request, jsonify, Response, stream_with_context
 import os
 import re
 import logging
 import func
-from datetime import datetime, timedelta
-from apscheduler.schedulers.background import BackgroundScheduler
+from datetime import datetime
 import time
-import requests
-from collections import deque
+import atexit
+import base64
+import functools
+import itertools
+import struct
+import math
+import multiprocessing
 import random
+import threading
+from html import escape
 from urllib.parse import urlparse
-from requests.utils import get_environ_proxies
 from func import authenticate_request, process_messages_for_gemini
+from client_pool import UpstreamClientPool
+from state_backend import SharedKeyScheduler, create_key_scheduler
+from settings import load_config, valid_api_keys
+from retry_policy import RetryBudget, RetryPolicy, load_error_policy
+from hedging import HedgePolicy, hedged_call
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from response_cache import CachedResponse, ResponseCache, cache_key as response_cache_key
+from context_cache import ContextCache
+from media_store import ImageNormalizer, MediaStore
+from body_reader import RequestBodyError, StreamingBodyParser
+import sse
+import metrics
+import request_log
+from token_estimator import estimate_text_tokens, estimate_tokens
+from admission import AdmissionQueue, client_id
+from traffic_capture import TrafficCapture
+from model_catalog import ModelCatalog, etag_matches, model_id
+from key_health import KeyHealth
+from single_flight import SingleFlight
+from embedding_batcher import EmbeddingBatcher, EmbeddingError
+from stream_resume import ResumableStream, continuation_contents
 
 os.environ['TZ'] = 'Asia/Shanghai'
 
@@ -23,22 +45,11 @@ app = Flask(__name__)
 
 app.secret_key = os.urandom(24)
 
-formatter = logging.Formatter('%(message)s')
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
 MAX_RETRIES = int(os.environ.get('MaxRetries', 3))
 MAX_REQUESTS = int(os.environ.get('MaxRequests', 2))
 LIMIT_WINDOW = int(os.environ.get('LimitWindow', 60))
-RETRY_DELAY = 1
-MAX_RETRY_DELAY = 16
-
-request_counts = {}
-
-api_key_blacklist = set()
 api_key_blacklist_duration = 60
 
 # 核心优势
@@ -61,51 +72,31 @@ safety_settings = [
     },
 ]
 
-# 从 env.json 或 .env 加载环境变量
-def load_config():
-    config = {}
-    key_array_from_json = None
-    key_array_from_env = None
-
-    # 尝试从 env.json 加载
-    try:
-        with open("env.json", "r") as f:
-            config_json = json.load(f)
-            if "KeyArray" in config_json:
-                key_array_from_json = config_json["KeyArray"]
-                if isinstance(key_array_from_json, str):
-                    key_array_from_json = key_array_from_json.splitlines()
-                config.update(config_json)  # 使用 update 合并配置
-    except FileNotFoundError:
-        pass
-
-    # 尝试从 .env 加载
-    from dotenv import load_dotenv
-    load_dotenv()
-    config_env = {key: os.environ.get(key) for key in
-                  ["KeyArray", "MaxRetries", "MaxRequests", "LimitWindow", "password", "PORT"]}
-    if "KeyArray" in config_env and config_env["KeyArray"]:
-        key_array_from_env = config_env["KeyArray"].splitlines()
-    config.update(config_env)  # 使用 update 合并配置
-
-    # 检查 KeyArray 是否都为 "your_key" 或缺失
-    if (key_array_from_json == "your_key" or (isinstance(key_array_from_json, list) and all(
-            k.strip() == "your_key" for k in key_array_from_json)) or key_array_from_json is None) and \
-            (key_array_from_env == "your_key" or (isinstance(key_array_from_env, list) and all(
-                k.strip() == "your_key" for k in key_array_from_env)) or key_array_from_env is None):
-        print("错误：请在 env.json 或 .env 文件中将 KeyArray 的值替换为您的 Google API 密钥。或检查是否有这两个文件。")
-        input("按 Enter 键退出...")
-        exit(1)
-
-    # 确保 KeyArray 是一个列表
-    if "KeyArray" in config and isinstance(config["KeyArray"], str):
-        config["KeyArray"] = config["KeyArray"].splitlines()
-
-    return config
-
 config = load_config()
 
-def get_system_proxy(url="http://example.com"):  # get_environ_proxies 需要一个 URL 参数
+# 日志在后台线程中格式化和输出，请求路径上只做级别过滤和入队；LogFormat=json 时每行一条带请求字段的 JSON。
+# 配置在根 logger 上，各模块的 logger 都使用同一个输出
+LOG_SAMPLE_RATE = float(config.get("LogSampleRate") if config.get("LogSampleRate") is not None else 1)
+log_handler = request_log.setup_logging(
+    level=config.get("LogLevel") or "INFO",
+    log_format=config.get("LogFormat") or "text",
+    max_queue=int(config.get("LogQueueSize") or 10000),
+)
+atexit.register(log_handler.close)
+
+# 快速启动：上游 SDK、Pillow 等在后台线程中预热，不推迟开始接受请求
+FAST_STARTUP = str(config.get("FastStartup", "false")).lower() in ("1", "true", "yes")
+scheduler = None
+
+def config_list(value):
+    """配置项中的列表既可以是 JSON 数组，也可以是逗号/空白分隔的字符串"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [item for item in re.split(r"[,\s]+", value) if item]
+    return list(value)
+
+def get_system_proxy(url="http://example.com"):
     """
     获取系统代理设置。
     优先使用环境变量中的代理设置，如果没有设置，则尝试自动检测。
@@ -121,67 +112,206 @@ def get_system_proxy(url="http://example.com"):  # get_environ_proxies 需要一
     if https_proxy:
         proxy['https'] = https_proxy
 
-    # 2. 如果环境变量没有设置，尝试自动检测
+    # 2. 如果环境变量没有设置，尝试自动检测（Windows 注册表 / macOS 系统设置）
+    # 与 requests.utils.get_environ_proxies() 相同，但不必在启动时导入 requests
     if not proxy:
         try:
-            # 使用 requests.utils.get_environ_proxies()
-            proxy = get_environ_proxies(url)
-        except:
-            # 在某些系统或配置下，get_environ_proxies() 可能会失败
+            from urllib.request import getproxies, proxy_bypass
+            if not proxy_bypass(urlparse(url).hostname):
+                proxy = getproxies()
+        except Exception:
+            # 在某些系统或配置下，自动检测可能会失败
             pass
 
     return proxy
 
+# 每个 key 在 LimitWindow 内允许的输入 token 数（对应官方的 TPM 限制），0 表示不限制
+MAX_INPUT_TOKENS = int(config.get("MaxInputTokens") or 0)
+# 每个请求一个 ticket，随预占的 token 记录一起保存，拿到实际用量后按它找到要修正的那条记录
+usage_tickets = itertools.count(1)
+
 class APIKeyManager:
     def __init__(self):
-        if isinstance(config["KeyArray"], list):
-             self.api_keys = [key for key in config["KeyArray"] if re.match(r"AIzaSy[a-zA-Z0-9_-]{33}", key)]
-        elif isinstance(config["KeyArray"], str):
-            self.api_keys = [key for key in config["KeyArray"].splitlines() if re.match(r"AIzaSy[a-zA-Z0-9_-]{33}", key)]
-        else:
-            self.api_keys = []  # 或者根据需要处理 None 或其他类型
-        self.current_index = random.randint(0, len(self.api_keys) - 1) if self.api_keys else 0
-
-    def get_available_key(self):
-        num_keys = len(self.api_keys)
-        for _ in range(num_keys):
-            if self.current_index >= num_keys:
-                self.current_index = 0
-            current_key = self.api_keys[self.current_index]
-            self.current_index += 1
-
-            if current_key not in api_key_blacklist:
-                return current_key
-
-        logger.error("所有API key都已耗尽或被暂时禁用或没有任意一个有效API key，请重新配置或稍后重试。")
-        return None
+        self.api_keys = valid_api_keys(config["KeyArray"])
+        # 打乱初始顺序，相当于原来的随机起始位置；配置了 StateBackend 时限额状态在多个 worker / 节点间共享
+        self.scheduler = create_key_scheduler(random.sample(self.api_keys, len(self.api_keys)), MAX_REQUESTS,
+                                              LIMIT_WINDOW, max_tokens=MAX_INPUT_TOKENS,
+                                              backend=config.get("StateBackend"))
+
+    def get_available_key(self, exclude=(), tokens=0, ticket=None):
+        """返回能负担 tokens 个输入 token 的 (key, 0)，或在没有余量时返回 (None, 最早可用还需等待的秒数)"""
+        key, wait_time = self.scheduler.acquire(exclude, tokens, ticket)
+        self._record_acquire(key)
+        return key, wait_time
+
+    def try_key(self, key, tokens=0, ticket=None):
+        """指定的 key 现在有余量时直接占用它"""
+        if not self.scheduler.try_acquire(key, tokens, ticket):
+            return False
+        self._record_acquire(key)
+        return True
+
+    def record_usage(self, key, ticket, estimated, actual):
+        """用上游返回的实际输入 token 数修正该请求（ticket）发送前按 estimated 记下的用量"""
+        if actual and ticket is not None:
+            self.scheduler.adjust_tokens(key, ticket, actual)
+            if actual < estimated:
+                # 多扣的 token 退回后可能有排队的请求可以发出了
+                admission_queue.notify()
+
+    def _record_acquire(self, key):
+        if key is None:
+            metrics.no_key_available_total.inc()
+            return
+        label = metrics.key_label(key)
+        metrics.key_acquired_total.inc(label)
+        if self.scheduler.is_saturated(key):
+            metrics.key_rate_limited_total.inc(label)
+
+    def has_alternative(self, key):
+        """除 key 之外现在是否还有立即可用的 key"""
+        return self.scheduler.next_available_in(exclude={key}) == 0
 
     def show_all_keys(self):
         logger.info(f"当前可用API key个数: {len(self.api_keys)} ")
         for i, api_key in enumerate(self.api_keys):
-            logger.info(f"API Key{i}: {api_key[:11]}...")
+            logger.info(f"API Key{i}: {api_key[:11]}... (指标标签 {metrics.key_label(api_key)})")
 
-    def blacklist_key(self, key):
-        logger.warning(f"{key[:11]} → 暂时禁用 {api_key_blacklist_duration} 秒")
-        api_key_blacklist.add(key)
-
-        scheduler.add_job(lambda: api_key_blacklist.discard(key), 'date', run_date=datetime.now() + timedelta(seconds=api_key_blacklist_duration))
+    def blacklist_key(self, key, duration=api_key_blacklist_duration):
+        logger.warning("%s → 暂时禁用 %s 秒", key[:11], duration)
+        metrics.key_cooldowns_total.inc(metrics.key_label(key))
+        self.scheduler.cooldown(key, duration)
 
 key_manager = APIKeyManager()
 key_manager.show_all_keys()
-current_api_key = key_manager.get_available_key()
-
-def switch_api_key():
-    global current_api_key
-    key = key_manager.get_available_key()
-    if key:
-      current_api_key = key
-      logger.info(f"API key 替换为 → {current_api_key[:11]}...")
-    else:
-      logger.error("API key 替换失败，所有API key都已耗尽或被暂时禁用，请重新配置或稍后重试")
-
-logger.info(f"当前 API key: {current_api_key[:11]}...")
 
+# /metrics 需要鉴权：配置了 MetricsToken 时使用该令牌（供 Prometheus 单独使用），否则与 API 相同使用 password
+METRICS_TOKEN = config.get("MetricsToken") or None
+metrics.REGISTRY.gauge("gemini_proxy_keys", "配置的 API key 数", lambda: len(key_manager.scheduler))
+metrics.REGISTRY.gauge("gemini_proxy_keys_cooling_down", "当前被暂时禁用的 API key 数",
+                       lambda: key_manager.scheduler.cooling_down_count())
+
+# 所有 key 都没有余量时请求在准入队列中按客户端公平排队，超过等待上限或队列已满时返回 429
+admission_queue = AdmissionQueue(
+    max_size=int(config.get("AdmissionQueueSize") or 100),
+    max_wait=float(config.get("AdmissionMaxWait") if config.get("AdmissionMaxWait") is not None else 20),
+    next_available=lambda: key_manager.scheduler.next_available_in(),
+    offload=isinstance(key_manager.scheduler, SharedKeyScheduler),
+)
+# 请求记录（默认关闭）：脱敏后追加写入 CapturePath，可用 benchmarks/replay.py 回放
+traffic_capture = TrafficCapture(
+    path=config.get("CapturePath"),
+    text_mode=config.get("CaptureText") or 'full',
+    sample_rate=float(config.get("CaptureSampleRate") if config.get("CaptureSampleRate") is not None else 1),
+)
+atexit.register(traffic_capture.close)
+
+# Flask 模式下排队会占着工作线程：默认没有可用 key 时直接返回 429 和按最早可用时间估计的 Retry-After，
+# AdmissionSyncWait 可开启短暂的排队等待，最多 1 秒。ASGI 模式排队只挂起协程，不受此限制
+SYNC_ADMISSION_MAX_WAIT = 1.0
+SYNC_ADMISSION_WAIT = min(float(config.get("AdmissionSyncWait") or 0), SYNC_ADMISSION_MAX_WAIT)
+metrics.REGISTRY.gauge("gemini_proxy_admission_queue_depth", "准入队列中等待 key 的请求数",
+                       admission_queue.depth_by_client, ("client",))
+
+# 每个 key 一个长期存活的上游客户端，替代每次请求都调用 genai.configure
+client_pool = UpstreamClientPool(endpoint=config.get("UpstreamEndpoint"), transport=config.get("UpstreamTransport"))
+
+# 重试策略：单个请求的截止时间、全局重试预算，以及按错误类型配置的禁用/退避行为
+REQUEST_DEADLINE = float(config.get("RequestDeadline") or 60)
+retry_policy = RetryPolicy(
+    MAX_RETRIES,
+    REQUEST_DEADLINE,
+    load_error_policy(config.get("ErrorPolicy")),
+    RetryBudget(ratio=float(config.get("RetryBudget") or 0.2)),
+)
+
+# key 健康状态：按错误类型指数增长的冷却、后台探测被禁用的 key，并持久化到 KeyStatePath
+KEY_PROBE_MODEL = config.get("KeyProbeModel")
+
+def probe_key(api_key):
+    """
+    默认用 ListModels 探测（只取一个模型，不消耗生成配额），不依赖某个具体模型是否仍在提供，
+    模型下线不会让正常的 key 被误判为失效；配置了 KeyProbeModel 时改为对该模型调用 CountTokens
+    """
+    if KEY_PROBE_MODEL:
+        client_pool.get_client(api_key).count_tokens(
+            model=f"models/{model_id(KEY_PROBE_MODEL)}", contents=[{"role": "user", "parts": [{"text": "ping"}]}],
+            timeout=10)
+        return
+    # 分页结果在迭代时才发出请求
+    next(iter(client_pool.get_client(api_key, "model").list_models(page_size=1, timeout=10)), None)
+
+key_health = KeyHealth(
+    key_manager.scheduler,
+    probe_key,
+    lambda error: retry_policy.rule_for(error)[0],
+    probe_interval=float(config.get("KeyProbeInterval") or 15),
+    retire_cooldown=float(config.get("KeyRetireCooldown") or 3600),
+    path=config.get("KeyStatePath"),
+)
+key_health.restore(key_manager.api_keys)
+atexit.register(key_health.save)
+metrics.REGISTRY.gauge("gemini_proxy_keys_retired", "探测确认已失效的 API key 数", key_health.retired_count)
+
+# 对冲请求（仅非流式）：按请求体的 hedge 字段或 HedgeModels 开启。
+# 对冲预算只按开启对冲的请求数累积（不按时间补充），对冲数不超过这些请求的 HedgeBudget 比例，0 表示不对冲
+HEDGE_BUDGET = float(config.get("HedgeBudget") if config.get("HedgeBudget") is not None else 0.1)
+hedge_policy = HedgePolicy(
+    config_list(config.get("HedgeModels")),
+    percentile=float(config.get("HedgePercentile") or 95),
+    min_delay=float(config.get("HedgeMinDelay") or 0.3),
+    default_delay=float(config.get("HedgeDefaultDelay") or 3),
+    budget=RetryBudget(ratio=HEDGE_BUDGET, min_per_second=0, max_tokens=10, initial_tokens=0),
+)
+hedge_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="hedge")
+
+# 同一客户端同时发出的相同请求（temperature 为 0）只调用一次上游，其余的共享结果（流式请求从共享缓冲区分发）；
+# 默认关闭，CoalesceRequests 设为 true 开启
+single_flight = SingleFlight(enabled=str(config.get("CoalesceRequests", "false")).lower() in ("1", "true", "yes"))
+
+# temperature 为 0 的确定性请求直接复用之前的结果；ResponseCacheTTL 设为 0 可关闭
+response_cache = ResponseCache(
+    ttl=float(config.get("ResponseCacheTTL") if config.get("ResponseCacheTTL") is not None else 600),
+    max_entries=int(config.get("ResponseCacheMaxEntries") or 1000),
+    max_bytes=int(float(config.get("ResponseCacheMaxMB") or 64) * 1024 * 1024),
+    path=config.get("ResponseCachePath"),
+    disk_max_bytes=int(float(config.get("ResponseCacheDiskMaxMB") or 256) * 1024 * 1024),
+)
+
+# 长前缀自动上下文缓存（Gemini cachedContents），默认关闭，缓存条目会产生存储费用
+context_cache = ContextCache(
+    client_pool,
+    enabled=str(config.get("ContextCache", "false")).lower() in ("1", "true", "yes"),
+    min_bytes=int(float(config.get("ContextCacheMinKB") or 64) * 1024),
+    min_reuse=int(config.get("ContextCacheMinReuse") or 2),
+    ttl=int(config.get("ContextCacheTTL") or 600),
+)
+
+# 消息中的图片/文件按内容哈希只解码一次，多轮对话中重复出现的媒体直接复用
+# ImageMaxPixels 非 0 时，图片在进程池中缩放并重新编码（去除元数据）后再发送
+image_max_pixels = int(config.get("ImageMaxPixels") or 0)
+image_normalizer = ImageNormalizer(
+    func.normalize_image,
+    image_max_pixels,
+    image_format=config.get("ImageFormat") or "WEBP",
+    quality=int(config.get("ImageQuality") or 85),
+    workers=int(config.get("ImageWorkers") or 2),
+) if image_max_pixels > 0 else None
+media_store = MediaStore(max_bytes=int(float(config.get("MediaStoreMaxMB") or 256) * 1024 * 1024), normalizer=image_normalizer)
+
+# 请求体大小限制；超过 STREAM_BODY_MIN_BYTES 的请求体边接收边解析，媒体数据直接流式解码
+MAX_BODY_BYTES = int(float(config.get("MaxBodyMB") or 100) * 1024 * 1024)
+MAX_PART_BYTES = int(float(config.get("MaxPartMB") or 50) * 1024 * 1024)
+STREAM_BODY_MIN_BYTES = int(float(config.get("StreamBodyMinKB") or 1024) * 1024)
+BODY_CHUNK_SIZE = 64 * 1024
+
+# 流式输出合并：StreamFlushMs 毫秒内到达的小段文本合并为一个 SSE 事件，累计超过 StreamFlushBytes 时立即发送
+STREAM_FLUSH_INTERVAL = float(config.get("StreamFlushMs") or 0) / 1000
+STREAM_FLUSH_BYTES = int(config.get("StreamFlushBytes") or 4096)
+# 流式输出中途断开时最多换 key 续写几次，0 表示不续写（与原来一样直接截断）
+STREAM_RESUME_ATTEMPTS = int(config.get("StreamResumeAttempts") if config.get("StreamResumeAttempts") is not None else 2)
+
+# 模型列表获取成功之前（或 ModelCatalogTTL=0 时）展示的默认模型
 GEMINI_MODELS = [
     {"id": "gemini-1.5-flash-8b-latest"},
     {"id": "gemini-1.5-flash-8b-exp-0924"},
@@ -211,15 +341,14 @@ os.environ['LimitWindow'] = str(config.get('LimitWindow', 60))
 os.environ['password'] = config.get('password', '')
 os.environ["PORT"] = str(config.get("PORT", 7860))
 
-@app.route('/')
-def index():
+def render_index_html(models):
     github_url = "https://github.com/HerSophia/Gemini-rProxy"  # 替换成你的 GitHub 仓库地址
     models_html = "<ul>"
-    for model in GEMINI_MODELS:
-        models_html += f"<li>{model['id']}</li>"
+    for model in models:
+        models_html += f"<li>{escape(model)}</li>"
     models_html += "</ul>"
 
-    html_template = f"""
+    return f"""
 <!DOCTYPE html>
 <html>
 <head>
@@ -235,81 +364,122 @@ def index():
 </body>
 </html>
     """
-    return render_template_string(html_template)
 
-def is_within_rate_limit(api_key):
-    now = datetime.now()
-    if api_key not in request_counts:
-        request_counts[api_key] = deque()
+def fetch_key_models(api_key):
+    """用该 key 调用 ListModels（不消耗生成配额），返回它能使用的模型名"""
+    client = client_pool.get_client(api_key, "model")
+    return [model.name for model in client.list_models(page_size=1000, timeout=10)]
+
+# 模型列表：后台按 key 定期获取并缓存，/v1/models 和首页直接返回序列化好的内容，选 key 时跳过不能使用该模型的 key
+model_catalog = ModelCatalog(
+    fetch_key_models,
+    [model["id"] for model in GEMINI_MODELS],
+    render_index_html,
+    ttl=float(config.get("ModelCatalogTTL") if config.get("ModelCatalogTTL") is not None else 3600),
+)
+
+def cached_body_response(body, etag, mimetype):
+    """客户端带着相同 ETag 的 If-None-Match 时返回 304，不重复发送内容"""
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype=mimetype, headers=headers)
 
-    while request_counts[api_key] and request_counts[api_key][0] < now - timedelta(seconds=LIMIT_WINDOW):
-        request_counts[api_key].popleft()
+@app.route('/')
+def index():
+    snapshot = model_catalog.snapshot
+    return cached_body_response(snapshot.index_body, snapshot.index_etag, 'text/html')
 
-    if len(request_counts[api_key]) >= MAX_REQUESTS:
-        earliest_request_time = request_counts[api_key][0]
-        wait_time = (earliest_request_time + timedelta(seconds=LIMIT_WINDOW)) - now
-        return False, wait_time.total_seconds()
-    else:
-        return True, 0
-
-def increment_request_count(api_key):
-    now = datetime.now()
-    if api_key not in request_counts:
-        request_counts[api_key] = deque()
-    request_counts[api_key].append(now)
-
-def handle_api_error(error, attempt):
-    if attempt > MAX_RETRIES:
-        logger.error(f"{MAX_RETRIES} 次尝试后仍然失败，请修改预设或输入")
-        return 0, jsonify({
-                'error': {
-                    'message': f"{MAX_RETRIES} 次尝试后仍然失败，请修改预设或输入",
-                    'type': 'max_retries_exceeded'
-                }
-        })
+def acquire_key(retry_state, preferred=(), tokens=0, model=None, ticket=None):
+    """
+    优先选择 preferred 中（如持有上下文缓存）的 key，其次是本次请求还没尝试过的 key，
+    都尝试过时才允许复用；tokens 为本次请求估计的输入 token 数，ticket 用于之后修正用量。
+    已知不能使用 model 的 key 不会被选中。
+    """
+    for key in preferred:
+        if key not in retry_state.tried_keys and key_manager.try_key(key, tokens, ticket):
+            retry_state.tried_keys.add(key)
+            return key, 0
+
+    unsupported = model_catalog.keys_without(model) if model else frozenset()
+    key, wait_time = key_manager.get_available_key(exclude=retry_state.tried_keys | unsupported, tokens=tokens,
+                                                   ticket=ticket)
+    if key is None and retry_state.tried_keys:
+        key, wait_time = key_manager.get_available_key(exclude=unsupported, tokens=tokens, ticket=ticket)
+    if key is not None:
+        retry_state.tried_keys.add(key)
+    return key, wait_time
+
+def acquire_hedge_key(retry_state, tokens=0, model=None, ticket=None):
+    """对冲用的 key 必须是本次请求还没用过、能使用该模型且现在就有余量的 key，并受对冲预算限制"""
+    if not hedge_policy.allow_hedge():
+        return None
+    unsupported = model_catalog.keys_without(model) if model else frozenset()
+    key, _ = key_manager.get_available_key(exclude=retry_state.tried_keys | unsupported, tokens=tokens, ticket=ticket)
+    if key is not None:
+        retry_state.tried_keys.add(key)
+        logger.info("对冲请求 → %s...", key[:11])
+    return key
+
+def apply_error_policy(error, api_key, retry_state):
+    """按错误类型的策略禁用 key，并决定立即切换还是退避，返回 (结果码, 退避秒数)"""
+    name, rule = retry_policy.rule_for(error)
+
+    duration = key_health.record_failure(api_key, name, rule)
+    if duration:
+        key_manager.blacklist_key(api_key, duration)
+
+    if not rule["retry"]:
+        logger.error("%s 已配置为不重试", name)
+        return 2, 0
+
+    retry_state.failures += 1
+    if key_manager.has_alternative(api_key):
+        logger.info("→ 立即切换到其他 API key 重试...")
+        return 0, 0
+
+    delay = retry_policy.backoff(rule, retry_state.failures)
+    if delay:
+        logger.warning("→ 没有其他可用的 API key，%s 秒后重试...", delay)
+    return 0, delay
+
+def handle_api_error(error, api_key, retry_state):
+    """
+    记录错误并按重试策略处理 API key，返回 (结果码, 重试前需退避的秒数)。
+    本身从不等待，由同步 (app.py) 或异步 (asgi.py) 调用方决定如何处理退避。
+    """
+    # 走到这里时上游调用已经导入过 SDK，这里的导入只是查一次 sys.modules
+    from google.api_core.exceptions import InvalidArgument, ResourceExhausted, Aborted, InternalServerError, ServiceUnavailable, PermissionDenied
+    from google.generativeai.types import StopCandidateException, generation_types
 
+    metrics.upstream_errors_total.inc(metrics.key_label(api_key), type(error).__name__)
     if isinstance(error, InvalidArgument):
-        logger.error(f"{current_api_key[:11]} → 无效，可能已过期或被删除")
-        key_manager.blacklist_key(current_api_key)
-        switch_api_key()
-        return 0, None
+        logger.error("%s → 无效，可能已过期或被删除", api_key[:11])
+        return apply_error_policy(error, api_key, retry_state)
 
     elif isinstance(error, ResourceExhausted):
-        delay = min(RETRY_DELAY * (2 ** attempt), MAX_RETRY_DELAY)
-        logger.warning(f"{current_api_key[:11]} → 429 官方资源耗尽 → {delay} 秒后重试...")
-        key_manager.blacklist_key(current_api_key)
-        switch_api_key()
-        time.sleep(delay)
-        return 0, None
+        logger.warning("%s → 429 官方资源耗尽", api_key[:11])
+        return apply_error_policy(error, api_key, retry_state)
 
     elif isinstance(error, Aborted):
-        delay = min(RETRY_DELAY * (2 ** attempt), MAX_RETRY_DELAY)
-        logger.warning(f"{current_api_key[:11]} → 操作被中止 → {delay} 秒后重试...")
-        time.sleep(delay)
-        return 0, None
+        logger.warning("%s → 操作被中止", api_key[:11])
+        return apply_error_policy(error, api_key, retry_state)
 
     elif isinstance(error, InternalServerError):
-        delay = min(RETRY_DELAY * (2 ** attempt), MAX_RETRY_DELAY)
-        logger.warning(f"{current_api_key[:11]} → 500 服务器内部错误 → {delay} 秒后重试...")
-        time.sleep(delay)
-        return 0, None
+        logger.warning("%s → 500 服务器内部错误", api_key[:11])
+        return apply_error_policy(error, api_key, retry_state)
 
     elif isinstance(error, ServiceUnavailable):
-        delay = min(RETRY_DELAY * (2 ** attempt), MAX_RETRY_DELAY)
-        logger.warning(f"{current_api_key[:11]} → 503 服务不可用 → {delay} 秒后重试...")
-        time.sleep(delay)
-        return 0, None
+        logger.warning("%s → 503 服务不可用", api_key[:11])
+        return apply_error_policy(error, api_key, retry_state)
 
     elif isinstance(error, PermissionDenied):
-        logger.error(f"{current_api_key[:11]} → 403 权限被拒绝，该 API KEY 可能已经被官方封禁")
-        key_manager.blacklist_key(current_api_key)
-        switch_api_key()
-        return 0, None
+        logger.error("%s → 403 权限被拒绝，该 API KEY 可能已经被官方封禁", api_key[:11])
+        return apply_error_policy(error, api_key, retry_state)
 
     elif isinstance(error, StopCandidateException):
         logger.warning(f"AI输出内容被Gemini官方阻挡，代理没有得到有效回复")
-        switch_api_key()
-        return 0, None
+        return apply_error_policy(error, api_key, retry_state)
 
     elif isinstance(error, generation_types.BlockedPromptException):
         try:
@@ -321,225 +491,675 @@ def handle_api_error(error, attempt):
 
                 if block_reason_str == "SAFETY":
                     logger.warning(f"用户输入因安全原因被阻止")
-                    return 1, None
+                    return 1, 0
                 elif block_reason_str == "BLOCKLIST":
                     logger.warning(f"用户输入因包含阻止列表中的术语而被阻止")
-                    return 1, None
+                    return 1, 0
                 elif block_reason_str == "PROHIBITED_CONTENT":
                     logger.warning(f"用户输入因包含禁止内容而被阻止")
-                    return 1, None
+                    return 1, 0
                 elif block_reason_str == "OTHER":
                     logger.warning(f"用户输入因未知原因被阻止")
-                    return 1, None
+                    return 1, 0
                 else:
                     logger.warning(f"用户输入被阻止，原因未知: {block_reason_str}")
-                    return 1, None
+                    return 1, 0
             else:
                 logger.warning(f"用户输入被阻止，原因未知: {full_reason_str}")
-                return 1, None
+                return 1, 0
 
         except (IndexError, AttributeError) as e:
             logger.error(f"获取提示原因失败↙\n{e}")
             logger.error(f"提示被阻止↙\n{error}")
-            return 2, None
+            return 2, 0
 
     else:
         logger.error(f"该模型还未发布，暂时不可用，请更换模型或未来一段时间再试")
         logger.error(f"证明↙\n{error}")
-        return 2, None
+        return 2, 0
+
+def is_stale_context_error(error):
+    """使用上下文缓存时的 InvalidArgument / NotFound 说明缓存已过期或被删除"""
+    from google.api_core.exceptions import InvalidArgument, NotFound
+    return isinstance(error, (InvalidArgument, NotFound))
+
+STREAM_ERROR_DATA = {
+    'error': {
+        'message': '流式输出时截断，请关闭流式输出或修改你的输入',
+        'type': 'internal_server_error'
+    }
+}
+
+def new_body_parser():
+    return StreamingBodyParser(media_store, MAX_BODY_BYTES, MAX_PART_BYTES)
+
+def check_content_length(content_length):
+    """Content-Length 已知时提前拒绝过大的请求体，不读取任何内容；返回是否走流式解析"""
+    if content_length is not None and content_length > MAX_BODY_BYTES:
+        raise RequestBodyError(f"请求体超过 {MAX_BODY_BYTES} 字节上限", 413)
+    return content_length is None or content_length >= STREAM_BODY_MIN_BYTES
+
+def require_json_object(request_data):
+    """请求体须为 JSON 对象；[]、"x" 等合法但不是对象的 JSON 同样按请求格式错误拒绝"""
+    if not isinstance(request_data, dict):
+        raise RequestBodyError("请求体须为 JSON 对象", 400)
+    return request_data
+
+def read_request_json(request):
+    """小请求体直接 get_json，大请求体按块读取并增量解析"""
+    if not check_content_length(request.content_length):
+        return require_json_object(request.get_json())
+    parser = new_body_parser()
+    while True:
+        chunk = request.stream.read(BODY_CHUNK_SIZE)
+        if not chunk:
+            break
+        parser.feed(chunk)
+    return require_json_object(parser.close())
+
+def parse_chat_request(request_data):
+    messages = request_data.get('messages', [])
+    model = request_data.get('model', 'gemini-2.0-flash-exp')
+    temperature = request_data.get('temperature', 1)
+    max_tokens = request_data.get('max_tokens', 8192)
+    stream = request_data.get('stream', False)
+    return messages, model, temperature, max_tokens, stream
+
+def model_unavailable_error(model):
+    logger.error(f"{model} 很可能暂时不可用，请更换模型或未来一段时间再试")
+    return {
+        'error': {
+            'message': f'{model} 很可能暂时不可用，请更换模型或未来一段时间再试',
+            'type': 'internal_server_error'
+        }
+    }, 503
+
+def retries_exhausted_error():
+    logger.error(f"{MAX_RETRIES} 次尝试均失败，请调整配置或向Moonfanz反馈")
+    return {
+        'error': {
+            'message': f'{MAX_RETRIES} 次尝试均失败，请调整配置或向Moonfanz反馈',
+            'type': 'internal_server_error'
+        }
+    }, 500
+
+def no_available_key_error(wait_time):
+    """所有 key 都没有余量时直接返回 429，并告知客户端最早何时可以重试"""
+    if wait_time is None:
+        message = '没有任意一个有效API key，请重新配置'
+        headers = {}
+    else:
+        message = f'所有API key都已耗尽或被暂时禁用，请在 {math.ceil(wait_time)} 秒后重试'
+        headers = {'Retry-After': str(math.ceil(wait_time))}
+    logger.error(message)
+    return {
+        'error': {
+            'message': message,
+            'type': 'rate_limit_exceeded'
+        }
+    }, 429, headers
+
+def retry_later_error(delay):
+    """需要退避但不能占着线程等待时，让客户端自行在 delay 秒后重试"""
+    logger.error(f"上游暂时不可用且没有其他可用的API key，请在 {math.ceil(delay)} 秒后重试")
+    return {
+        'error': {
+            'message': f'上游暂时不可用且没有其他可用的API key，请在 {math.ceil(delay)} 秒后重试',
+            'type': 'upstream_unavailable'
+        }
+    }, 503, {'Retry-After': str(math.ceil(delay))}
+
+def deadline_exceeded_error():
+    logger.error(f"请求在 {REQUEST_DEADLINE:g} 秒内仍未成功，已放弃重试")
+    return {
+        'error': {
+            'message': f'请求在 {REQUEST_DEADLINE:g} 秒内仍未成功，请稍后重试',
+            'type': 'deadline_exceeded'
+        }
+    }, 504
+
+def retry_budget_exhausted_error():
+    logger.error(f"重试预算已耗尽，上游可能正在大面积故障")
+    return {
+        'error': {
+            'message': '上游错误过多，重试预算已耗尽，请稍后重试',
+            'type': 'retry_budget_exhausted'
+        }
+    }, 503
+
+def media_stats_headers(media_stats):
+    """记录本次请求的媒体数量和预处理节省的字节数，并以响应头的形式返回给客户端"""
+    if not media_stats.get('media_count'):
+        return {}
+    saved = media_stats['bytes_in'] - media_stats['bytes_out']
+    metrics.media_bytes_total.inc('in', amount=media_stats['bytes_in'])
+    metrics.media_bytes_total.inc('out', amount=media_stats['bytes_out'])
+    if saved > 0:
+        logger.info("媒体 %d 个，预处理节省 %.1f KB", media_stats['media_count'], saved / 1024)
+    return {
+        'X-Media-Count': str(media_stats['media_count']),
+        'X-Media-Bytes-In': str(media_stats['bytes_in']),
+        'X-Media-Bytes-Out': str(media_stats['bytes_out']),
+        'X-Media-Bytes-Saved': str(saved),
+    }
+
+def resume_stream(model, generation_config, gemini_history, user_message, tokens, keys, partial_text, error):
+    """
+    流式输出中途断开时换一个健康的 key 续写：已输出的文本作为 model 回复的开头，上游只生成之后的部分。
+    keys 为这条流用过的 key（最后一个是刚刚断开的），返回新的流式响应；不能续写时返回 None。
+    与对话请求一样不占着工作线程等待：现在没有可用的 key 或需要退避时直接放弃续写，按原来的方式截断
+    """
+    from google.api_core.exceptions import GoogleAPICallError
+
+    if not isinstance(error, GoogleAPICallError):
+        # 安全拦截等内容上的问题换 key 也没有用
+        return None
+    retry_state = retry_policy.start()
+    retry_state.tried_keys.update(keys)
+    handle_api_error(error, keys[-1], retry_state)
+    contents = continuation_contents(gemini_history, user_message, partial_text)
+
+    for attempt in range(1, MAX_RETRIES + 1):
+        if not retry_state.allow_retry():
+            logger.error("重试预算已耗尽，不再续写")
+            break
+        api_key, wait_time = acquire_key(retry_state, tokens=tokens, model=model)
+        if api_key is None:
+            logger.error("没有立即可用的 API key（最早 %s 秒后可用），不再续写", wait_time)
+            break
+        keys.append(api_key)
+        logger.warning("流式输出中断（已输出 %d 个字符），换 key 续写，第 %d/%d 次尝试 → %s...",
+                       len(partial_text), attempt, MAX_RETRIES, api_key[:11])
+        metrics.upstream_attempts_total.inc(model, metrics.key_label(api_key))
+        try:
+            gen_model = client_pool.get_model(api_key, model, generation_config, safety_settings)
+            response = gen_model.generate_content(contents, stream=True)
+            key_health.record_success(api_key)
+            metrics.stream_resumes_total.inc(model, 'resumed')
+            return response
+        except Exception as e:
+            success, delay = handle_api_error(e, api_key, retry_state)
+        if success != 0 or delay:
+            break
+
+    metrics.stream_resumes_total.inc(model, 'failed')
+    return None
+
+def upstream_request_options(stream, retry_state):
+    """非流式请求把剩余的截止时间作为上游调用的超时；流式请求时长不可预知，不设超时"""
+    if stream:
+        return {}
+    return {"timeout": max(retry_state.remaining(), 1)}
+
+def usage_from_metadata(model, usage_metadata, record=True):
+    """
+    把 Gemini 的 usage_metadata 转换为 OpenAI 格式的 usage，并记录指标；没有用量信息（如命中缓存）时为 0。
+    合并请求共享发起者的响应，record 为 False，用量只由发起者记录一次
+    """
+    prompt_tokens = getattr(usage_metadata, 'prompt_token_count', 0) or 0
+    completion_tokens = getattr(usage_metadata, 'candidates_token_count', 0) or 0
+    total_tokens = getattr(usage_metadata, 'total_token_count', 0) or prompt_tokens + completion_tokens
+    if total_tokens and record:
+        metrics.tokens_total.inc(model, 'prompt', amount=prompt_tokens)
+        metrics.tokens_total.inc(model, 'completion', amount=completion_tokens)
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': total_tokens
+    }
+
+def build_completion(response, model, record_usage=True):
+    """非流式：把 Gemini 响应转换为 OpenAI 格式，返回 (响应 dict, 状态码)"""
+    try:
+        text_content = response.text
+    except (AttributeError, IndexError, TypeError, ValueError) as e:
+        if "response.candidates is empty" in str(e):
+            logger.error(f"你的输入被AI安全过滤器阻止")
+            return {
+                'error': {
+                    'message': '你的输入被AI安全过滤器阻止',
+                    'type': 'prompt_blocked_error',
+                    'details': str(e)
+                }
+            }, 400
+        else:
+            logger.error(f"AI响应处理失败")
+            return {
+                'error': {
+                    'message': 'AI响应处理失败',
+                    'type': 'response_processing_error'
+                }
+            }, 500
+
+    response_data = {
+        'id': 'chatcmpl-xxxxxxxxxxxx',
+        'object': 'chat.completion',
+        'created': int(datetime.now().timestamp()),
+        'model': model,
+        'choices': [{
+            'index': 0,
+            'message': {
+                'role': 'assistant',
+                'content': text_content
+            },
+            'finish_reason': 'stop'
+        }],
+        'usage': usage_from_metadata(model, getattr(response, 'usage_metadata', None), record_usage)
+    }
+    logger.info("200!")
+    return response_data, 200
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    is_authenticated, auth_error, status_code = func.check_authorization(request.headers.get('Authorization'), METRICS_TOKEN)
+    if not is_authenticated:
+        return jsonify(auth_error), status_code
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
+
+def error_outcome(data):
+    """从错误响应中取出错误类型，作为请求记录中的 outcome"""
+    error = data.get('error') if isinstance(data, dict) else None
+    if isinstance(error, dict):
+        return error.get('type')
+    return 'error' if error else None
+
+def record_request_metrics(request_info, status, start_time):
+    """请求结束（流式请求为开始输出）时记录总耗时、状态码和尝试次数"""
+    model, stream = request_info.get('model', ''), str(request_info.get('stream', False)).lower()
+    metrics.requests_total.inc(model, stream, str(status))
+    metrics.request_duration.observe(time.monotonic() - start_time, model, stream)
+    if request_info.get('attempts'):
+        metrics.request_attempts.observe(request_info['attempts'], model)
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
+    start_time = time.monotonic()
+    request_info = {'request_id': request_log.begin(request.headers.get('X-Request-ID'), LOG_SAMPLE_RATE)}
+    response = app.make_response(handle_chat_completions(request_info, start_time))
+    response.headers['X-Request-ID'] = request_info['request_id']
+    record_request_metrics(request_info, response.status_code, start_time)
+    # 流式请求在流结束时记录
+    if not response.is_streamed:
+        if traffic_capture.enabled:
+            if response.status_code != 200:
+                request_info.setdefault('outcome', error_outcome(response.get_json(silent=True)))
+            traffic_capture.record(request_info, response.status_code, start_time)
+        request_log.end()
+    return response
+
+def handle_chat_completions(request_info, start_time):
     is_authenticated, auth_error, status_code = func.authenticate_request(request)
     if not is_authenticated:
         return auth_error if auth_error else jsonify({'error': '未授权'}), status_code if status_code else 401
 
-    request_data = request.get_json()
-    messages = request_data.get('messages', [])
-    model = request_data.get('model', 'gemini-2.0-flash-exp')
-    temperature = request_data.get('temperature', 1)
-    max_tokens = request_data.get('max_tokens', 8192)
-    stream = request_data.get('stream', False)
+    try:
+        request_data = read_request_json(request)
+        request_info.update(request=request_data, body_bytes=request.content_length)
+    except RequestBodyError as e:
+        logger.error("读取请求体失败: %s", e.message)
+        return jsonify({'error': e.message}), e.status
+    messages, model, temperature, max_tokens, stream = parse_chat_request(request_data)
     hint = "流式" if stream else "非流"
-    logger.info(f"\n{model} [{hint}] → {current_api_key[:11]}...")
+    logger.info("\n%s [%s]", model, hint)
+    request_info.update(model=model, stream=stream)
+    request_log.bind(model=model)
 
-    gemini_history, user_message, error_response = func.process_messages_for_gemini(messages)
+    media_stats = {}
+    gemini_history, user_message, error_response = func.process_messages_for_gemini(messages, media_store, media_stats)
 
     if error_response:
-        logger.error(f"处理输入消息时出错↙\n {error_response}")
+        logger.error("处理输入消息时出错↙\n %s", error_response)
         return jsonify(error_response), 400
+    media_headers = media_stats_headers(media_stats)
 
-    def do_request(current_api_key, attempt):
-        isok, time = is_within_rate_limit(current_api_key)
-        if not isok:
-            logger.warning(f"{current_api_key[:11]} → 暂时超过限额，该API key将在 {time} 秒后启用...")
-            switch_api_key()
-            return 0, None
-
-        increment_request_count(current_api_key)
-
-        genai.configure(api_key=current_api_key)
+    retry_state = retry_policy.start()
+    hedge = not stream and hedge_policy.start(model, request_data)
+    context_plan = context_cache.plan(model, gemini_history)
+    estimated_tokens = estimate_tokens(gemini_history, user_message) if MAX_INPUT_TOKENS else 0
+    usage_ticket = next(usage_tickets) if MAX_INPUT_TOKENS else None
+    client = client_id(request.headers.get('Authorization'), request_data.get('user'))
+    request_info['client'] = client
 
+    def do_request(current_api_key):
         generation_config = {
             "temperature": temperature,
             "max_output_tokens": max_tokens
         }
 
-        gen_model = genai.GenerativeModel(
-            model_name=model,
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
+        # 命中上下文缓存时只发送缓存前缀之后的消息
+        context = context_cache.acquire(current_api_key, context_plan, logger)
+        history = gemini_history[context.turns:] if context else gemini_history
+
+        gen_model = client_pool.get_model(current_api_key, model, generation_config, safety_settings,
+                                          cached_content=context.name if context else None)
+        request_options = upstream_request_options(stream, retry_state)
 
+        metrics.upstream_attempts_total.inc(model, metrics.key_label(current_api_key))
         try:
-            if gemini_history:
-                chat_session = gen_model.start_chat(history=gemini_history)
-                response = chat_session.send_message(user_message, stream=stream)
+            call_start = time.monotonic()
+            if history:
+                chat_session = gen_model.start_chat(history=history)
+                response = chat_session.send_message(user_message, stream=stream, request_options=request_options)
             else:
-                response = gen_model.generate_content(user_message, stream=stream)
-            return 1, response
+                response = gen_model.generate_content(user_message, stream=stream, request_options=request_options)
+            latency = time.monotonic() - call_start
+            metrics.upstream_latency.observe(latency, model, str(stream).lower())
+            if not stream:
+                hedge_policy.tracker.record(model, latency)
+                key_manager.record_usage(current_api_key, usage_ticket, estimated_tokens,
+                                         getattr(response.usage_metadata, 'prompt_token_count', 0))
+            key_health.record_success(current_api_key)
+            return 1, response, 0
         except Exception as e:
-            return handle_api_error(e, attempt)
-
-    def generate(response):
-        try:
-            logger.info(f"流式开始...")
+            if context is not None and is_stale_context_error(e):
+                logger.warning("%s → 上下文缓存已失效，改为发送完整历史重试", current_api_key[:11])
+                context_cache.invalidate(context)
+                return 0, None, 0
+            success, delay = handle_api_error(e, current_api_key, retry_state)
+            return success, None, delay
+        finally:
+            context_cache.release(context)
+
+    def generate(response, store_key=None, api_key=None, record_usage=True):
+        texts = []
+        usage_metadata = []
+
+        def upstream_texts():
             for chunk in response:
+                # 每个分块都带有截至目前的用量，最后一个分块的即为总用量
+                if getattr(chunk, 'usage_metadata', None):
+                    usage_metadata[:] = [chunk.usage_metadata]
                 if chunk.text:
-                    data = {
-                        'choices': [
-                            {
-                                'delta': {
-                                    'content': chunk.text
-                                },
-                                'finish_reason': None,
-                                'index': 0
-                            }
-                        ],
-                        'object': 'chat.completion.chunk'
-                    }
-                    yield f"data: {json.dumps(data)}\n\n"
-
-            data = {
-                        'choices': [
-                            {
-                                'delta': {},
-                                'finish_reason': 'stop',
-                                'index': 0
-                            }
-                        ],
-                        'object': 'chat.completion.chunk'
-                    }
-            logger.info(f"流式结束")
-            yield f"data: {json.dumps(data)}\n\n"
-            logger.info(f"200!")
-
-        except Exception:
-            logger.error(f"流式输出中途被截断，请关闭流式输出或修改你的输入")
-            logger.info(f"流式结束")
-            error_data = {
-                'error': {
-                    'message': '流式输出时截断，请关闭流式输出或修改你的输入',
-                    'type': 'internal_server_error'
-                }
-            }
-            yield f"data: {json.dumps(error_data)}\n\n"
-            data = {
-                        'choices': [
-                            {
-                                'delta': {},
-                                'finish_reason': 'stop',
-                                'index': 0
-                            }
-                        ],
-                        'object': 'chat.completion.chunk'
-                    }
-
-            yield f"data: {json.dumps(data)}\n\n"
-
-    attempt = 0
-    success = 0
-    response = None
+                    if not texts:
+                        request_info['ttft'] = time.monotonic() - start_time
+                        metrics.ttft.observe(request_info['ttft'], model)
+                    texts.append(chunk.text)
+                    yield chunk.text
 
-    for attempt in range(1, MAX_RETRIES + 1):
-        logger.info(f"第 {attempt}/{MAX_RETRIES} 次尝试 ...")
-        success, response = do_request(current_api_key, attempt)
+        stream_start = time.monotonic()
+        try:
+            logger.info("流式开始...")
+            for text in sse.coalesce(upstream_texts(), STREAM_FLUSH_INTERVAL, STREAM_FLUSH_BYTES):
+                yield sse.encode_delta(text)
+
+            logger.info("流式结束")
+            usage = usage_from_metadata(model, usage_metadata[0] if usage_metadata else None, record_usage)
+            if api_key:
+                key_manager.record_usage(api_key, usage_ticket, estimated_tokens, usage['prompt_tokens'])
+            yield sse.encode_stop(usage)
+            logger.info("200!")
+            metrics.streams_total.inc(model, 'completed')
+            request_info['outcome'] = 'cache_hit' if isinstance(response, CachedResponse) else 'completed'
+            if store_key:
+                response_cache.put(store_key, {'text': ''.join(texts)})
 
-        if success == 1:
-            break
-        elif success == 2:
+        except Exception:
+            logger.error("流式输出中途被截断，请关闭流式输出或修改你的输入")
+            logger.info("流式结束")
+            metrics.streams_total.inc(model, 'truncated')
+            request_info['outcome'] = 'truncated'
+            yield sse.encode_event(STREAM_ERROR_DATA)
+            yield sse.STOP_EVENT
+        finally:
+            metrics.stream_duration.observe(time.monotonic() - stream_start, model)
+            traffic_capture.record(request_info, 200, start_time)
+            request_log.end()
+
+    cache_key = None
+    if response_cache.cacheable(temperature):
+        cache_key = response_cache_key(model, gemini_history, user_message, temperature, max_tokens)
+        cached = response_cache.get(cache_key)
+        metrics.response_cache_total.inc('miss' if cached is None else 'hit')
+        if cached is not None:
+            logger.info("命中响应缓存")
+            request_info['outcome'] = 'cache_hit'
+            response = CachedResponse(cached['text'])
+            if stream:
+                return Response(stream_with_context(generate(response)), mimetype='text/event-stream', headers=media_headers)
+            response_data, status = build_completion(response, model)
+            return jsonify(response_data), status, media_headers
+
+    # 相同的请求正在进行时等待并共享它的上游响应，不再单独占用 key 和配额
+    flight = None
+    if single_flight.coalescable(temperature):
+        flight_key = cache_key or response_cache_key(model, gemini_history, user_message, temperature, max_tokens)
+        # 只合并同一客户端（Authorization 和 user 字段相同）的请求
+        flight, leader = single_flight.join(f"{client}:{flight_key}:{'stream' if stream else 'full'}",
+                                            retry_state.remaining())
+        if flight is None:
+            error_data, status = deadline_exceeded_error()
+            return jsonify(error_data), status
+        if not leader:
+            logger.info("与进行中的相同请求合并")
+            metrics.coalesced_requests_total.inc(model, str(stream).lower())
+            request_info['outcome'] = 'coalesced'
+            if stream:
+                return Response(stream_with_context(generate(flight, record_usage=False)), mimetype='text/event-stream', headers=media_headers)
+            response_data, status = build_completion(flight.response, model, record_usage=False)
+            return jsonify(response_data), status, media_headers
 
-            logger.error(f"{model} 很可能暂时不可用，请更换模型或未来一段时间再试")
-            response = {
-                'error': {
-                    'message': f'{model} 很可能暂时不可用，请更换模型或未来一段时间再试',
-                    'type': 'internal_server_error'
-                }
-            }
-            return jsonify(response), 503
+    try:
+        response = None
+
+        for attempt in range(1, MAX_RETRIES + 1):
+            if retry_state.remaining() <= 0:
+                error_data, status = deadline_exceeded_error()
+                return jsonify(error_data), status
+            request_info['attempts'] = attempt
+
+            preferred = context_cache.preferred_keys(context_plan)
+            current_api_key, wait_time = admission_queue.admit(
+                client, lambda: acquire_key(retry_state, preferred, estimated_tokens, model, usage_ticket),
+                min(retry_state.remaining(), SYNC_ADMISSION_WAIT))
+            if current_api_key is None:
+                if wait_time is not None:
+                    metrics.admission_rejected_total.inc()
+                error_data, status, headers = no_available_key_error(wait_time)
+                return jsonify(error_data), status, headers
+
+            request_info['key'] = metrics.key_label(current_api_key)
+            request_log.bind(key=request_info['key'], attempt=attempt)
+            logger.info("第 %d/%d 次尝试 → %s...", attempt, MAX_RETRIES, current_api_key[:11])
+            if hedge:
+                success, response, delay = hedged_call(hedge_executor, do_request, current_api_key,
+                                                       lambda: acquire_hedge_key(retry_state, estimated_tokens, model,
+                                                                                 usage_ticket),
+                                                       hedge_policy.delay(model))
+            else:
+                success, response, delay = do_request(current_api_key)
+
+            if success == 1:
+                break
+            elif success == 2:
+                error_data, status = model_unavailable_error(model)
+                return jsonify(error_data), status
+
+            if attempt < MAX_RETRIES:
+                if not retry_state.allow_retry():
+                    error_data, status = retry_budget_exhausted_error()
+                    return jsonify(error_data), status
+                if delay:
+                    # 同步模式下不占着工作线程睡眠，交给客户端退避
+                    error_data, status, headers = retry_later_error(delay)
+                    return jsonify(error_data), status, headers
 
-    else:
-        logger.error(f"{MAX_RETRIES} 次尝试均失败，请调整配置或向Moonfanz反馈")
-        response = {
-            'error': {
-                'message': f'{MAX_RETRIES} 次尝试均失败，请调整配置或向Moonfanz反馈',
-                'type': 'internal_server_error'
-            }
+        else:
+            error_data, status = retries_exhausted_error()
+            return jsonify(error_data), status
+
+        if stream and STREAM_RESUME_ATTEMPTS:
+            response = ResumableStream(response, functools.partial(
+                resume_stream, model, {"temperature": temperature, "max_output_tokens": max_tokens},
+                gemini_history, user_message, estimated_tokens, [current_api_key]), STREAM_RESUME_ATTEMPTS)
+        if flight is not None:
+            flight.resolve(response, stream)
+        if stream:
+            return Response(stream_with_context(generate(flight or response, cache_key, current_api_key)),
+                            mimetype='text/event-stream', headers=media_headers)
+        else:
+            response_data, status = build_completion(response, model)
+            if cache_key and status == 200:
+                response_cache.put(cache_key, {'text': response_data['choices'][0]['message']['content']})
+            return jsonify(response_data), status, media_headers
+    finally:
+        if flight is not None:
+            # 发起者没拿到上游响应就返回时，让等待的相同请求各自重试
+            flight.cancel()
+
+# OpenAI 兼容的 /v1/embeddings：同一时间窗口内的输入合并成一次 BatchEmbedContents，一批只占用一次 key 的请求额度
+EMBEDDING_MODEL = config.get("EmbeddingModel") or "text-embedding-004"
+# OpenAI 允许单个请求最多 2048 条输入
+MAX_EMBEDDING_INPUTS = 2048
+
+def embedding_model(name):
+    """OpenAI 的 embedding 模型名（或未指定）映射到 EmbeddingModel，其他模型名按 Gemini 模型名使用"""
+    if not name or name.startswith(("text-embedding-3", "text-embedding-ada")):
+        return EMBEDDING_MODEL
+    return model_id(name)
+
+def parse_embedding_request(request_data):
+    """返回 (模型, 输入文本列表, 输出维度, 编码格式)，请求不合法时抛出 ValueError"""
+    inputs = request_data.get('input')
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if not isinstance(inputs, list) or not inputs:
+        raise ValueError("input 须为字符串或非空的字符串数组")
+    if not all(isinstance(text, str) for text in inputs):
+        raise ValueError("只支持文本输入，不支持 token 数组")
+    if len(inputs) > MAX_EMBEDDING_INPUTS:
+        raise ValueError(f"单个请求最多 {MAX_EMBEDDING_INPUTS} 条输入")
+    dimensions = request_data.get('dimensions')
+    if dimensions is not None and (not isinstance(dimensions, int) or isinstance(dimensions, bool) or dimensions <= 0):
+        raise ValueError("dimensions 须为正整数")
+    encoding_format = request_data.get('encoding_format') or 'float'
+    if encoding_format not in ('float', 'base64'):
+        raise ValueError("encoding_format 须为 float 或 base64")
+    return embedding_model(request_data.get('model')), inputs, dimensions, encoding_format
+
+def invalid_request_error(message):
+    logger.error(message)
+    return {
+        'error': {
+            'message': message,
+            'type': 'invalid_request_error'
         }
-        return jsonify(response), 500 if response is not None else 503
+    }, 400
 
-    if stream:
-        return Response(stream_with_context(generate(response)), mimetype='text/event-stream')
-    else:
+def embed_batch(group, texts):
+    """
+    在 embedding 线程池中执行：与对话请求相同地选 key、遵守限额和重试策略，调用一次 BatchEmbedContents；
+    最终失败时抛出 EmbeddingError，由批次中的每个调用方返回给客户端。
+    线程池由两种模式共用，不能在这里等待：没有立即可用的 key 或需要退避时直接返回带 Retry-After 的错误
+    """
+    model, dimensions = group
+    metrics.embedding_batch_size.observe(len(texts), model)
+    requests = [{"model": f"models/{model}", "content": {"parts": [{"text": text}]}} for text in texts]
+    if dimensions:
+        for item in requests:
+            item["output_dimensionality"] = dimensions
+
+    retry_state = retry_policy.start()
+    for attempt in range(1, MAX_RETRIES + 1):
+        if retry_state.remaining() <= 0:
+            raise EmbeddingError(*deadline_exceeded_error())
+        api_key, wait_time = acquire_key(retry_state, model=model)
+        if api_key is None:
+            raise EmbeddingError(*no_available_key_error(wait_time))
+
+        logger.info("embedding %d 条，第 %d/%d 次尝试 → %s...", len(texts), attempt, MAX_RETRIES, api_key[:11])
+        metrics.upstream_attempts_total.inc(model, metrics.key_label(api_key))
         try:
-            text_content = response.text
-        except (AttributeError, IndexError, TypeError, ValueError) as e:
-            if "response.candidates is empty" in str(e):
-                logger.error(f"你的输入被AI安全过滤器阻止")
-                return jsonify({
-                    'error': {
-                        'message': '你的输入被AI安全过滤器阻止',
-                        'type': 'prompt_blocked_error',
-                        'details': str(e)
-                    }
-                }), 400
-            else:
-                logger.error(f"AI响应处理失败")
-                return jsonify({
-                    'error': {
-                        'message': 'AI响应处理失败',
-                        'type': 'response_processing_error'
-                    }
-                }), 500
-
-        response_data = {
-            'id': 'chatcmpl-xxxxxxxxxxxx',  
-            'object': 'chat.completion',
-            'created': int(datetime.now().timestamp()),
-            'model': model,
-            'choices': [{
-                'index': 0,
-                'message': {
-                    'role': 'assistant',
-                    'content': text_content
-                },
-                'finish_reason': 'stop'
-            }],
-            'usage': {
-                'prompt_tokens': 0,
-                'completion_tokens': 0,
-                'total_tokens': 0
-            }
-        }
-        logger.info(f"200!")
-        return jsonify(response_data)
+            call_start = time.monotonic()
+            response = client_pool.get_client(api_key).batch_embed_contents(
+                model=f"models/{model}", requests=requests, timeout=max(retry_state.remaining(), 1))
+            metrics.upstream_latency.observe(time.monotonic() - call_start, model, 'false')
+            key_health.record_success(api_key)
+            return [list(embedding.values) for embedding in response.embeddings]
+        except Exception as e:
+            success, delay = handle_api_error(e, api_key, retry_state)
+
+        if success != 0:
+            raise EmbeddingError(*model_unavailable_error(model))
+        if attempt < MAX_RETRIES:
+            if not retry_state.allow_retry():
+                raise EmbeddingError(*retry_budget_exhausted_error())
+            if delay:
+                raise EmbeddingError(*retry_later_error(delay))
+
+    raise EmbeddingError(*retries_exhausted_error())
+
+embedding_batcher = EmbeddingBatcher(
+    embed_batch,
+    window=float(config.get("EmbeddingBatchWindow") if config.get("EmbeddingBatchWindow") is not None else 0.01),
+    max_batch=int(config.get("EmbeddingMaxBatch") or 100),
+)
+
+def submit_embeddings(model, texts, dimensions):
+    """每条输入单独排进批次，返回与 texts 一一对应的 Future"""
+    return [embedding_batcher.submit((model, dimensions), text) for text in texts]
+
+def build_embedding_response(model, texts, vectors, encoding_format):
+    """转换为 OpenAI 格式；base64 为 little-endian float32，与 OpenAI 相同。Gemini 不返回用量，按文本估计"""
+    data = []
+    for index, vector in enumerate(vectors):
+        if encoding_format == 'base64':
+            vector = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode('ascii')
+        data.append({'object': 'embedding', 'index': index, 'embedding': vector})
+    prompt_tokens = sum(estimate_text_tokens(text) for text in texts)
+    return {
+        'object': 'list',
+        'data': data,
+        'model': model,
+        'usage': {'prompt_tokens': prompt_tokens, 'total_tokens': prompt_tokens},
+    }
+
+@app.route('/v1/embeddings', methods=['POST'])
+def embeddings():
+    start_time = time.monotonic()
+    request_info = {'request_id': request_log.begin(request.headers.get('X-Request-ID'), LOG_SAMPLE_RATE)}
+    response = app.make_response(handle_embeddings(request_info))
+    response.headers['X-Request-ID'] = request_info['request_id']
+    record_request_metrics(request_info, response.status_code, start_time)
+    request_log.end()
+    return response
+
+def handle_embeddings(request_info):
+    is_authenticated, auth_error, status_code = func.authenticate_request(request)
+    if not is_authenticated:
+        return auth_error if auth_error else jsonify({'error': '未授权'}), status_code if status_code else 401
+
+    try:
+        request_data = read_request_json(request)
+        model, texts, dimensions, encoding_format = parse_embedding_request(request_data)
+    except RequestBodyError as e:
+        logger.error("读取请求体失败: %s", e.message)
+        return jsonify({'error': e.message}), e.status
+    except ValueError as e:
+        error_data, status = invalid_request_error(str(e))
+        return jsonify(error_data), status
+    request_info.update(model=model, stream=False)
+    request_log.bind(model=model)
+    logger.info("\n%s [embedding %d 条]", model, len(texts))
+
+    futures = submit_embeddings(model, texts, dimensions)
+    try:
+        deadline = time.monotonic() + REQUEST_DEADLINE
+        vectors = [future.result(timeout=max(deadline - time.monotonic(), 0)) for future in futures]
+    except EmbeddingError as e:
+        return jsonify(e.data), e.status, e.headers
+    except FutureTimeoutError:
+        error_data, status = deadline_exceeded_error()
+        return jsonify(error_data), status
+    return jsonify(build_embedding_response(model, texts, vectors, encoding_format))
 
 @app.route('/v1/models', methods=['GET'])
 def list_models():
-    response = {"object": "list", "data": GEMINI_MODELS}
-    return jsonify(response)
+    snapshot = model_catalog.snapshot
+    return cached_body_response(snapshot.models_body, snapshot.models_etag, 'application/json')
 
 def keep_alive():
+    import requests
+
     try:
         port = int(os.environ.get('PORT', 3000))
         url = f"http://127.0.0.1:{port}/"
@@ -554,10 +1174,25 @@ def keep_alive():
     except requests.exceptions.RequestException as e:
         print(f"Keep alive ping failed: {e} at {time.ctime()}")
 
-if __name__ == '__main__':
+def warm_up():
+    """导入上游 SDK、Pillow 并启动定时任务；之后第一个请求不必再等待导入"""
+    global scheduler
+
+    start = time.monotonic()
+    import google.generativeai
+    import google.api_core.exceptions
+    import PIL.Image
+    from apscheduler.schedulers.background import BackgroundScheduler
 
-    config = load_config()  # load_config() 中已经处理了错误情况
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(keep_alive, 'interval', hours=12)
+    scheduler.start()
+    model_catalog.start(lambda: key_manager.api_keys)
+    key_health.start(on_result=lambda key, result: metrics.key_probes_total.inc(result))
+    logger.info("预热完成，耗时 %.2f 秒", time.monotonic() - start)
 
+def start_background_tasks():
+    """设置代理并启动后台定时任务，供 app.py 直接运行和 asgi.py 启动时共用"""
     # 获取并设置代理 (如果需要)
     proxies = get_system_proxy()  # 或者 get_proxy()，如果你实现了方案三
     if proxies:
@@ -567,13 +1202,27 @@ if __name__ == '__main__':
         if 'https' in proxies:
             os.environ['HTTPS_PROXY'] = proxies['https']
 
-    scheduler = BackgroundScheduler()
-
-    scheduler.add_job(keep_alive, 'interval', hours=12)
-    scheduler.start()
+    # FastStartup：不等 SDK 导入完成就开始接受请求，预热在后台线程中进行；
+    # 预热完成前到达的请求在首次调用上游时导入 SDK（与预热线程共用同一把导入锁，不会重复导入）
+    if FAST_STARTUP:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    else:
+        warm_up()
 
     logger.info(f"最大尝试次数/MaxRetries: {MAX_RETRIES}")
     logger.info(f"最大请求次数/MaxRequests: {MAX_REQUESTS}")
     logger.info(f"请求限额窗口/LimitWindow: {LIMIT_WINDOW} 秒")
+    if MAX_INPUT_TOKENS:
+        logger.info(f"输入 token 限额/MaxInputTokens: {MAX_INPUT_TOKENS}")
+    if traffic_capture.enabled:
+        logger.info(f"请求记录/CapturePath: {traffic_capture.path}（文本: {traffic_capture.text_mode}，采样率: {traffic_capture.sample_rate}）")
+    logger.info(f"限额状态存储/StateBackend: {type(key_manager.scheduler).__name__}")
+    logger.info(f"准入队列/AdmissionQueueSize: {admission_queue.max_size}，最长等待/AdmissionMaxWait: {admission_queue.max_wait} 秒")
+
+if __name__ == '__main__':
+    # 打包为单文件可执行程序时，图片预处理进程池的子进程需要
+    multiprocessing.freeze_support()
+
+    start_background_tasks()
 
-    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 3000)))
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 3000)))
@@ -0,0 +1,421 @@
+import asyncio
+import functools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import app as proxy
+from hedging import async_hedged_call
+from body_reader import RequestBodyError
+from embedding_batcher import EmbeddingError
+from stream_resume import AsyncResumableStream, continuation_contents
+from response_cache import CachedResponse, cache_key as response_cache_key
+import func
+import sse
+import metrics
+import request_log
+from token_estimator import estimate_tokens
+from admission import client_id
+from model_catalog import etag_matches
+from app import logger, MAX_RETRIES, safety_settings
+
+# 异步服务模式：每个请求 / 每条 SSE 流只占用一个协程，而不是一个工作线程。
+# 运行方式: uvicorn asgi:app --host 0.0.0.0 --port 3000
+# key 轮换、速率限制和错误映射与 app.py (Flask) 共用同一套实现。
+
+
+def cached_body_response(request, body, etag, media_type):
+    """客户端带着相同 ETag 的 If-None-Match 时返回 304，不重复发送内容"""
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type=media_type, headers=headers)
+
+async def index(request):
+    snapshot = proxy.model_catalog.snapshot
+    return cached_body_response(request, snapshot.index_body, snapshot.index_etag, 'text/html')
+
+async def list_models(request):
+    snapshot = proxy.model_catalog.snapshot
+    return cached_body_response(request, snapshot.models_body, snapshot.models_etag, 'application/json')
+
+async def prometheus_metrics(request):
+    is_authenticated, auth_error, status_code = func.check_authorization(request.headers.get('Authorization'),
+                                                                         proxy.METRICS_TOKEN)
+    if not is_authenticated:
+        return JSONResponse(auth_error, status_code=status_code)
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+async def resume_stream(model, generation_config, gemini_history, user_message, client, tokens, keys, partial_text, error):
+    """proxy.resume_stream 的异步版本：排队等 key 和退避只挂起协程，不占用线程，因此可以等待"""
+    from google.api_core.exceptions import GoogleAPICallError
+
+    if not isinstance(error, GoogleAPICallError):
+        return None
+    retry_state = proxy.retry_policy.start()
+    retry_state.tried_keys.update(keys)
+    await asyncio.to_thread(proxy.handle_api_error, error, keys[-1], retry_state)
+    contents = continuation_contents(gemini_history, user_message, partial_text)
+
+    for attempt in range(1, MAX_RETRIES + 1):
+        if not retry_state.allow_retry():
+            logger.error("重试预算已耗尽，不再续写")
+            break
+        api_key, _ = await proxy.admission_queue.admit_async(
+            client, lambda: proxy.acquire_key(retry_state, tokens=tokens, model=model), retry_state.remaining())
+        if api_key is None:
+            break
+        keys.append(api_key)
+        logger.warning("流式输出中断（已输出 %d 个字符），换 key 续写，第 %d/%d 次尝试 → %s...",
+                       len(partial_text), attempt, MAX_RETRIES, api_key[:11])
+        metrics.upstream_attempts_total.inc(model, metrics.key_label(api_key))
+        try:
+            gen_model = proxy.client_pool.get_model(api_key, model, generation_config, safety_settings, use_async=True)
+            response = await gen_model.generate_content_async(contents, stream=True)
+            proxy.key_health.record_success(api_key)
+            metrics.stream_resumes_total.inc(model, 'resumed')
+            return response
+        except Exception as e:
+            success, delay = await asyncio.to_thread(proxy.handle_api_error, e, api_key, retry_state)
+        if success != 0 or not retry_state.can_wait(delay):
+            break
+        if delay:
+            await asyncio.sleep(delay)
+
+    metrics.stream_resumes_total.inc(model, 'failed')
+    return None
+
+def request_content_length(request):
+    """Content-Length 请求头，没有时返回 None；不是非负整数时按请求格式错误拒绝"""
+    content_length = request.headers.get('content-length')
+    if not content_length:
+        return None
+    try:
+        content_length = int(content_length)
+    except ValueError:
+        content_length = -1
+    if content_length < 0:
+        raise RequestBodyError("Content-Length 请求头不合法", 400)
+    return content_length
+
+async def read_request_json(request):
+    """小请求体直接解析，大请求体按块增量解析；收尾（可能包含图片预处理）放到线程中执行"""
+    if not proxy.check_content_length(request_content_length(request)):
+        try:
+            return proxy.require_json_object(await request.json())
+        except ValueError as e:
+            raise RequestBodyError(f"请求体不是合法的 JSON: {e}", 400)
+    parser = proxy.new_body_parser()
+    async for chunk in request.stream():
+        parser.feed(chunk)
+    return proxy.require_json_object(await asyncio.to_thread(parser.close))
+
+async def chat_completions(request):
+    start_time = time.monotonic()
+    request_info = {'request_id': request_log.begin(request.headers.get('X-Request-ID'), proxy.LOG_SAMPLE_RATE)}
+    response = await handle_chat_completions(request, request_info, start_time)
+    response.headers['X-Request-ID'] = request_info['request_id']
+    proxy.record_request_metrics(request_info, response.status_code, start_time)
+    # 流式请求在流结束时记录
+    if proxy.traffic_capture.enabled and not isinstance(response, StreamingResponse):
+        if response.status_code != 200:
+            request_info.setdefault('outcome', proxy.error_outcome(json.loads(response.body) if response.body else None))
+        proxy.traffic_capture.record(request_info, response.status_code, start_time)
+    return response
+
+async def handle_chat_completions(request, request_info, start_time):
+    is_authenticated, auth_error, status_code = func.check_authorization(request.headers.get('Authorization'))
+    if not is_authenticated:
+        return JSONResponse(auth_error, status_code=status_code)
+
+    try:
+        request_data = await read_request_json(request)
+        request_info.update(request=request_data, body_bytes=request_content_length(request))
+    except RequestBodyError as e:
+        logger.error("读取请求体失败: %s", e.message)
+        return JSONResponse({'error': e.message}, status_code=e.status)
+    messages, model, temperature, max_tokens, stream = proxy.parse_chat_request(request_data)
+    hint = "流式" if stream else "非流"
+    logger.info("\n%s [%s]", model, hint)
+    request_info.update(model=model, stream=stream)
+    request_log.bind(model=model)
+
+    # 媒体解码和图片预处理可能耗时较长，放到线程中执行，避免阻塞事件循环
+    media_stats = {}
+    gemini_history, user_message, error_response = await asyncio.to_thread(
+        func.process_messages_for_gemini, messages, proxy.media_store, media_stats)
+
+    if error_response:
+        logger.error("处理输入消息时出错↙\n %s", error_response)
+        return JSONResponse(error_response, status_code=400)
+    media_headers = proxy.media_stats_headers(media_stats)
+
+    retry_state = proxy.retry_policy.start()
+    hedge = not stream and proxy.hedge_policy.start(model, request_data)
+    context_plan = proxy.context_cache.plan(model, gemini_history)
+    estimated_tokens = estimate_tokens(gemini_history, user_message) if proxy.MAX_INPUT_TOKENS else 0
+    usage_ticket = next(proxy.usage_tickets) if proxy.MAX_INPUT_TOKENS else None
+    client = client_id(request.headers.get('Authorization'), request_data.get('user'))
+    request_info['client'] = client
+
+    async def do_request(current_api_key):
+        generation_config = {
+            "temperature": temperature,
+            "max_output_tokens": max_tokens
+        }
+
+        # 命中上下文缓存时只发送缓存前缀之后的消息
+        context = await proxy.context_cache.acquire_async(current_api_key, context_plan, logger)
+        history = gemini_history[context.turns:] if context else gemini_history
+
+        gen_model = proxy.client_pool.get_model(current_api_key, model, generation_config, safety_settings, use_async=True,
+                                                cached_content=context.name if context else None)
+        request_options = proxy.upstream_request_options(stream, retry_state)
+
+        metrics.upstream_attempts_total.inc(model, metrics.key_label(current_api_key))
+        try:
+            call_start = time.monotonic()
+            if history:
+                chat_session = gen_model.start_chat(history=history)
+                response = await chat_session.send_message_async(user_message, stream=stream, request_options=request_options)
+            else:
+                response = await gen_model.generate_content_async(user_message, stream=stream, request_options=request_options)
+            latency = time.monotonic() - call_start
+            metrics.upstream_latency.observe(latency, model, str(stream).lower())
+            if not stream:
+                proxy.hedge_policy.tracker.record(model, latency)
+                await asyncio.to_thread(proxy.key_manager.record_usage, current_api_key, usage_ticket,
+                                        estimated_tokens, getattr(response.usage_metadata, 'prompt_token_count', 0))
+            proxy.key_health.record_success(current_api_key)
+            return 1, response, 0
+        except Exception as e:
+            if context is not None and proxy.is_stale_context_error(e):
+                logger.warning("%s → 上下文缓存已失效，改为发送完整历史重试", current_api_key[:11])
+                proxy.context_cache.invalidate(context)
+                return 0, None, 0
+            success, delay = await asyncio.to_thread(proxy.handle_api_error, e, current_api_key, retry_state)
+            return success, None, delay
+        finally:
+            proxy.context_cache.release(context)
+
+    async def generate(response, store_key=None, api_key=None, record_usage=True):
+        texts = []
+        usage_metadata = []
+
+        async def upstream_texts():
+            async for chunk in response:
+                # 每个分块都带有截至目前的用量，最后一个分块的即为总用量
+                if getattr(chunk, 'usage_metadata', None):
+                    usage_metadata[:] = [chunk.usage_metadata]
+                if chunk.text:
+                    if not texts:
+                        request_info['ttft'] = time.monotonic() - start_time
+                        metrics.ttft.observe(request_info['ttft'], model)
+                    texts.append(chunk.text)
+                    yield chunk.text
+
+        stream_start = time.monotonic()
+        try:
+            logger.info("流式开始...")
+            async for text in sse.async_coalesce(upstream_texts(), proxy.STREAM_FLUSH_INTERVAL, proxy.STREAM_FLUSH_BYTES):
+                yield sse.encode_delta(text)
+
+            logger.info("流式结束")
+            usage = proxy.usage_from_metadata(model, usage_metadata[0] if usage_metadata else None, record_usage)
+            if api_key:
+                await asyncio.to_thread(proxy.key_manager.record_usage, api_key, usage_ticket, estimated_tokens,
+                                        usage['prompt_tokens'])
+            yield sse.encode_stop(usage)
+            logger.info("200!")
+            metrics.streams_total.inc(model, 'completed')
+            request_info['outcome'] = 'cache_hit' if isinstance(response, CachedResponse) else 'completed'
+            if store_key:
+                await asyncio.to_thread(proxy.response_cache.put, store_key, {'text': ''.join(texts)})
+
+        except Exception:
+            logger.error("流式输出中途被截断，请关闭流式输出或修改你的输入")
+            logger.info("流式结束")
+            metrics.streams_total.inc(model, 'truncated')
+            request_info['outcome'] = 'truncated'
+            yield sse.encode_event(proxy.STREAM_ERROR_DATA)
+            yield sse.STOP_EVENT
+        finally:
+            metrics.stream_duration.observe(time.monotonic() - stream_start, model)
+            proxy.traffic_capture.record(request_info, 200, start_time)
+            request_log.end()
+
+    cache_key = None
+    if proxy.response_cache.cacheable(temperature):
+        cache_key = response_cache_key(model, gemini_history, user_message, temperature, max_tokens)
+        # 配置了 ResponseCachePath 时会读写 SQLite，放到线程池中执行
+        cached = await asyncio.to_thread(proxy.response_cache.get, cache_key)
+        metrics.response_cache_total.inc('miss' if cached is None else 'hit')
+        if cached is not None:
+            logger.info("命中响应缓存")
+            request_info['outcome'] = 'cache_hit'
+            response = CachedResponse(cached['text'])
+            if stream:
+                return StreamingResponse(generate(response), media_type='text/event-stream', headers=media_headers)
+            response_data, status = proxy.build_completion(response, model)
+            return JSONResponse(response_data, status_code=status, headers=media_headers)
+
+    flight = None
+    if proxy.single_flight.coalescable(temperature):
+        flight_key = cache_key or response_cache_key(model, gemini_history, user_message, temperature, max_tokens)
+        # 只合并同一客户端（Authorization 和 user 字段相同）的请求
+        flight, leader = await proxy.single_flight.join_async(f"{client}:{flight_key}:{'stream' if stream else 'full'}",
+                                                              retry_state.remaining())
+        if flight is None:
+            error_data, status = proxy.deadline_exceeded_error()
+            return JSONResponse(error_data, status_code=status)
+        if not leader:
+            logger.info("与进行中的相同请求合并")
+            metrics.coalesced_requests_total.inc(model, str(stream).lower())
+            request_info['outcome'] = 'coalesced'
+            if stream:
+                return StreamingResponse(generate(flight, record_usage=False), media_type='text/event-stream', headers=media_headers)
+            response_data, status = proxy.build_completion(flight.response, model, record_usage=False)
+            return JSONResponse(response_data, status_code=status, headers=media_headers)
+
+    try:
+        response = None
+
+        for attempt in range(1, MAX_RETRIES + 1):
+            if retry_state.remaining() <= 0:
+                error_data, status = proxy.deadline_exceeded_error()
+                return JSONResponse(error_data, status_code=status)
+            request_info['attempts'] = attempt
+
+            preferred = proxy.context_cache.preferred_keys(context_plan)
+            # 没有可用 key 时在准入队列中协程等待，不占用线程
+            current_api_key, wait_time = await proxy.admission_queue.admit_async(
+                client, lambda: proxy.acquire_key(retry_state, preferred, estimated_tokens, model, usage_ticket),
+                retry_state.remaining())
+
+            if current_api_key is None:
+                if wait_time is not None:
+                    metrics.admission_rejected_total.inc()
+                error_data, status, headers = proxy.no_available_key_error(wait_time)
+                return JSONResponse(error_data, status_code=status, headers=headers)
+
+            request_info['key'] = metrics.key_label(current_api_key)
+            request_log.bind(key=request_info['key'], attempt=attempt)
+            logger.info("第 %d/%d 次尝试 → %s...", attempt, MAX_RETRIES, current_api_key[:11])
+            if hedge:
+                success, response, delay = await async_hedged_call(do_request, current_api_key,
+                                                                   lambda: proxy.acquire_hedge_key(retry_state, estimated_tokens,
+                                                                                                   model, usage_ticket),
+                                                                   proxy.hedge_policy.delay(model))
+            else:
+                success, response, delay = await do_request(current_api_key)
+
+            if success == 1:
+                break
+            elif success == 2:
+                error_data, status = proxy.model_unavailable_error(model)
+                return JSONResponse(error_data, status_code=status)
+
+            if attempt < MAX_RETRIES:
+                if not retry_state.allow_retry():
+                    error_data, status = proxy.retry_budget_exhausted_error()
+                    return JSONResponse(error_data, status_code=status)
+                if delay:
+                    if not retry_state.can_wait(delay):
+                        error_data, status = proxy.deadline_exceeded_error()
+                        return JSONResponse(error_data, status_code=status)
+                    await asyncio.sleep(delay)
+
+        else:
+            error_data, status = proxy.retries_exhausted_error()
+            return JSONResponse(error_data, status_code=status)
+
+        if stream and proxy.STREAM_RESUME_ATTEMPTS:
+            response = AsyncResumableStream(response, functools.partial(
+                resume_stream, model, {"temperature": temperature, "max_output_tokens": max_tokens},
+                gemini_history, user_message, client, estimated_tokens, [current_api_key]), proxy.STREAM_RESUME_ATTEMPTS)
+        if flight is not None:
+            flight.resolve(response, stream)
+        if stream:
+            return StreamingResponse(generate(flight or response, cache_key, current_api_key),
+                                     media_type='text/event-stream', headers=media_headers)
+        else:
+            response_data, status = proxy.build_completion(response, model)
+            if cache_key and status == 200:
+                await asyncio.to_thread(proxy.response_cache.put, cache_key,
+                                        {'text': response_data['choices'][0]['message']['content']})
+            return JSONResponse(response_data, status_code=status, headers=media_headers)
+    finally:
+        if flight is not None:
+            # 发起者没拿到上游响应就返回时，让等待的相同请求各自重试
+            flight.cancel()
+
+async def embeddings(request):
+    start_time = time.monotonic()
+    request_info = {'request_id': request_log.begin(request.headers.get('X-Request-ID'), proxy.LOG_SAMPLE_RATE)}
+    response = await handle_embeddings(request, request_info)
+    response.headers['X-Request-ID'] = request_info['request_id']
+    proxy.record_request_metrics(request_info, response.status_code, start_time)
+    return response
+
+async def handle_embeddings(request, request_info):
+    is_authenticated, auth_error, status_code = func.check_authorization(request.headers.get('Authorization'))
+    if not is_authenticated:
+        return JSONResponse(auth_error, status_code=status_code)
+
+    try:
+        request_data = await read_request_json(request)
+        model, texts, dimensions, encoding_format = proxy.parse_embedding_request(request_data)
+    except RequestBodyError as e:
+        logger.error("读取请求体失败: %s", e.message)
+        return JSONResponse({'error': e.message}, status_code=e.status)
+    except ValueError as e:
+        error_data, status = proxy.invalid_request_error(str(e))
+        return JSONResponse(error_data, status_code=status)
+    request_info.update(model=model, stream=False)
+    request_log.bind(model=model)
+    logger.info("\n%s [embedding %d 条]", model, len(texts))
+
+    # 批次在线程池中调用上游，这里只挂起协程等待结果
+    futures = [asyncio.wrap_future(future) for future in proxy.submit_embeddings(model, texts, dimensions)]
+    try:
+        vectors = await asyncio.wait_for(asyncio.gather(*futures), proxy.REQUEST_DEADLINE)
+    except EmbeddingError as e:
+        return JSONResponse(e.data, status_code=e.status, headers=e.headers)
+    except asyncio.TimeoutError:
+        error_data, status = proxy.deadline_exceeded_error()
+        return JSONResponse(error_data, status_code=status)
+    return JSONResponse(proxy.build_embedding_response(model, texts, vectors, encoding_format))
+
+@asynccontextmanager
+async def lifespan(app):
+    # asyncio.to_thread 使用的默认线程池，大小由 serve.py 按预期并发流数确定
+    threads = int(proxy.config.get("Threads") or 0)
+    if threads:
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=threads))
+    proxy.start_background_tasks()
+    yield
+    logger.info("服务正在退出")
+    if proxy.scheduler is not None:
+        proxy.scheduler.shutdown(wait=False)
+
+app = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/v1/chat/completions', chat_completions, methods=['POST']),
+        Route('/v1/embeddings', embeddings, methods=['POST']),
+        Route('/v1/models', list_models, methods=['GET']),
+        Route('/metrics', prometheus_metrics, methods=['GET']),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 3000)))
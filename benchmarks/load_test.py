@@ -0,0 +1,362 @@
+"""
+代理整体压测：在本进程中启动模拟上游（mock_upstream.py），以子进程启动代理，
+再用多个并发客户端压测 /v1/chat/completions 的流式和非流式接口。
+
+输出每种模式的 req/s、延迟和首字延迟（TTFT）的 p50/p99、上游重试次数，
+以及代理进程（含 worker 子进程）每个请求消耗的 CPU 时间和内存，结果写成 JSON，便于不同版本之间对比。
+CPU/内存统计读取 /proc，仅支持 Linux。
+
+    python benchmarks/load_test.py --server asgi --concurrency 32 --duration 15 --output results.json
+    python benchmarks/load_test.py --errors 429=0.05,503=0.02 --compare results.json
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_upstream
+
+PASSWORD = "bench"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+# Flask 模式：不使用 app.py 的 __main__（debug 模式的重载器会多启动一个进程），直接运行多线程开发服务器
+FLASK_COMMAND = ("import os, app; app.start_background_tasks(); "
+                 "app.app.run(host='127.0.0.1', port=int(os.environ['PORT']), threaded=True)")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def fake_keys(count):
+    return [f"AIzaSy{'BENCH' + str(i).zfill(4):_<33}" for i in range(count)]
+
+
+def start_proxy(args, upstream_port):
+    port = free_port()
+    env = {key: value for key, value in os.environ.items() if key != "GEMINI_PROXY_CONFIG"}
+    env.update({
+        "KeyArray": "\n".join(fake_keys(args.keys)),
+        "password": PASSWORD,
+        "PORT": str(port),
+        "UpstreamEndpoint": f"http://127.0.0.1:{upstream_port}",
+        "MaxRequests": str(args.max_requests),
+        "LimitWindow": "60",
+        "ResponseCacheTTL": "0",
+        "PYTHONWARNINGS": "ignore",
+    })
+    if args.workers:
+        env["Workers"] = str(args.workers)
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    command = [sys.executable, "serve.py"] if args.server == "asgi" else [sys.executable, "-c", FLASK_COMMAND]
+    log = tempfile.NamedTemporaryFile(prefix="proxy-", suffix=".log", delete=False)
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            connection.request("GET", "/v1/models")
+            connection.getresponse().read()
+            return process, port, log.name
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    with open(log.name, encoding="utf-8", errors="replace") as f:
+        sys.exit(f"代理启动失败，日志:\n{f.read()[-4000:]}")
+
+
+def process_tree(pid):
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def cpu_seconds(pid):
+    """进程树的 CPU 时间（用户态 + 内核态）"""
+    total = 0
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def rss_bytes(pid):
+    total = 0
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize_ms(values):
+    if not values:
+        return None
+    return {
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p90": round(percentile(values, 90) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "mean": round(sum(values) / len(values) * 1000, 2),
+    }
+
+
+class Client:
+    """每个并发客户端一个线程，复用一条 keep-alive 连接"""
+
+    def __init__(self, port, stream, prompt_chars, index):
+        self.port = port
+        self.stream = stream
+        self.prompt_chars = prompt_chars
+        self.index = index
+        self.connection = None
+        self.sequence = 0
+
+    def request(self):
+        self.sequence += 1
+        prompt = f"[{self.index}-{self.sequence}] " + "x" * self.prompt_chars
+        body = json.dumps({"model": "gemini-1.5-flash", "stream": self.stream,
+                           "messages": [{"role": "user", "content": prompt}]})
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {PASSWORD}"}
+        start = time.perf_counter()
+        ttft = None
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=120)
+            self.connection.request("POST", "/v1/chat/completions", body, headers)
+            response = self.connection.getresponse()
+            while True:
+                data = response.read1(65536) if self.stream else response.read()
+                if not data:
+                    break
+                if ttft is None and self.stream and b'"content"' in data:
+                    ttft = time.perf_counter() - start
+                if not self.stream:
+                    break
+            status = response.status
+            if response.will_close:
+                self.connection.close()
+                self.connection = None
+        except (OSError, http.client.HTTPException):
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = None
+            status = "connection_error"
+        return status, time.perf_counter() - start, ttft
+
+
+def run_load(port, stream, concurrency, duration, prompt_chars):
+    stop_at = time.perf_counter() + duration
+    results = []
+    lock = threading.Lock()
+
+    def worker(index):
+        client = Client(port, stream, prompt_chars, index)
+        local = []
+        while time.perf_counter() < stop_at:
+            local.append(client.request())
+        with lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def upstream_calls(mock):
+    """模拟上游收到的生成请求数（含注入错误的请求）"""
+    return sum(count for (method, _), count in mock.calls.items() if "Generate" in method)
+
+
+def measure(args, mock, process, port, stream):
+    mode = "stream" if stream else "non-stream"
+    if args.warmup:
+        run_load(port, stream, args.concurrency, args.warmup, args.prompt_chars)
+
+    rss_peak = [rss_bytes(process.pid)]
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.wait(0.5):
+            rss_peak[0] = max(rss_peak[0], rss_bytes(process.pid))
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    calls_before, cpu_before = upstream_calls(mock), cpu_seconds(process.pid)
+    results, elapsed = run_load(port, stream, args.concurrency, args.duration, args.prompt_chars)
+    cpu_used, calls = cpu_seconds(process.pid) - cpu_before, upstream_calls(mock) - calls_before
+    done.set()
+    sampler.join()
+
+    statuses = {}
+    for status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = [(latency, ttft) for status, latency, ttft in results if status == 200]
+    count = len(results)
+    return {
+        "mode": mode,
+        "requests": count,
+        "ok": len(ok),
+        "status_counts": statuses,
+        "duration_s": round(elapsed, 2),
+        "rps": round(len(ok) / elapsed, 2),
+        "latency_ms": summarize_ms([latency for latency, _ in ok]),
+        "ttft_ms": summarize_ms([ttft for _, ttft in ok if ttft is not None]) if stream else None,
+        "upstream_calls": calls,
+        "retries_per_request": round((calls - count) / count, 4) if count else None,
+        "cpu_ms_per_request": round(cpu_used * 1000 / count, 3) if count else None,
+        "rss_mb": round(rss_bytes(process.pid) / 1024 / 1024, 1),
+        "rss_peak_mb": round(rss_peak[0] / 1024 / 1024, 1),
+    }
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_result(result):
+    line = (f"{result['mode']:<11} {result['rps']:>9.1f} req/s  "
+            f"p50 {result['latency_ms']['p50'] if result['latency_ms'] else '-':>8} ms  "
+            f"p99 {result['latency_ms']['p99'] if result['latency_ms'] else '-':>8} ms  ")
+    if result["ttft_ms"]:
+        line += f"TTFT p50 {result['ttft_ms']['p50']:>7} ms  p99 {result['ttft_ms']['p99']:>7} ms  "
+    line += (f"重试/请求 {result['retries_per_request']}  CPU {result['cpu_ms_per_request']} ms/请求  "
+             f"RSS {result['rss_mb']} MB (峰值 {result['rss_peak_mb']} MB)  状态 {result['status_counts']}")
+    print(line)
+
+
+# 对比时关注的指标，以及数值变大是否代表变好
+COMPARED_METRICS = [
+    ("rps", ("rps",), True),
+    ("p50 延迟", ("latency_ms", "p50"), False),
+    ("p99 延迟", ("latency_ms", "p99"), False),
+    ("TTFT p50", ("ttft_ms", "p50"), False),
+    ("TTFT p99", ("ttft_ms", "p99"), False),
+    ("CPU/请求", ("cpu_ms_per_request",), False),
+    ("RSS 峰值", ("rss_peak_mb",), False),
+]
+
+
+def compare(baseline, current):
+    print(f"\n与 {baseline.get('version') or '基线'} 对比（当前 {current.get('version') or '-'}）:")
+    previous = {result["mode"]: result for result in baseline.get("results", [])}
+    for result in current["results"]:
+        old = previous.get(result["mode"])
+        if old is None:
+            continue
+        for name, path, higher_is_better in COMPARED_METRICS:
+            before, after = old, result
+            for part in path:
+                before = before.get(part) if isinstance(before, dict) else None
+                after = after.get(part) if isinstance(after, dict) else None
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            better = (change > 0) == higher_is_better
+            print(f"  {result['mode']:<11} {name:<10} {before:>10} → {after:<10} "
+                  f"{change:+.1f}% {'更好' if better and abs(change) >= 1 else ('更差' if abs(change) >= 1 else '')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=("asgi", "flask"), default="asgi",
+                        help="asgi 为 serve.py 生产模式，flask 为 app.py 的多线程服务器")
+    parser.add_argument("--workers", type=int, default=1, help="asgi 模式的 worker 进程数，0 为按 CPU 自动确定")
+    parser.add_argument("--modes", default="stream,non-stream")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="每种模式的压测时长（秒）")
+    parser.add_argument("--warmup", type=float, default=2, help="每种模式正式计时前的预热时长（秒）")
+    parser.add_argument("--prompt-chars", type=int, default=200)
+    parser.add_argument("--keys", type=int, default=8, help="模拟的 API key 数")
+    parser.add_argument("--max-requests", type=int, default=1000000, help="每个 key 的 MaxRequests")
+    parser.add_argument("--env", action="append", default=[], help="传给代理的额外配置，如 --env StreamFlushMs=20")
+    parser.add_argument("--output", help="结果 JSON 文件")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 对比")
+    mock_upstream.add_arguments(parser)
+    args = parser.parse_args()
+
+    mock = mock_upstream.mock_from_args(args)
+    server, upstream_port = mock_upstream.start(mock, max_workers=max(64, args.concurrency * 4))
+    process, port, log_path = start_proxy(args, upstream_port)
+    try:
+        report = {
+            "version": git_version(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "cpus": os.cpu_count(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+            "results": [],
+        }
+        print(f"代理 {args.server} 模式，{args.concurrency} 并发，每种模式 {args.duration:g} 秒，日志 {log_path}")
+        for mode in args.modes.split(","):
+            result = measure(args, mock, process, port, mode.strip() == "stream")
+            report["results"].append(result)
+            print_result(result)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        server.stop(grace=0)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+本地模拟的 Gemini 上游（gRPC，与官方 v1beta 协议一致），用于压测和本地联调，不消耗真实配额。
+支持 GenerateContent / StreamGenerateContent / CountTokens / EmbedContent / BatchEmbedContents、
+ModelService 的 ListModels / GetModel，以及 CacheService 的创建/删除缓存。
+
+首个响应的延迟、流式分块的数量和间隔都可以配置，并可以按比例注入 429/403/500/503 错误、提示词被拦截的响应，
+以及流式输出到一半时断开 (midstream)。请求以 model 角色的内容结尾时，从该前缀之后继续生成（与续写的行为一致）。
+
+    python benchmarks/mock_upstream.py --port 50051 --latency 0.2 --chunks 20 --chunk-interval 0.02 \\
+        --errors 429=0.05,503=0.01,blocked=0.01,midstream=0.01
+
+代理端设置 UpstreamEndpoint=http://127.0.0.1:50051 即可对接（仅支持默认的 grpc 传输）。
+"""
+import argparse
+import hashlib
+import itertools
+import math
+import random
+import struct
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from google.ai.generativelanguage_v1beta import types
+from google.protobuf import empty_pb2
+
+SERVICE_PREFIX = "google.ai.generativelanguage.v1beta."
+
+# 错误名 → gRPC 状态码（与官方 API 的 HTTP 状态码对应）；blocked 返回带 block_reason 的正常响应
+ERROR_CODES = {
+    "429": grpc.StatusCode.RESOURCE_EXHAUSTED,
+    "403": grpc.StatusCode.PERMISSION_DENIED,
+    "500": grpc.StatusCode.INTERNAL,
+    "503": grpc.StatusCode.UNAVAILABLE,
+    "blocked": None,
+    # 流式输出到一半时以 UNAVAILABLE 断开；非流式方法按 503 处理
+    "midstream": grpc.StatusCode.UNAVAILABLE,
+}
+
+DEFAULT_MODELS = ["gemini-1.5-flash", "gemini-1.5-pro", "gemini-2.0-flash-exp", "text-embedding-004"]
+
+
+def parse_errors(value):
+    """'429=0.05,503=0.01' → {'429': 0.05, '503': 0.01}"""
+    errors = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        name, _, rate = item.partition("=")
+        name = name.strip()
+        if name not in ERROR_CODES:
+            raise ValueError(f"不支持的错误类型: {name}，可选 {', '.join(ERROR_CODES)}")
+        errors[name] = float(rate)
+    return errors
+
+
+class MockGemini:
+    def __init__(self, latency=0.0, jitter=0.0, chunks=8, chunk_interval=0.0, chunk_chars=16, errors=None,
+                 embedding_dim=768, models=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunks = chunks
+        self.chunk_interval = chunk_interval
+        self.chunk_chars = chunk_chars
+        self.errors = errors or {}
+        self.embedding_dim = embedding_dim
+        self.models = models or DEFAULT_MODELS
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.caches = {}
+        self._cache_ids = itertools.count()
+        # 按 (方法, 结果) 统计的调用次数，以及按 key 统计的调用次数
+        self.calls = {}
+        self.calls_by_key = {}
+
+    def _count(self, method, result, api_key):
+        with self._lock:
+            self.calls[(method, result)] = self.calls.get((method, result), 0) + 1
+            self.calls_by_key[api_key] = self.calls_by_key.get(api_key, 0) + 1
+
+    def _begin(self, method, context):
+        """模拟网络和排队延迟并按比例注入错误；返回 'blocked' 表示应返回被拦截的响应"""
+        api_key = dict(context.invocation_metadata()).get("x-goog-api-key", "")
+        delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+        roll = self._random.random()
+        for name, rate in self.errors.items():
+            if roll < rate:
+                self._count(method, name, api_key)
+                if name == "blocked" or name == "midstream" and method == "StreamGenerateContent":
+                    return name
+                context.abort(ERROR_CODES[name], f"mock upstream injected {name}")
+            roll -= rate
+        self._count(method, "ok", api_key)
+        return None
+
+    def _text(self, index):
+        words = ("Hello", " world", "，", "你好", " mock", " token", "\n", " 流式")
+        text = "".join(words[(index + i) % len(words)] for i in range(self.chunk_chars))
+        return text[:self.chunk_chars]
+
+    @staticmethod
+    def _prompt_tokens(request):
+        return sum(max(1, len(part.text) // 4) for content in request.contents for part in content.parts)
+
+    def _response(self, text, request, output_chunks):
+        prompt_tokens = self._prompt_tokens(request)
+        output_tokens = output_chunks * max(1, self.chunk_chars // 4)
+        return types.GenerateContentResponse(
+            candidates=[{"content": {"parts": [{"text": text}], "role": "model"}, "finish_reason": 1, "index": 0}],
+            usage_metadata={"prompt_token_count": prompt_tokens, "candidates_token_count": output_tokens,
+                            "total_token_count": prompt_tokens + output_tokens},
+        )
+
+    @staticmethod
+    def _blocked():
+        return types.GenerateContentResponse(prompt_feedback={"block_reason": 1})
+
+    def generate_content(self, request, context):
+        if self._begin("GenerateContent", context) == "blocked":
+            return self._blocked()
+        text = "".join(self._text(i) for i in range(self.chunks))
+        return self._response(text, request, self.chunks)
+
+    def _resume_index(self, request):
+        """请求以 model 内容结尾时（续写），跳过前缀已经包含的分块"""
+        if not request.contents or request.contents[-1].role != "model":
+            return 0
+        prefix = "".join(part.text for part in request.contents[-1].parts)
+        return min(len(prefix) // max(self.chunk_chars, 1), self.chunks - 1)
+
+    def stream_generate_content(self, request, context):
+        result = self._begin("StreamGenerateContent", context)
+        if result == "blocked":
+            yield self._blocked()
+            return
+        start = self._resume_index(request)
+        for i in range(start, self.chunks):
+            if i > start and self.chunk_interval:
+                time.sleep(self.chunk_interval)
+            if result == "midstream" and i >= start + (self.chunks - start) // 2:
+                context.abort(ERROR_CODES["midstream"], "mock upstream injected midstream disconnect")
+            if i == self.chunks - 1:
+                yield self._response(self._text(i), request, self.chunks)
+            else:
+                yield types.GenerateContentResponse(
+                    candidates=[{"content": {"parts": [{"text": self._text(i)}], "role": "model"}, "index": 0}])
+
+    def count_tokens(self, request, context):
+        self._begin("CountTokens", context)
+        return types.CountTokensResponse(total_tokens=self._prompt_tokens(request))
+
+    def _embedding(self, content):
+        """按文本内容确定性地生成单位向量，相同输入得到相同结果"""
+        text = "".join(part.text for part in content.parts)
+        values, counter = [], 0
+        while len(values) < self.embedding_dim:
+            digest = hashlib.sha256(f"{counter}:{text}".encode("utf-8")).digest()
+            values.extend(x / 2 ** 31 - 1 for x in struct.unpack("<8I", digest))
+            counter += 1
+        values = values[:self.embedding_dim]
+        norm = math.sqrt(sum(v * v for v in values)) or 1
+        return {"values": [v / norm for v in values]}
+
+    def embed_content(self, request, context):
+        self._begin("EmbedContent", context)
+        return types.EmbedContentResponse(embedding=self._embedding(request.content))
+
+    def batch_embed_contents(self, request, context):
+        self._begin("BatchEmbedContents", context)
+        return types.BatchEmbedContentsResponse(
+            embeddings=[self._embedding(item.content) for item in request.requests])
+
+    def _model(self, name):
+        short = name.split("/", 1)[-1]
+        methods = ["embedContent", "batchEmbedContents"] if "embedding" in short else \
+            ["generateContent", "countTokens", "createCachedContent"]
+        return types.Model(name=f"models/{short}", base_model_id=short, version="001", display_name=short,
+                           input_token_limit=1048576, output_token_limit=8192,
+                           supported_generation_methods=methods)
+
+    def list_models(self, request, context):
+        return types.ListModelsResponse(models=[self._model(name) for name in self.models])
+
+    def get_model(self, request, context):
+        if request.name.split("/", 1)[-1] not in self.models:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"model {request.name} not found")
+        return self._model(request.name)
+
+    def create_cached_content(self, request, context):
+        with self._lock:
+            name = f"cachedContents/mock{next(self._cache_ids)}"
+            self.caches[name] = request.cached_content
+        return types.CachedContent(name=name, model=request.cached_content.model)
+
+    def delete_cached_content(self, request, context):
+        with self._lock:
+            self.caches.pop(request.name, None)
+        return empty_pb2.Empty()
+
+    def handlers(self):
+        def unary(func, request_type, response_type):
+            return grpc.unary_unary_rpc_method_handler(
+                func, request_deserializer=request_type.deserialize, response_serializer=response_type.serialize)
+
+        generative = grpc.method_handlers_generic_handler(SERVICE_PREFIX + "GenerativeService", {
+            "GenerateContent": unary(self.generate_content, types.GenerateContentRequest,
+                                     types.GenerateContentResponse),
+            "StreamGenerateContent": grpc.unary_stream_rpc_method_handler(
+                self.stream_generate_content, request_deserializer=types.GenerateContentRequest.deserialize,
+                response_serializer=types.GenerateContentResponse.serialize),
+            "CountTokens": unary(self.count_tokens, types.CountTokensRequest, types.CountTokensResponse),
+            "EmbedContent": unary(self.embed_content, types.EmbedContentRequest, types.EmbedContentResponse),
+            "BatchEmbedContents": unary(self.batch_embed_contents, types.BatchEmbedContentsRequest,
+                                        types.BatchEmbedContentsResponse),
+        })
+        model = grpc.method_handlers_generic_handler(SERVICE_PREFIX + "ModelService", {
+            "ListModels": unary(self.list_models, types.ListModelsRequest, types.ListModelsResponse),
+            "GetModel": unary(self.get_model, types.GetModelRequest, types.Model),
+        })
+        cache = grpc.method_handlers_generic_handler(SERVICE_PREFIX + "CacheService", {
+            "CreateCachedContent": unary(self.create_cached_content, types.CreateCachedContentRequest,
+                                         types.CachedContent),
+            "DeleteCachedContent": grpc.unary_unary_rpc_method_handler(
+                self.delete_cached_content, request_deserializer=types.DeleteCachedContentRequest.deserialize,
+                response_serializer=empty_pb2.Empty.SerializeToString),
+        })
+        return generative, model, cache
+
+
+def start(mock, host="127.0.0.1", port=0, max_workers=256):
+    """启动 gRPC 服务，返回 (server, 实际端口)；max_workers 即可同时处理的上游请求数"""
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers),
+                         options=[("grpc.max_receive_message_length", -1), ("grpc.max_send_message_length", -1)])
+    server.add_generic_rpc_handlers(mock.handlers())
+    port = server.add_insecure_port(f"{host}:{port}")
+    server.start()
+    return server, port
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.05, help="首个响应前的延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟的随机抖动范围（秒）")
+    parser.add_argument("--chunks", type=int, default=8, help="每个响应的分块数")
+    parser.add_argument("--chunk-interval", type=float, default=0.01, help="流式分块之间的间隔（秒）")
+    parser.add_argument("--chunk-chars", type=int, default=16, help="每个分块的字符数")
+    parser.add_argument("--errors", default="", help="注入错误的比例，如 429=0.05,403=0.01,500=0.01,503=0.01,blocked=0.01,midstream=0.01")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def mock_from_args(args):
+    return MockGemini(latency=args.latency, jitter=args.jitter, chunks=args.chunks, chunk_interval=args.chunk_interval,
+                      chunk_chars=args.chunk_chars, errors=parse_errors(args.errors), seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=50051)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server, port = start(mock_from_args(args), args.host, args.port)
+    print(f"模拟上游已启动: http://{args.host}:{port}")
+    try:
+        server.wait_for_termination()
+    except KeyboardInterrupt:
+        server.stop(grace=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+按记录的时间间隔回放 CapturePath 记录的请求（JSONL），用真实的流量形态压测或分析代理。
+
+被脱敏的文本按原长度用占位字符填充；被脱敏的图片生成原大小左右的随机噪声图片，
+其他媒体用原大小的随机字节代替，因此请求体大小和媒体处理开销与原始流量接近。
+
+    python benchmarks/replay.py capture/requests.jsonl --url http://127.0.0.1:3000 --password pw --speed 2
+    python benchmarks/replay.py capture/requests.jsonl --speed 0 --max-inflight 64 --output replay.json
+
+--speed 1 为原速，2 为两倍速，0 为不按时间间隔、尽快发送（同时最多 --max-inflight 个请求）。
+"""
+import argparse
+import base64
+import http.client
+import json
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import summarize_ms
+
+
+class MediaFactory:
+    """为被脱敏的媒体生成同类型、大小接近的替代内容，相同 (类型, 大小) 只生成一次"""
+
+    def __init__(self):
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def data_uri(self, mime_type, size):
+        mime_type = mime_type or 'application/octet-stream'
+        size = max(int(size or 0), 1)
+        key = (mime_type, size)
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = f"data:{mime_type};base64,{base64.b64encode(self._generate(mime_type, size)).decode()}"
+            return self._cache[key]
+
+    @staticmethod
+    def _generate(mime_type, size):
+        if mime_type.startswith('image/'):
+            try:
+                from PIL import Image
+                # 随机噪声几乎无法压缩，PNG 约每像素 3 字节
+                side = max(1, int(math.sqrt(size / 3)))
+                image = Image.frombytes('RGB', (side, side), os.urandom(side * side * 3))
+                output = BytesIO()
+                image.save(output, format='PNG')
+                return output.getvalue()
+            except Exception:
+                pass
+        return os.urandom(size)
+
+
+def restore_text(value, filler):
+    if isinstance(value, dict) and value.get('redacted') == 'text':
+        return filler * value.get('chars', 0)
+    return value
+
+
+def restore_media(value, media):
+    if isinstance(value, dict) and value.get('redacted') == 'media':
+        return media.data_uri(value.get('mime_type'), value.get('bytes'))
+    return value
+
+
+def restore_request(request_data, media, filler='x'):
+    """把记录中的请求体还原成可以发送的请求"""
+    request_data = dict(request_data)
+    messages = []
+    for message in request_data.get('messages') or []:
+        if not isinstance(message, dict):
+            messages.append(message)
+            continue
+        content = message.get('content')
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                if isinstance(part, dict):
+                    part = dict(part)
+                    if 'text' in part:
+                        part['text'] = restore_text(part['text'], filler)
+                    for field in ('image_url', 'file', 'input_audio'):
+                        value = part.get(field)
+                        if isinstance(value, dict) and value.get('redacted') != 'media':
+                            part[field] = {key: restore_media(item, media) for key, item in value.items()}
+                        elif value is not None:
+                            part[field] = restore_media(value, media)
+                parts.append(part)
+            content = parts
+        else:
+            content = restore_text(content, filler)
+        messages.append(dict(message, content=content))
+    request_data['messages'] = messages
+    return request_data
+
+
+class Sender:
+    """每个线程复用一条 keep-alive 连接"""
+
+    def __init__(self, url, password):
+        parts = urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.path = parts.path.rstrip('/') + '/v1/chat/completions'
+        self.headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {password}'}
+        self._local = threading.local()
+
+    def _connection(self):
+        """返回 (连接, 是否为复用的旧连接)"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            return connection, True
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        connection = self._local.connection = cls(self.host, self.port, timeout=300)
+        return connection, False
+
+    def _close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+        self._local.connection = None
+
+    def send(self, body, stream):
+        start = time.perf_counter()
+        ttft = None
+        while True:
+            connection, reused = self._connection()
+            try:
+                connection.request('POST', self.path, body, self.headers)
+                response = connection.getresponse()
+                break
+            except (OSError, http.client.HTTPException):
+                self._close()
+                # 空闲的 keep-alive 连接可能已被服务端关闭，换一条新连接重发一次
+                if not reused:
+                    return 'connection_error', time.perf_counter() - start, None
+        try:
+            while True:
+                data = response.read1(65536)
+                if not data:
+                    break
+                if ttft is None and stream and b'"content"' in data:
+                    ttft = time.perf_counter() - start
+            if response.will_close:
+                self._close()
+        except (OSError, http.client.HTTPException):
+            self._close()
+            return 'connection_error', time.perf_counter() - start, ttft
+        return response.status, time.perf_counter() - start, ttft
+
+
+def load_records(path, limit=None):
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record.get('request'), dict):
+                records.append(record)
+            if limit and len(records) >= limit:
+                break
+    records.sort(key=lambda record: record.get('ts', 0))
+    return records
+
+
+def status_counts(statuses):
+    counts = {}
+    for status in statuses:
+        counts[str(status)] = counts.get(str(status), 0) + 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', help='CapturePath 记录的 JSONL 文件')
+    parser.add_argument('--url', default='http://127.0.0.1:3000', help='代理地址')
+    parser.add_argument('--password', default=os.environ.get('password', ''))
+    parser.add_argument('--speed', type=float, default=1.0, help='回放速度倍数，0 为尽快发送')
+    parser.add_argument('--max-inflight', type=int, default=256, help='同时进行的最大请求数')
+    parser.add_argument('--limit', type=int, help='只回放前 N 条记录')
+    parser.add_argument('--output', help='结果 JSON 文件')
+    args = parser.parse_args()
+
+    records = load_records(args.capture, args.limit)
+    if not records:
+        sys.exit('记录文件中没有可回放的请求')
+
+    media = MediaFactory()
+    sender = Sender(args.url, args.password)
+    results = [None] * len(records)
+    first_ts = records[0].get('ts', 0)
+
+    def run(index, record, scheduled):
+        lag = time.perf_counter() - scheduled
+        body = json.dumps(restore_request(record['request'], media))
+        status, latency, ttft = sender.send(body, bool(record['request'].get('stream')))
+        results[index] = (status, latency, ttft, lag)
+
+    print(f"回放 {len(records)} 条请求 → {args.url}，速度 {'尽快' if not args.speed else f'{args.speed:g}x'}")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.max_inflight) as executor:
+        inflight = threading.BoundedSemaphore(args.max_inflight)
+        for index, record in enumerate(records):
+            scheduled = start + (record.get('ts', first_ts) - first_ts) / args.speed if args.speed else time.perf_counter()
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            inflight.acquire()
+            future = executor.submit(run, index, record, scheduled)
+            future.add_done_callback(lambda _: inflight.release())
+    elapsed = time.perf_counter() - start
+
+    done = [result for result in results if result is not None]
+    ok = [result for result in done if result[0] == 200]
+    report = {
+        'capture': os.path.abspath(args.capture),
+        'url': args.url,
+        'speed': args.speed,
+        'requests': len(records),
+        'duration_s': round(elapsed, 2),
+        'rps': round(len(done) / elapsed, 2) if elapsed else None,
+        'status_counts': status_counts(result[0] for result in done),
+        'original_status_counts': status_counts(record.get('status') for record in records),
+        'latency_ms': summarize_ms([result[1] for result in ok]),
+        'original_latency_ms': summarize_ms([record['duration_ms'] / 1000 for record in records
+                                             if record.get('status') == 200 and record.get('duration_ms') is not None]),
+        'ttft_ms': summarize_ms([result[2] for result in ok if result[2] is not None]),
+        'original_ttft_ms': summarize_ms([record['ttft_ms'] / 1000 for record in records if record.get('ttft_ms')]),
+        # 实际发送时间比计划晚了多少：过大说明回放端本身成了瓶颈，应调大 --max-inflight 或降低速度
+        'schedule_lag_ms': summarize_ms([result[3] for result in done]),
+    }
+    for key in ('rps', 'status_counts', 'original_status_counts', 'latency_ms', 'original_latency_ms', 'ttft_ms',
+                'original_ttft_ms', 'schedule_lag_ms'):
+        print(f"{key:<24} {report[key]}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+SSE 编码微基准：对比原来的 json.dumps 编码与 sse.py 中的字节模板编码，以及合并小段文本后的效果。
+单进程单线程运行，结果即每核每秒可编码的分块数。
+
+    python benchmarks/sse_encoder.py [分块数]
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sse
+
+
+def legacy_completion_chunk(content=None, finish_reason=None):
+    return {
+        'choices': [
+            {
+                'delta': {'content': content} if content is not None else {},
+                'finish_reason': finish_reason,
+                'index': 0
+            }
+        ],
+        'object': 'chat.completion.chunk'
+    }
+
+
+def legacy_encode(text):
+    return f"data: {json.dumps(legacy_completion_chunk(text))}\n\n".encode('utf-8')
+
+
+def make_deltas(count):
+    """模拟上游的分块：大多是几个到几十个字符，中英文混合，偶尔带引号和换行"""
+    random.seed(0)
+    words = ["Hello", " world", "，", "你好", "模型", "\n", "\"quoted\"", " the", " 代码", "```python\n", " = ", "\\"]
+    return [''.join(random.choice(words) for _ in range(random.randint(1, 8))) for _ in range(count)]
+
+
+def bench(name, deltas, encode_all):
+    start = time.perf_counter()
+    events, size = encode_all(deltas)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<34} {len(deltas) / elapsed:>12,.0f} 分块/秒  {events:>8} 个事件  {size / 1024:>8.0f} KB")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    deltas = make_deltas(count)
+
+    assert legacy_encode(deltas[0]) == sse.encode_delta(deltas[0])
+    assert f"data: {json.dumps(legacy_completion_chunk(finish_reason='stop'))}\n\n".encode() == sse.STOP_EVENT
+
+    def run_legacy(deltas):
+        out = [legacy_encode(text) for text in deltas]
+        return len(out), sum(map(len, out))
+
+    def run_template(deltas):
+        out = [sse.encode_delta(text) for text in deltas]
+        return len(out), sum(map(len, out))
+
+    def run_coalesced(deltas):
+        # 模拟上游分块在 StreamFlushBytes 内到达（interval 取较大值，只按字节数触发）
+        out = [sse.encode_delta(text) for text in sse.coalesce(deltas, 3600, 4096)]
+        return len(out), sum(map(len, out))
+
+    print(f"{count} 个分块，Python {sys.version.split()[0]}")
+    bench("json.dumps (原实现)", deltas, run_legacy)
+    bench("字节模板", deltas, run_template)
+    bench("字节模板 + 合并 (4096 字节)", deltas, run_coalesced)
+
+
+if __name__ == '__main__':
+    main()
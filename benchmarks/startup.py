@@ -0,0 +1,131 @@
+"""
+冷启动测试：反复以子进程启动代理，测量从启动进程到
+  - 第一个被接受的请求（GET /v1/models 返回）所用的时间，
+  - 第一个成功的 /v1/chat/completions（需要上游 SDK 已导入）所用的时间，
+分别对比 FastStartup 开启和关闭时的结果。上游使用本进程中的模拟上游，不消耗真实配额。
+
+    python benchmarks/startup.py --server asgi --runs 5
+    python benchmarks/startup.py --server flask --runs 3 --output startup.json
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_upstream
+from load_test import FLASK_COMMAND, PASSWORD, ROOT, fake_keys, free_port
+
+CHAT_BODY = json.dumps({"model": "gemini-1.5-flash", "messages": [{"role": "user", "content": "hi"}]})
+
+
+def try_request(port, method, path, body=None):
+    """返回状态码；连接被拒绝（还没开始监听）时返回 None"""
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {PASSWORD}"}
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    except OSError:
+        return None
+    finally:
+        connection.close()
+
+
+def measure_once(args, upstream_port, fast_startup):
+    port = free_port()
+    env = {key: value for key, value in os.environ.items() if key != "GEMINI_PROXY_CONFIG"}
+    env.update({
+        "KeyArray": "\n".join(fake_keys(4)),
+        "password": PASSWORD,
+        "PORT": str(port),
+        "UpstreamEndpoint": f"http://127.0.0.1:{upstream_port}",
+        "MaxRequests": "1000",
+        "ResponseCacheTTL": "0",
+        "FastStartup": "true" if fast_startup else "false",
+        "Workers": "1",
+        "PYTHONWARNINGS": "ignore",
+    })
+    command = [sys.executable, "serve.py"] if args.server == "asgi" else [sys.executable, "-c", FLASK_COMMAND]
+    log = tempfile.NamedTemporaryFile(prefix="startup-", suffix=".log", delete=False)
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        accepted = None
+        deadline = start + args.timeout
+        while time.perf_counter() < deadline and process.poll() is None:
+            if try_request(port, "GET", "/v1/models") is not None:
+                accepted = time.perf_counter() - start
+                break
+            time.sleep(0.005)
+        if accepted is None:
+            with open(log.name, encoding="utf-8", errors="replace") as f:
+                sys.exit(f"代理启动失败，日志:\n{f.read()[-4000:]}")
+        status = try_request(port, "POST", "/v1/chat/completions", CHAT_BODY)
+        first_completion = time.perf_counter() - start
+        if status != 200:
+            print(f"  第一个对话请求返回 {status}，日志 {log.name}")
+        return accepted, first_completion
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        os.unlink(log.name)
+
+
+def summarize(values):
+    return {
+        "median_ms": round(statistics.median(values) * 1000, 1),
+        "min_ms": round(min(values) * 1000, 1),
+        "max_ms": round(max(values) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=("asgi", "flask"), default="asgi",
+                        help="asgi 为 serve.py 生产模式，flask 为 app.py 的多线程服务器")
+    parser.add_argument("--runs", type=int, default=5, help="每种设置启动的次数")
+    parser.add_argument("--timeout", type=float, default=60, help="单次启动的最长等待时间（秒）")
+    parser.add_argument("--output", help="结果 JSON 文件")
+    args = parser.parse_args()
+
+    server, upstream_port = mock_upstream.start(mock_upstream.MockGemini(latency=0, chunks=1))
+    report = {"server": args.server, "runs": args.runs, "python": sys.version.split()[0], "results": {}}
+    try:
+        # 交替启动，避免磁盘缓存等因素只偏向其中一种设置
+        samples = {False: [], True: []}
+        for run in range(args.runs):
+            for fast_startup in (False, True):
+                samples[fast_startup].append(measure_once(args, upstream_port, fast_startup))
+        for fast_startup, values in samples.items():
+            name = "fast_startup" if fast_startup else "default"
+            report["results"][name] = {
+                "first_accepted": summarize([accepted for accepted, _ in values]),
+                "first_completion": summarize([completion for _, completion in values]),
+            }
+            result = report["results"][name]
+            print(f"{name:<13} 首个被接受的请求 {result['first_accepted']['median_ms']:>8} ms   "
+                  f"首个对话完成 {result['first_completion']['median_ms']:>8} ms   (中位数，{args.runs} 次)")
+    finally:
+        server.stop(grace=0)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import binascii
+import json
+import re
+import secrets
+
+from media_store import MAX_HEADER_LENGTH, new_digest, parse_data_uri_header
+
+# 字符串内需要特殊处理的字节：结束引号和转义符
+_STRING_SPECIAL = re.compile(rb'["\\]')
+# base64 字母表以外的字节（换行等），解码前删除，保证按 4 字节对齐分段解码
+_BASE64_JUNK = bytes(c for c in range(256)
+                     if c not in b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')
+_JSON_ESCAPES = {ord('"'): b'"', ord('\\'): b'\\', ord('/'): b'/', ord('b'): b'\b',
+                 ord('f'): b'\f', ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t'}
+
+
+class RequestBodyError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class _MediaPart:
+    """一个正在流式解码的 base64 data URI：边接收边计算哈希、边解码"""
+
+    def __init__(self, mime_type):
+        self.mime_type = mime_type
+        self.digest = new_digest(mime_type)
+        self.size = 0
+        self._pending = bytearray()
+        self._decoded = bytearray()
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        self._pending += bytes(data).translate(None, _BASE64_JUNK)
+        aligned = len(self._pending) // 4 * 4
+        if aligned:
+            self._decode(self._pending[:aligned])
+            del self._pending[:aligned]
+
+    def _decode(self, data):
+        try:
+            self._decoded += binascii.a2b_base64(data)
+        except binascii.Error as e:
+            raise RequestBodyError(f"data URI 中的 base64 数据无效: {e}")
+
+    def finish(self):
+        if self._pending:
+            self._decode(self._pending)
+            self._pending = bytearray()
+        return self.mime_type, self.digest.hexdigest(), self._decoded
+
+
+class StreamingBodyParser:
+    """
+    增量解析 JSON 请求体，适用于带大量图片/文件的请求。
+
+    请求体按块 feed 进来：普通 JSON 文本照常缓冲，最后一次性 json.loads；
+    一旦某个字符串超过 stream_threshold 且是 base64 data URI，后续内容不再缓冲，
+    而是直接流式计算哈希并解码，JSON 中只留下一个占位符。close() 时把解码结果登记到 media_store，
+    并用对应的 MediaData 替换占位符，之后 process_messages_for_gemini 直接使用，不再解析。
+    这样同一份媒体在内存中只有解码后的一份，而不是原始请求体、解析后的字符串、解码结果多份同时存在。
+
+    请求体总大小超过 max_body_bytes、单个字符串超过 max_part_bytes 时立即抛出 RequestBodyError (413)。
+    """
+
+    def __init__(self, media_store, max_body_bytes, max_part_bytes, stream_threshold=64 * 1024):
+        self.media_store = media_store
+        self.max_body_bytes = max_body_bytes
+        self.max_part_bytes = max_part_bytes
+        self.stream_threshold = stream_threshold
+
+        self._buffer = bytearray()
+        self._size = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._string_checked = False
+        self._media = None
+        self._parts = []
+        self._placeholder = f"\x00media:{secrets.token_hex(8)}:"
+
+    def feed(self, chunk):
+        self._size += len(chunk)
+        if self._size > self.max_body_bytes:
+            raise RequestBodyError(f"请求体超过 {self.max_body_bytes} 字节上限", 413)
+
+        view = memoryview(chunk)
+        pos, end = 0, len(chunk)
+        while pos < end:
+            if self._media is not None:
+                pos = self._feed_media(chunk, view, pos)
+            elif not self._in_string:
+                quote = chunk.find(b'"', pos)
+                if quote < 0:
+                    self._buffer += view[pos:]
+                    break
+                self._buffer += view[pos:quote + 1]
+                self._in_string = True
+                self._string_start = len(self._buffer)
+                self._string_checked = False
+                pos = quote + 1
+            elif self._escape:
+                self._buffer.append(chunk[pos])
+                self._escape = False
+                pos += 1
+            else:
+                match = _STRING_SPECIAL.search(chunk, pos)
+                stop = match.start() if match else end
+                self._buffer += view[pos:stop]
+                pos = stop
+                self._check_string()
+                if match is None or self._media is not None:
+                    continue
+                self._buffer.append(chunk[pos])
+                if chunk[pos] == ord('"'):
+                    self._in_string = False
+                else:
+                    self._escape = True
+                pos += 1
+
+    def _check_string(self):
+        """检查当前字符串的长度；足够长且是 base64 data URI 时切换为流式解码"""
+        length = len(self._buffer) - self._string_start
+        if length > self.max_part_bytes:
+            raise RequestBodyError(f"单个消息内容超过 {self.max_part_bytes} 字节上限", 413)
+        if self._string_checked or length < self.stream_threshold:
+            return
+
+        head = bytes(self._buffer[self._string_start:self._string_start + MAX_HEADER_LENGTH])
+        comma = head.find(b',')
+        if comma < 0 and len(head) < MAX_HEADER_LENGTH and (head.startswith(b'data:') or b'data:'.startswith(head)):
+            # 头部还没有接收完整，等待更多数据再判断
+            return
+        self._string_checked = True
+        if not head.startswith(b'data:') or comma < 0:
+            return
+        try:
+            mime_type, is_base64 = parse_data_uri_header(json.loads(b'"' + head[5:comma] + b'"'))
+        except ValueError:
+            return
+        if not is_base64:
+            return
+
+        # 已缓冲的部分一般不含未完成的转义序列，可以直接按 JSON 字符串反转义；否则稍后再试
+        try:
+            payload = json.loads(b'"' + self._buffer[self._string_start + comma + 1:] + b'"').encode('utf-8')
+        except ValueError:
+            self._string_checked = False
+            return
+        del self._buffer[self._string_start - 1:]
+        self._media = _MediaPart(mime_type)
+        self._media.write(payload)
+
+    def _feed_media(self, chunk, view, pos):
+        media = self._media
+        if self._escape:
+            self._escape = False
+            escaped = _JSON_ESCAPES.get(chunk[pos])
+            if escaped is None:
+                raise RequestBodyError("data URI 中包含不支持的转义序列")
+            media.write(escaped)
+            return pos + 1
+
+        match = _STRING_SPECIAL.search(chunk, pos)
+        stop = match.start() if match else len(chunk)
+        if stop > pos:
+            media.write(view[pos:stop])
+        if media.size > self.max_part_bytes:
+            raise RequestBodyError(f"单个消息内容超过 {self.max_part_bytes} 字节上限", 413)
+        if match is None:
+            return stop
+
+        if chunk[stop] == ord('"'):
+            self._buffer += json.dumps(f"{self._placeholder}{len(self._parts)}").encode('utf-8')
+            self._parts.append(media.finish())
+            self._media = None
+            self._in_string = False
+        else:
+            self._escape = True
+        return stop + 1
+
+    def _replace_placeholders(self, value, media):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                value[key] = self._replace_placeholders(item, media)
+        elif isinstance(value, list):
+            for index, item in enumerate(value):
+                value[index] = self._replace_placeholders(item, media)
+        elif isinstance(value, str) and value.startswith(self._placeholder):
+            return media[int(value[len(self._placeholder):])]
+        return value
+
+    def close(self):
+        """结束解析，返回请求 JSON；媒体字段的值为 MediaData（可能触发图片预处理，耗时较长）"""
+        if self._in_string or self._media is not None:
+            raise RequestBodyError("请求体不是完整的 JSON")
+        try:
+            data = json.loads(self._buffer)
+        except ValueError as e:
+            raise RequestBodyError(f"请求体不是合法的 JSON: {e}")
+        self._buffer = bytearray()
+
+        media = []
+        while self._parts:
+            mime_type, digest, decoded = self._parts.pop(0)
+            media.append(self.media_store.store(mime_type, digest, decoded))
+        return self._replace_placeholders(data, media)
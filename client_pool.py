@@ -0,0 +1,172 @@
+import functools
+import json
+import threading
+from collections import OrderedDict
+
+DEFAULT_ENDPOINT = "generativelanguage.googleapis.com"
+
+# 不限制消息大小，与 SDK 默认创建的 gRPC 通道保持一致（多模态请求可能很大）
+# use_local_subchannel_pool: 每个 key 独占自己的连接，不与其他 key 的通道共享
+CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    ("grpc.use_local_subchannel_pool", 1),
+]
+
+
+class _ApiKeyMetadata:
+    """grpc.AuthMetadataPlugin 接口：每次调用附加 x-goog-api-key 元数据"""
+
+    def __init__(self, api_key):
+        self._metadata = (("x-goog-api-key", api_key),)
+
+    def __call__(self, context, callback):
+        callback(self._metadata, None)
+
+
+@functools.lru_cache(maxsize=None)
+def _api_key_interceptor_classes(use_async):
+    """
+    明文通道不能携带调用凭据（gRPC 只在加密或本机连接上发送），改用拦截器给每次调用附加
+    x-goog-api-key 元数据。生成内容只用到一元调用和服务端流式调用，只拦截这两种；
+    grpc.aio 按拦截器实现的第一个接口归类，所以两种调用各用一个类。
+    """
+    import grpc
+
+    module = grpc.aio if use_async else grpc
+
+    class ApiKeyInterceptor:
+        def __init__(self, api_key):
+            self._metadata = (("x-goog-api-key", api_key),)
+
+        def _details(self, client_call_details):
+            # 同步和异步版本的 ClientCallDetails 都是 namedtuple
+            metadata = tuple(client_call_details.metadata or ()) + self._metadata
+            return client_call_details._replace(metadata=metadata)
+
+    class UnaryUnaryInterceptor(ApiKeyInterceptor, module.UnaryUnaryClientInterceptor):
+        def intercept_unary_unary(self, continuation, client_call_details, request):
+            return continuation(self._details(client_call_details), request)
+
+    class UnaryStreamInterceptor(ApiKeyInterceptor, module.UnaryStreamClientInterceptor):
+        def intercept_unary_stream(self, continuation, client_call_details, request):
+            return continuation(self._details(client_call_details), request)
+
+    return UnaryUnaryInterceptor, UnaryStreamInterceptor
+
+
+class UpstreamClientPool:
+    """
+    每个 API key 一组长期存活的上游客户端（各自持有独立的长连接），
+    以及按 (key, 模型, generation_config) 缓存的 GenerativeModel 对象。
+    请求之间不再调用 genai.configure 修改进程级的全局状态。
+
+    endpoint 以 http:// 开头时使用明文连接（API key 由拦截器附加），便于对接本地或容器内的桩服务做测试。
+    transport 只影响同步客户端 ("grpc" 或 "rest")，异步客户端始终使用 grpc_asyncio。
+    SDK（google.generativeai、grpc）在第一次创建客户端时才导入，不拖慢启动。
+    """
+
+    def __init__(self, endpoint=None, transport=None, max_models=1024):
+        endpoint = endpoint or DEFAULT_ENDPOINT
+        self.insecure = endpoint.startswith("http://")
+        self.endpoint = endpoint
+        self.target = endpoint.split("://", 1)[-1]
+        if ":" not in self.target:
+            self.target += ":443"
+        self.transport = transport or "grpc"
+        self.max_models = max_models
+        self._client_info = None
+
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._models = OrderedDict()
+
+    @property
+    def client_info(self):
+        if self._client_info is None:
+            import google.generativeai as genai
+            from google.generativeai import client as genai_client
+            from google.api_core import gapic_v1
+            self._client_info = gapic_v1.client_info.ClientInfo(
+                user_agent=f"{genai_client.USER_AGENT}/{genai.__version__}")
+        return self._client_info
+
+    def _channel_credentials(self, api_key):
+        import grpc
+
+        return grpc.composite_channel_credentials(grpc.ssl_channel_credentials(),
+                                                  grpc.metadata_call_credentials(_ApiKeyMetadata(api_key)))
+
+    def _create_channel(self, api_key, use_async):
+        import grpc
+
+        if self.insecure:
+            interceptors = [cls(api_key) for cls in _api_key_interceptor_classes(use_async)]
+            if use_async:
+                return grpc.aio.insecure_channel(self.target, options=CHANNEL_OPTIONS, interceptors=interceptors)
+            return grpc.intercept_channel(grpc.insecure_channel(self.target, options=CHANNEL_OPTIONS), *interceptors)
+
+        creds = self._channel_credentials(api_key)
+        if use_async:
+            return grpc.aio.secure_channel(self.target, creds, options=CHANNEL_OPTIONS)
+        return grpc.secure_channel(self.target, creds, options=CHANNEL_OPTIONS)
+
+    def _create_client(self, api_key, service, use_async):
+        import google.ai.generativelanguage as glm
+
+        client_cls = getattr(glm, service.title() + "ServiceClient")
+
+        if self.transport == "rest" and not use_async:
+            return client_cls(
+                client_options={"api_key": api_key, "api_endpoint": self.endpoint},
+                transport="rest",
+                client_info=self.client_info,
+            )
+
+        channel = self._create_channel(api_key, use_async)
+        if use_async:
+            transport = client_cls.get_transport_class("grpc_asyncio")(channel=channel)
+            return getattr(glm, service.title() + "ServiceAsyncClient")(transport=transport, client_info=self.client_info)
+
+        transport = client_cls.get_transport_class("grpc")(channel=channel)
+        return client_cls(transport=transport, client_info=self.client_info)
+
+    def get_client(self, api_key, service="generative", use_async=False):
+        """返回该 key 的长连接客户端，首次使用时创建；异步客户端须在事件循环中获取"""
+        cache_key = (api_key, service, use_async)
+        client = self._clients.get(cache_key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(cache_key)
+                if client is None:
+                    client = self._create_client(api_key, service, use_async)
+                    self._clients[cache_key] = client
+        return client
+
+    def get_model(self, api_key, model_name, generation_config, safety_settings, use_async=False, cached_content=None):
+        cache_key = (api_key, model_name, json.dumps(generation_config, sort_keys=True), cached_content)
+        with self._lock:
+            gen_model = self._models.get(cache_key)
+            if gen_model is not None:
+                self._models.move_to_end(cache_key)
+
+        if gen_model is None:
+            import google.generativeai as genai
+
+            gen_model = genai.GenerativeModel(
+                model_name=model_name,
+                generation_config=generation_config,
+                safety_settings=safety_settings
+            )
+            gen_model._client = self.get_client(api_key)
+            if cached_content:
+                # 与 GenerativeModel.from_cached_content 相同，只是不额外请求一次 CachedContent.get
+                gen_model._cached_content = cached_content
+            with self._lock:
+                gen_model = self._models.setdefault(cache_key, gen_model)
+                while len(self._models) > self.max_models:
+                    self._models.popitem(last=False)
+
+        if use_async and gen_model._async_client is None:
+            gen_model._async_client = self.get_client(api_key, use_async=True)
+        return gen_model
@@ -0,0 +1,248 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from media_store import json_default
+
+
+class PrefixPlan:
+    """一次请求的前缀信息：前 i+1 条历史的链式哈希 hashes[i] 与累计字节数 sizes[i]"""
+
+    def __init__(self, model, history, hashes, sizes):
+        self.model = model
+        self.history = history
+        self.hashes = hashes
+        self.sizes = sizes
+
+
+class ContextHandle:
+    def __init__(self, api_key, model, prefix_hash, turns, size, name, expires_at):
+        self.api_key = api_key
+        self.model = model
+        self.prefix_hash = prefix_hash
+        self.turns = turns
+        self.size = size
+        self.name = name
+        self.expires_at = expires_at
+        self.refs = 0
+
+
+class ContextCache:
+    """
+    长前缀自动上下文缓存。
+
+    每个请求的历史消息按轮次做链式哈希，统计每个前缀出现的次数；某个前缀的大小和复用次数都超过阈值后，
+    为 (key, 模型) 创建一个 Gemini cachedContents 条目，之后的请求只发送前缀之后的新消息。
+    缓存条目按 key 区分（cachedContents 归属于 key 所在的项目），带引用计数与过期时间：
+    临近过期的条目不再使用，超出数量上限时只淘汰没有在途请求引用的条目。
+    所有上游调用都经由 UpstreamClientPool，因此可以对接本地桩服务测试。
+    """
+
+    # 距离过期不足该秒数的条目不再使用，避免请求途中缓存失效
+    EXPIRY_MARGIN = 30
+
+    def __init__(self, client_pool, enabled=False, min_bytes=65536, min_reuse=2, ttl=600, max_handles=256, max_prefixes=10000):
+        self.client_pool = client_pool
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+        self.min_reuse = min_reuse
+        self.ttl = ttl
+        self.max_handles = max_handles
+        self.max_prefixes = max_prefixes
+
+        self._lock = threading.Lock()
+        self._prefix_counts = OrderedDict()
+        self._handles = OrderedDict()
+        self._creating = set()
+        self._failed = {}
+        self._cleanup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="context-cache")
+
+    def plan(self, model, history):
+        """计算历史消息的前缀哈希并记录一次出现；历史总量不到阈值时返回 None"""
+        if not self.enabled or not history:
+            return None
+
+        hashes, sizes = [], []
+        digest = hashlib.sha256(model.encode("utf-8"))
+        size = 0
+        for turn in history:
+            data = json.dumps(turn, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=json_default).encode("utf-8")
+            digest.update(data)
+            size += len(data)
+            hashes.append(digest.copy().hexdigest())
+            sizes.append(size)
+
+        if size < self.min_bytes:
+            return None
+
+        with self._lock:
+            for prefix_hash, prefix_size in zip(hashes, sizes):
+                if prefix_size < self.min_bytes:
+                    continue
+                self._prefix_counts[prefix_hash] = self._prefix_counts.get(prefix_hash, 0) + 1
+                self._prefix_counts.move_to_end(prefix_hash)
+            while len(self._prefix_counts) > self.max_prefixes:
+                self._prefix_counts.popitem(last=False)
+
+        return PrefixPlan(model, history, hashes, sizes)
+
+    def _live(self, handle, now):
+        return handle.expires_at - self.EXPIRY_MARGIN > now
+
+    def preferred_keys(self, plan):
+        """持有该请求可用前缀缓存的 key，前缀越长越靠前"""
+        if plan is None:
+            return []
+        now = time.time()
+        with self._lock:
+            handles = [handle for handle in self._handles.values()
+                       if handle.model == plan.model and self._live(handle, now)
+                       and handle.turns <= len(plan.hashes) and plan.hashes[handle.turns - 1] == handle.prefix_hash]
+        handles.sort(key=lambda handle: handle.turns, reverse=True)
+        return [handle.api_key for handle in handles]
+
+    def _find(self, api_key, plan, now):
+        """在已有条目中找最长的可用前缀"""
+        for turns in range(len(plan.hashes), 0, -1):
+            handle = self._handles.get((api_key, plan.model, plan.hashes[turns - 1]))
+            if handle is not None and self._live(handle, now):
+                return handle
+        return None
+
+    def _candidate(self, api_key, plan, cached_size, now):
+        """
+        选出值得新建缓存的最长前缀：出现次数达到阈值，且比已缓存部分多出至少 min_bytes。
+        返回前缀轮数，没有合适的返回 0。
+        """
+        for turns in range(len(plan.hashes), 0, -1):
+            prefix_hash = plan.hashes[turns - 1]
+            if plan.sizes[turns - 1] - cached_size < self.min_bytes:
+                return 0
+            if self._prefix_counts.get(prefix_hash, 0) < self.min_reuse:
+                continue
+            cache_id = (api_key, plan.model, prefix_hash)
+            if cache_id in self._creating or self._failed.get(cache_id, 0) > now:
+                continue
+            return turns
+        return 0
+
+    def _begin(self, api_key, plan):
+        """返回 (可直接使用的条目, 需要新建的前缀轮数)"""
+        now = time.time()
+        with self._lock:
+            handle = self._find(api_key, plan, now)
+            turns = self._candidate(api_key, plan, handle.size if handle else 0, now)
+            if turns:
+                self._creating.add((api_key, plan.model, plan.hashes[turns - 1]))
+            elif handle is not None:
+                handle.refs += 1
+                self._handles.move_to_end((api_key, plan.model, handle.prefix_hash))
+            return handle, turns
+
+    def _create_request(self, plan, turns):
+        import google.generativeai.protos as protos
+        from google.generativeai.types import content_types
+
+        model_name = plan.model if plan.model.startswith("models/") else f"models/{plan.model}"
+        return protos.CachedContent(
+            model=model_name,
+            contents=content_types.to_contents(plan.history[:turns]),
+            ttl={"seconds": int(self.ttl)},
+        )
+
+    def _finish(self, api_key, plan, turns, name, fallback):
+        """登记新建结果；创建失败时该前缀在 ttl 内不再尝试，退回到 fallback (已有的较短前缀)"""
+        prefix_hash = plan.hashes[turns - 1]
+        cache_id = (api_key, plan.model, prefix_hash)
+        now = time.time()
+        evicted = []
+        with self._lock:
+            self._creating.discard(cache_id)
+            if name is None:
+                self._failed[cache_id] = now + self.ttl
+                if fallback is not None and self._live(fallback, now):
+                    fallback.refs += 1
+                    return fallback, evicted
+                return None, evicted
+
+            handle = ContextHandle(api_key, plan.model, prefix_hash, turns, plan.sizes[turns - 1], name, now + self.ttl)
+            handle.refs += 1
+            self._handles[cache_id] = handle
+
+            for old_id, old in list(self._handles.items()):
+                if old.refs == 0 and not self._live(old, now):
+                    del self._handles[old_id]
+            for old_id, old in list(self._handles.items()):
+                if len(self._handles) <= self.max_handles:
+                    break
+                if old.refs == 0:
+                    del self._handles[old_id]
+                    evicted.append(old)
+            self._failed = {key: until for key, until in self._failed.items() if until > now}
+        return handle, evicted
+
+    def _delete_evicted(self, evicted):
+        """淘汰的条目尽早在上游删除，避免继续产生存储费用（失败无所谓，到期后上游也会自动删除）"""
+        for handle in evicted:
+            def delete(handle=handle):
+                try:
+                    self.client_pool.get_client(handle.api_key, "cache").delete_cached_content(name=handle.name)
+                except Exception:
+                    pass
+            self._cleanup_executor.submit(delete)
+
+    def acquire(self, api_key, plan, logger=None):
+        """同步版本：返回可用的 ContextHandle（调用方用完后须 release），没有则返回 None"""
+        if plan is None:
+            return None
+        handle, turns = self._begin(api_key, plan)
+        if not turns:
+            return handle
+
+        name = None
+        try:
+            client = self.client_pool.get_client(api_key, "cache")
+            name = client.create_cached_content(cached_content=self._create_request(plan, turns)).name
+            if logger:
+                logger.info(f"{api_key[:11]} → 已创建上下文缓存，前缀 {turns} 条消息 / {plan.sizes[turns - 1]} 字节")
+        except Exception as e:
+            if logger:
+                logger.warning(f"{api_key[:11]} → 创建上下文缓存失败，本次发送完整历史: {e}")
+        handle, evicted = self._finish(api_key, plan, turns, name, handle)
+        self._delete_evicted(evicted)
+        return handle
+
+    async def acquire_async(self, api_key, plan, logger=None):
+        """异步版本，语义同 acquire"""
+        if plan is None:
+            return None
+        handle, turns = self._begin(api_key, plan)
+        if not turns:
+            return handle
+
+        name = None
+        try:
+            client = self.client_pool.get_client(api_key, "cache", use_async=True)
+            name = (await client.create_cached_content(cached_content=self._create_request(plan, turns))).name
+            if logger:
+                logger.info(f"{api_key[:11]} → 已创建上下文缓存，前缀 {turns} 条消息 / {plan.sizes[turns - 1]} 字节")
+        except Exception as e:
+            if logger:
+                logger.warning(f"{api_key[:11]} → 创建上下文缓存失败，本次发送完整历史: {e}")
+        handle, evicted = self._finish(api_key, plan, turns, name, handle)
+        self._delete_evicted(evicted)
+        return handle
+
+    def release(self, handle):
+        if handle is None:
+            return
+        with self._lock:
+            handle.refs -= 1
+
+    def invalidate(self, handle):
+        """上游报告缓存不存在/已过期时丢弃该条目"""
+        with self._lock:
+            self._handles.pop((handle.api_key, handle.model, handle.prefix_hash), None)
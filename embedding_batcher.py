@@ -0,0 +1,88 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Gemini BatchEmbedContents 单次最多 100 条
+MAX_BATCH_SIZE = 100
+
+
+class EmbeddingError(Exception):
+    """一批 embedding 最终失败时，每个调用方收到的错误响应"""
+
+    def __init__(self, data, status, headers=None):
+        super().__init__(data)
+        self.data = data
+        self.status = status
+        self.headers = headers or {}
+
+
+class EmbeddingBatcher:
+    """
+    把同一时间窗口（window 秒）内到达的 embedding 输入按 (模型, 输出维度) 合并成一次
+    BatchEmbedContents 调用，结果按顺序拆回给各个调用方。一批占用一次 key 的请求额度，
+    而不是每条输入一次；攒满 max_batch 条时立即发送，不等窗口结束。
+
+    embed_batch(group, texts) 在线程池中执行，返回与 texts 一一对应的向量，失败时抛出异常（通常为 EmbeddingError）。
+    submit() 返回 concurrent.futures.Future，同步调用方直接等待，异步调用方用 asyncio.wrap_future 等待。
+    """
+
+    def __init__(self, embed_batch, window=0.01, max_batch=MAX_BATCH_SIZE, max_workers=16):
+        self.embed_batch = embed_batch
+        self.window = window
+        self.max_batch = min(max_batch, MAX_BATCH_SIZE)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embedding")
+        self._cond = threading.Condition()
+        # group → (最早一条的发送截止时间, [(文本, Future)])
+        self._pending = {}
+        self._thread = None
+
+    def submit(self, group, text):
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+            deadline, items = self._pending.setdefault(group, (time.monotonic() + self.window, []))
+            items.append((text, future))
+            if len(items) >= self.max_batch or len(items) == 1:
+                self._cond.notify()
+        return future
+
+    def _take_due(self):
+        """取出已攒满或已到截止时间的批次，返回 (批次列表, 下一次需要醒来的等待秒数)"""
+        now = time.monotonic()
+        batches, next_deadline = [], None
+        for group, (deadline, items) in list(self._pending.items()):
+            while len(items) >= self.max_batch:
+                batches.append((group, items[:self.max_batch]))
+                del items[:self.max_batch]
+            if items and deadline <= now:
+                batches.append((group, items))
+                items = []
+            if items:
+                next_deadline = deadline if next_deadline is None else min(next_deadline, deadline)
+            else:
+                del self._pending[group]
+        return batches, None if next_deadline is None else max(next_deadline - now, 0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batches, timeout = self._take_due()
+                while not batches:
+                    self._cond.wait(timeout)
+                    batches, timeout = self._take_due()
+            for group, items in batches:
+                self._executor.submit(self._execute, group, items)
+
+    def _execute(self, group, items):
+        try:
+            vectors = self.embed_batch(group, [text for text, _ in items])
+            if len(vectors) != len(items):
+                raise ValueError(f"上游返回了 {len(vectors)} 个向量，应为 {len(items)} 个")
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+        for (_, future), vector in zip(items, vectors):
+            future.set_result(vector)
@@ -1,13 +1,11 @@
 from io import BytesIO
 import base64
-from PIL import Image
 from flask import jsonify
 import logging
 import json
 import re
 import os
-import requests
-import google.generativeai as genai
+from media_store import MediaData, MediaStore
 logger = logging.getLogger(__name__)
 
 
@@ -15,26 +13,94 @@ request_counts = {}
 
 password = str(os.environ.get('password', 'your_password'))
 
-def authenticate_request(request):
-    auth_header = request.headers.get('Authorization')
-
+def check_authorization(auth_header, secret=None):
+    """校验 Authorization 请求头（secret 为空时与 password 比较），返回 (是否通过, 错误信息 dict, 状态码)，不依赖 Flask"""
     if not auth_header:
-        return False, jsonify({'error': '缺少Authorization请求头'}), 401
+        return False, {'error': '缺少Authorization请求头'}, 401
 
     try:
         auth_type, pass_word = auth_header.split(' ', 1)
     except ValueError:
-        return False, jsonify({'error': 'Authorization请求头格式错误'}), 401
+        return False, {'error': 'Authorization请求头格式错误'}, 401
 
     if auth_type.lower() != 'bearer':
-        return False, jsonify({'error': 'Authorization类型必须为Bearer'}), 401
+        return False, {'error': 'Authorization类型必须为Bearer'}, 401
 
-    if pass_word != password:
-        return False, jsonify({'error': '未授权'}), 401
+    if pass_word != (secret or password):
+        return False, {'error': '未授权'}, 401
 
     return True, None, None
 
-def process_messages_for_gemini(messages):
+def authenticate_request(request):
+    is_authenticated, auth_error, status_code = check_authorization(request.headers.get('Authorization'))
+    if not is_authenticated:
+        return False, jsonify(auth_error), status_code
+
+    return True, None, None
+
+def normalize_image(data, max_pixels, image_format='WEBP', quality=85):
+    """
+    缩放图片到不超过 max_pixels 像素，并去掉 EXIF 等元数据后重新编码。
+    在进程池中执行；返回 (mime_type, 数据)，处理后没有变小（或无法处理）时返回 None。
+    """
+    from PIL import Image, ImageOps
+
+    image = Image.open(BytesIO(data))
+    if getattr(image, 'n_frames', 1) > 1:
+        return None
+
+    width, height = image.size
+    scale = min(1.0, (max_pixels / float(width * height)) ** 0.5) if max_pixels else 1.0
+    # JPEG 可以在解码时直接按比例缩小，省掉大部分解码开销
+    image.draft('RGB', (max(1, int(width * scale)), max(1, int(height * scale))))
+    image = ImageOps.exif_transpose(image)
+
+    # 按 EXIF 方向旋转后再计算目标尺寸
+    width, height = image.size
+    scale = min(1.0, (max_pixels / float(width * height)) ** 0.5) if max_pixels else 1.0
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+    if image.size != target:
+        image = image.resize(target, Image.LANCZOS)
+
+    if image_format == 'JPEG':
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+    output = BytesIO()
+    image.save(output, format=image_format, quality=quality)
+    if output.tell() >= len(data):
+        return None
+    return f"image/{image_format.lower()}", output.getvalue()
+
+def _data_uri_part(media_store, uri, kind, errors, stats=None):
+    """
+    把 data URI 转成 inline_data；相同内容复用 media_store 中已解码的数据。
+    uri 也可以是请求体流式解析时已经解码好的 MediaData。
+    """
+    if isinstance(uri, MediaData):
+        mime_type, data = uri.mime_type, uri
+    else:
+        try:
+            mime_type, data = media_store.parse_data_uri(uri)
+        except ValueError:
+            errors.append(f"Invalid data URI for {kind}: {uri[:64]}...")
+            return None
+    if stats is not None:
+        stats['media_count'] = stats.get('media_count', 0) + 1
+        stats['bytes_in'] = stats.get('bytes_in', 0) + data.original_size
+        stats['bytes_out'] = stats.get('bytes_out', 0) + len(data)
+    return {
+        "inline_data": {
+            "mime_type": mime_type,
+            "data": data
+        }
+    }
+
+def process_messages_for_gemini(messages, media_store=None, stats=None):
+    """stats 不为 None 时写入本次请求的媒体统计：media_count、bytes_in（解码后原始大小）、bytes_out（实际发送大小）"""
+    if media_store is None:
+        media_store = MediaStore(max_bytes=0)
     gemini_history = []
     errors = []
     for message in messages:
@@ -57,36 +123,21 @@ def process_messages_for_gemini(messages):
                     parts.append({"text": item.get('text')})  
                 elif item.get('type') == 'image_url':
                     image_data = item.get('image_url', {}).get('url', '')
-                    if image_data.startswith('data:image/'):
-
-                        try:
-                            mime_type, base64_data = image_data.split(';')[0].split(':')[1], image_data.split(',')[1]
-                            parts.append({
-                                "inline_data": {
-                                    "mime_type": mime_type,
-                                    "data": base64_data
-                                }
-                            })
-                        except (IndexError, ValueError):
-                            errors.append(f"Invalid data URI for image: {image_data}")
+                    if isinstance(image_data, MediaData) and image_data.mime_type.startswith('image/') or \
+                            isinstance(image_data, str) and image_data.startswith('data:image/'):
+                        part = _data_uri_part(media_store, image_data, 'image', errors, stats)
+                        if part:
+                            parts.append(part)
                     else:
-                        errors.append(f"Invalid image URL format for item: {item}")
+                        errors.append(f"Invalid image URL format for item: {str(item)[:128]}")
                 elif item.get('type') == 'file_url':
                     file_data = item.get('file_url', {}).get('url', '')
-                    if file_data.startswith('data:'):
-
-                        try:
-                            mime_type, base64_data = file_data.split(';')[0].split(':')[1], file_data.split(',')[1]
-                            parts.append({
-                                "inline_data": {
-                                    "mime_type": mime_type,
-                                    "data": base64_data
-                                }
-                            })
-                        except (IndexError, ValueError):
-                            errors.append(f"Invalid data URI for file: {file_data}")
+                    if isinstance(file_data, MediaData) or isinstance(file_data, str) and file_data.startswith('data:'):
+                        part = _data_uri_part(media_store, file_data, 'file', errors, stats)
+                        if part:
+                            parts.append(part)
                     else:
-                        errors.append(f"Invalid file URL format for item: {item}")
+                        errors.append(f"Invalid file URL format for item: {str(item)[:128]}")
 
             if parts: 
                 if role in ['user', 'system']:
@@ -103,6 +154,6 @@ def process_messages_for_gemini(messages):
         user_message = {"role": "user", "parts": [""]}
 
     if errors:
-        return gemini_history, user_message, (jsonify({'error': errors}), 400)
+        return gemini_history, user_message, {'error': errors}
     else:
         return gemini_history, user_message, None
\ No newline at end of file
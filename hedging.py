@@ -0,0 +1,126 @@
+import asyncio
+import contextvars
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+class LatencyTracker:
+    """按模型记录最近若干次成功的非流式请求耗时，用于计算对冲延迟的分位数"""
+
+    def __init__(self, max_samples=200):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, model, seconds):
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=self.max_samples)
+            samples.append(seconds)
+
+    def percentile(self, model, p, min_samples=20):
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * p / 100))
+        return samples[index]
+
+
+class HedgePolicy:
+    """
+    对冲请求：非流式请求在 delay 秒内没有返回时，用另一个 key 再发一份相同的请求，先成功的胜出。
+    delay 取该模型近期耗时的 percentile 分位数（样本不足时用 default_delay），不低于 min_delay。
+    对冲请求同样通过 key 调度器取 key，计入每个 key 的限额；另有全局预算 budget 限制对冲比例：
+    每个开启对冲的请求由 start() 存入 budget.ratio 个令牌，每次对冲消耗 1 个。
+    """
+
+    def __init__(self, models, percentile, min_delay, default_delay, budget, tracker=None):
+        self.models = set(models)
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self.budget = budget
+        self.tracker = tracker or LatencyTracker()
+
+    def enabled_for(self, model, request_data):
+        """请求体中的 hedge 字段优先，否则看模型是否在 HedgeModels 中"""
+        hedge = request_data.get('hedge')
+        if hedge is not None:
+            return bool(hedge)
+        return model in self.models
+
+    def start(self, model, request_data):
+        """请求开始时调用，返回本次请求是否开启对冲；开启时向预算存入令牌"""
+        enabled = self.enabled_for(model, request_data)
+        if enabled:
+            self.budget.record_request()
+        return enabled
+
+    def delay(self, model):
+        delay = self.tracker.percentile(model, self.percentile)
+        if delay is None:
+            delay = self.default_delay
+        return max(delay, self.min_delay)
+
+    def allow_hedge(self):
+        return self.budget.try_spend()
+
+
+def hedged_call(executor, do_request, primary_key, acquire_hedge_key, delay):
+    """
+    同步版本：do_request(key) 返回 (结果码, 响应, 退避秒数)，结果码为 1 表示成功。
+    落败的一方若已开始执行无法中断，只会被丢弃结果（同步 SDK 调用不支持取消）。
+    """
+    # 在调用方的 contextvars 上下文中执行，日志仍能带上请求 ID 等字段
+    first = executor.submit(contextvars.copy_context().run, do_request, primary_key)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+
+    hedge_key = acquire_hedge_key()
+    if hedge_key is None:
+        return first.result()
+
+    pending = {first, executor.submit(contextvars.copy_context().run, do_request, hedge_key)}
+    result = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            result = future.result()
+            if result[0] == 1:
+                for loser in pending:
+                    loser.cancel()
+                return result
+    return result
+
+
+async def async_hedged_call(do_request, primary_key, acquire_hedge_key, delay):
+    """异步版本：先成功的一方胜出，另一方的上游调用会被取消"""
+    tasks = [asyncio.ensure_future(do_request(primary_key))]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return tasks[0].result()
+
+        # 选 key 可能访问共享状态存储，放到线程池中执行，不阻塞事件循环
+        hedge_key = await asyncio.to_thread(acquire_hedge_key)
+        if hedge_key is None:
+            return await tasks[0]
+
+        tasks.append(asyncio.ensure_future(do_request(hedge_key)))
+        pending = set(tasks)
+        result = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                if result[0] == 1:
+                    return result
+        return result
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from state_backend import key_id
+
+logger = logging.getLogger(__name__)
+
+# 探测时返回这些错误说明 key 本身已失效（被删除、过期或被封禁），而不是请求或上游的问题
+RETIRE_ERRORS = ("PermissionDenied", "InvalidArgument")
+
+
+class KeyHealth:
+    """
+    按错误类型自适应的 key 冷却和后台健康探测。
+
+    同一个 key 连续出现同类错误时，冷却时间从该类错误的 cooldown 开始每次翻倍，不超过 max_cooldown；
+    上游调用成功一次即清零。因 key 本身的问题（策略中 probe 为 true 的错误类型）被禁用的 key，
+    由后台线程每 probe_interval 秒用 probe(key)（ListModels 等不消耗生成配额的调用）探测一次：
+    成功则提前恢复调度；仍返回 RETIRE_ERRORS 时标记为已失效，冷却 retire_cooldown 秒，
+    之后只在冷却快结束时再探测一次，不再用用户请求去试。
+
+    设置了 path 时，各 key 的状态（只保存 key 的摘要）写入该 JSON 文件，重启后恢复。
+    """
+
+    def __init__(self, scheduler, probe, classify, probe_interval=15, retire_cooldown=3600, path=None, max_workers=8):
+        self.scheduler = scheduler
+        self.probe = probe
+        self.classify = classify
+        self.probe_interval = probe_interval
+        self.retire_cooldown = retire_cooldown
+        self.path = path
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        # key → {error, strikes, until, probe, retired, next_probe}，只记录出过错的 key
+        self._states = {}
+        self._dirty = False
+        self._thread = None
+
+    def record_failure(self, key, error_name, rule):
+        """按策略计算并返回这次的冷却秒数（0 表示不禁用），由调用方交给调度器"""
+        base = rule.get("cooldown") or 0
+        if not base:
+            return 0
+        now = time.time()
+        with self._lock:
+            state = self._states.get(key)
+            strikes = state["strikes"] + 1 if state and state["error"] == error_name else 1
+            duration = min(base * 2 ** (strikes - 1), max(base, rule.get("max_cooldown") or base))
+            self._states[key] = {
+                "error": error_name,
+                "strikes": strikes,
+                "until": now + duration,
+                "probe": bool(rule.get("probe")),
+                "retired": False,
+                "next_probe": now + min(self.probe_interval, duration / 2),
+            }
+            self._dirty = True
+        return duration
+
+    def record_success(self, key):
+        if key not in self._states:
+            return
+        with self._lock:
+            if self._states.pop(key, None) is not None:
+                self._dirty = True
+
+    def retired_count(self):
+        return sum(1 for state in list(self._states.values()) if state["retired"])
+
+    def restore(self, api_keys):
+        """从 path 恢复状态，仍在冷却中的 key 重新交给调度器冷却"""
+        if not self.path:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                saved = json.load(f).get("keys", {})
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("读取 key 状态失败，忽略: %s", e)
+            return
+
+        now = time.time()
+        restored = retired = 0
+        with self._lock:
+            for key in api_keys:
+                state = saved.get(key_id(key))
+                if not state:
+                    continue
+                remaining = state.get("until", 0) - now
+                if remaining <= 0 and not state.get("retired"):
+                    # 冷却已结束，只保留连续出错次数，下次出错时继续按倍数增长
+                    state["until"] = now
+                self._states[key] = dict(state, next_probe=now)
+                if remaining > 0:
+                    self.scheduler.cooldown(key, remaining)
+                    restored += 1
+                elif state.get("retired"):
+                    # 失效的 key 在重新探测出结果之前不参与调度
+                    self.scheduler.cooldown(key, self.probe_interval * 2)
+                retired += bool(state.get("retired"))
+        if restored or retired:
+            logger.info("已恢复 key 状态: %d 个仍在冷却，其中 %d 个已失效", restored, retired)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {key_id(key): {field: state[field] for field in ("error", "strikes", "until", "probe", "retired")}
+                    for key, state in self._states.items()}
+            self._dirty = False
+        # 多个 worker 可能同时保存：各自写入同目录下唯一的临时文件再原子替换，读到的总是某一次完整的写入
+        directory = os.path.dirname(os.path.abspath(self.path))
+        temp_path = None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(self.path)}.", suffix=".tmp", dir=directory)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"version": 1, "keys": data}, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning("保存 key 状态失败: %s", e)
+            if temp_path is not None:
+                try:
+                    os.unlink(temp_path)
+                except OSError:
+                    pass
+
+    def _due(self, now):
+        # 冷却已自然结束的 key 不必再探测，下次出错时再说
+        with self._lock:
+            return [key for key, state in self._states.items()
+                    if (state["retired"] or state["probe"] and state["until"] > now) and state["next_probe"] <= now]
+
+    def _probe(self, key):
+        try:
+            self.probe(key)
+        except Exception as e:
+            return key, self.classify(e) or type(e).__name__
+        return key, None
+
+    def _apply(self, key, error_name):
+        now = time.time()
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return None
+            if error_name is None:
+                del self._states[key]
+                self._dirty = True
+                result = "reinstated"
+            elif error_name in RETIRE_ERRORS:
+                state.update(retired=True, error=error_name, until=now + self.retire_cooldown,
+                             next_probe=now + max(self.retire_cooldown - self.probe_interval, self.probe_interval))
+                self._dirty = True
+                result = "retired"
+            else:
+                # 限流、上游故障等不说明 key 的好坏，保持原来的冷却，稍后再探测
+                state["next_probe"] = now + self.probe_interval
+                return "failed"
+
+        if result == "reinstated":
+            self.scheduler.reinstate(key)
+            logger.info("%s → 探测成功，提前恢复调度", key[:11])
+        else:
+            self.scheduler.cooldown(key, self.retire_cooldown)
+            logger.error("%s → 探测返回 %s，已失效，%d 秒内不再调度", key[:11], error_name, self.retire_cooldown)
+        return result
+
+    def probe_due(self, on_result=None):
+        """探测所有到期的 key，返回 {key: 结果}，结果为 reinstated / retired / failed"""
+        due = self._due(time.time())
+        if not due:
+            return {}
+        results = {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(due))) as executor:
+            for key, error_name in executor.map(self._probe, due):
+                result = self._apply(key, error_name)
+                if result is not None:
+                    results[key] = result
+                    if on_result:
+                        on_result(key, result)
+        return results
+
+    def start(self, on_result=None):
+        """启动后台探测线程，同时定期保存状态"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(on_result,),
+                                            name="key-health", daemon=True)
+            self._thread.start()
+
+    def _run(self, on_result):
+        while True:
+            time.sleep(min(self.probe_interval, 5))
+            try:
+                self.probe_due(on_result)
+            except Exception as e:
+                logger.warning("key 健康探测出错: %s", e)
+            self.save()
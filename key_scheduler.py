@@ -0,0 +1,210 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+
+class KeyScheduler:
+    """
+    线程安全的 API key 调度器。
+
+    每个 key 维护自己的滑动窗口（最近 window 秒内的请求时间）和冷却截止时间，
+    设置了 max_tokens 时还维护窗口内的 token 用量（对应官方的 TPM 限制），
+    所有 key 放在一个按“下次可用时间”排序的小顶堆里：
+    堆顶就是最早可用的 key，取用和归还都是 O(log n)。
+    可用时间相同的 key 按上次使用的先后排序，效果上仍是轮询。
+
+    堆中的条目带版本号，key 状态变化时直接压入新条目，旧条目在弹出时丢弃（惰性删除）。
+
+    取 key 时带上本次请求估计的 token 数：堆顶的 key 余额不够时跳过它继续找，
+    只会选中真正付得起这次请求的 key；单个请求超过整个额度时，等窗口清空后放行。
+    同时带上调用方生成的 ticket（每个请求唯一），拿到实际用量后按 ticket 修正对应的那条记录。
+    """
+
+    def __init__(self, api_keys, max_requests, window, max_tokens=0):
+        self.max_requests = max_requests
+        self.window = window
+        self.max_tokens = max_tokens
+
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._windows = {key: deque() for key in api_keys}
+        self._cooldown_until = {key: 0.0 for key in api_keys}
+        self._version = {key: 0 for key in api_keys}
+        self._token_entries = {key: deque() for key in api_keys}
+        self._token_used = {key: 0 for key in api_keys}
+        self._heap = [(0.0, next(self._seq), key, 0) for key in api_keys]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._windows)
+
+    def _ready_at(self, key, now):
+        window = self._windows[key]
+        while window and window[0] <= now - self.window:
+            window.popleft()
+
+        ready_at = self._cooldown_until[key]
+        if len(window) >= self.max_requests:
+            ready_at = max(ready_at, window[0] + self.window)
+        # 堆按“至少还有 1 个 token 余额”的时间排序，具体能否负担由 acquire 再判断
+        return max(ready_at, self._token_ready_at(key, 1, now), now)
+
+    def _token_ready_at(self, key, tokens, now):
+        """窗口内 token 余额足够 tokens 的最早时间"""
+        if not self.max_tokens:
+            return now
+        entries = self._token_entries[key]
+        while entries and entries[0][0] <= now - self.window:
+            self._token_used[key] -= entries.popleft()[1]
+
+        used = self._token_used[key]
+        excess = used + tokens - self.max_tokens
+        if excess <= 0 or used <= 0:
+            return now
+        freed = 0
+        for timestamp, amount, _ in entries:
+            freed += amount
+            if freed >= excess or freed >= used:
+                return timestamp + self.window
+        return now
+
+    def _take(self, key, tokens, now, ticket):
+        self._windows[key].append(now)
+        if self.max_tokens:
+            self._token_entries[key].append([now, tokens, ticket])
+            self._token_used[key] += tokens
+        self._push(key, now)
+
+    def _push(self, key, now):
+        self._version[key] += 1
+        heapq.heappush(self._heap, (self._ready_at(key, now), next(self._seq), key, self._version[key]))
+
+    def _peek(self, exclude, skipped):
+        """弹出失效条目和被排除的 key，返回堆顶有效条目（不弹出），没有则返回 None"""
+        while self._heap:
+            entry = self._heap[0]
+            ready_at, _, key, version = entry
+            if version != self._version[key]:
+                heapq.heappop(self._heap)
+            elif key in exclude:
+                skipped.append(heapq.heappop(self._heap))
+            else:
+                return entry
+        return None
+
+    def acquire(self, exclude=(), tokens=0, ticket=None):
+        """
+        取一个当前有余量（含 tokens 个 token 余额）的 key，并在其窗口中记一次请求（记录带上 ticket）。
+        返回 (key, 0)；没有可用 key 时返回 (None, 最早可用还需等待的秒数)；
+        除 exclude 外没有任何 key 时返回 (None, None)。
+        """
+        now = time.monotonic()
+        skipped = []
+        wait = None
+        with self._lock:
+            try:
+                while True:
+                    entry = self._peek(exclude, skipped)
+                    if entry is None:
+                        return None, wait
+
+                    ready_at, _, key, _ = entry
+                    if ready_at > now:
+                        return None, ready_at - now if wait is None else min(wait, ready_at - now)
+
+                    afford_at = self._token_ready_at(key, tokens, now)
+                    if afford_at > now:
+                        wait = afford_at - now if wait is None else min(wait, afford_at - now)
+                        skipped.append(heapq.heappop(self._heap))
+                        continue
+
+                    heapq.heappop(self._heap)
+                    self._take(key, tokens, now, ticket)
+                    return key, 0
+            finally:
+                for entry in skipped:
+                    heapq.heappush(self._heap, entry)
+
+    def try_acquire(self, key, tokens=0, ticket=None):
+        """只尝试指定的 key（例如持有上下文缓存的 key），现在有余量则占用并返回 True"""
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._windows or self._ready_at(key, now) > now or self._token_ready_at(key, tokens, now) > now:
+                return False
+            self._take(key, tokens, now, ticket)
+            return True
+
+    def adjust_tokens(self, key, ticket, actual):
+        """
+        拿到实际用量后，把该 key 上最近一条带 ticket 的记录改为 actual 个 token。
+        按 ticket 而不是估计值查找：同一个 key 上估计值相同的并发请求不会改错记录
+        """
+        if not self.max_tokens or ticket is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            entries = self._token_entries.get(key)
+            if not entries:
+                return
+            for entry in reversed(entries):
+                if entry[2] == ticket:
+                    if entry[1] != actual:
+                        self._token_used[key] += actual - entry[1]
+                        entry[1] = actual
+                        self._push(key, now)
+                    return
+
+    def next_available_in(self, exclude=()):
+        """不占用名额，仅返回最早可用 key 还需等待的秒数 (0 表示现在就有)"""
+        now = time.monotonic()
+        skipped = []
+        with self._lock:
+            try:
+                entry = self._peek(exclude, skipped)
+                if entry is None:
+                    return None
+                return max(entry[0] - now, 0)
+            finally:
+                for entry in skipped:
+                    heapq.heappush(self._heap, entry)
+
+    def cooldown(self, key, seconds):
+        """在 seconds 秒内不再调度该 key"""
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._windows:
+                return
+            self._cooldown_until[key] = max(self._cooldown_until[key], now + seconds)
+            self._push(key, now)
+
+    def reinstate(self, key):
+        """提前结束该 key 的冷却"""
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._windows:
+                return
+            self._cooldown_until[key] = 0.0
+            self._push(key, now)
+
+    def is_saturated(self, key):
+        """该 key 的窗口是否已经用满（不计已滑出窗口的请求）"""
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                return False
+            while window and window[0] <= now - self.window:
+                window.popleft()
+            return len(window) >= self.max_requests
+
+    def cooling_down_count(self):
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for until in self._cooldown_until.values() if until > now)
+
+    def is_cooling_down(self, key):
+        now = time.monotonic()
+        with self._lock:
+            return self._cooldown_until.get(key, 0) > now
@@ -0,0 +1,164 @@
+import binascii
+import hashlib
+import logging
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote_to_bytes
+
+# data URI 头部 (data:<mime>;base64) 的最大长度，只在这个范围内查找逗号
+MAX_HEADER_LENGTH = 256
+
+
+logger = logging.getLogger(__name__)
+
+
+class MediaData(bytes):
+    """
+    解码（及预处理）后的媒体内容，附带内容哈希、实际的 mime_type 和预处理前的大小；
+    同一份内容在各轮对话中共用同一个对象
+    """
+
+    def __new__(cls, data, digest, mime_type, original_size=None):
+        obj = super().__new__(cls, data)
+        obj.digest = digest
+        obj.mime_type = mime_type
+        obj.original_size = len(obj) if original_size is None else original_size
+        return obj
+
+
+class ImageNormalizer:
+    """
+    在进程池中执行图片预处理（缩放、重新编码、去除元数据），解码和编码不占用请求线程的 GIL。
+    worker 为可 pickle 的模块级函数 worker(data, max_pixels, image_format, quality)，
+    返回 (mime_type, 数据) 或 None（保持原图）。预处理失败或超时都退回原图。
+    """
+
+    def __init__(self, worker, max_pixels, image_format='WEBP', quality=85, workers=2, timeout=30):
+        self.worker = worker
+        self.max_pixels = max_pixels
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.workers = workers
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # 不用 fork：父进程中已有 gRPC 等后台线程，fork 出的子进程可能死锁
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def __call__(self, mime_type, data):
+        if not mime_type.startswith('image/'):
+            return mime_type, data
+        try:
+            future = self._get_executor().submit(self.worker, data, self.max_pixels, self.image_format, self.quality)
+            result = future.result(timeout=self.timeout)
+        except Exception as e:
+            logger.warning(f"图片预处理失败，发送原图: {e}")
+            return mime_type, data
+        return result if result is not None else (mime_type, data)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+def parse_data_uri_header(header):
+    """解析 data URI 逗号前 "data:" 之后的部分，返回 (mime_type, 是否 base64)"""
+    fields = header.split(';')
+    return fields[0] or 'text/plain', 'base64' in fields[1:]
+
+
+def new_digest(mime_type):
+    """媒体内容哈希：sha256(mime_type + NUL + data URI 中逗号之后的原始文本)"""
+    return hashlib.sha256(mime_type.encode('utf-8') + b'\0')
+
+
+def json_default(obj):
+    """json.dumps 的 default：媒体内容只按哈希参与序列化，不再逐字节编码"""
+    if isinstance(obj, MediaData):
+        return f"sha256:{obj.digest}"
+    if isinstance(obj, bytes):
+        return f"sha256:{hashlib.sha256(obj).hexdigest()}"
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class MediaStore:
+    """
+    按内容寻址的媒体存储。
+
+    data URI 只做一次 UTF-8 编码，之后通过 memoryview 切片取出数据部分计算哈希，不再整体 split 复制；
+    只有第一次见到的内容才会 base64 解码，解码结果按哈希放在内存 LRU 中（按总字节数限制），
+    后续轮次直接引用同一个 MediaData 对象，SDK 也不再重复解码 base64。
+    配置了 normalizer 时，新内容在入库前先经过预处理（如图片缩放），同一张图片只处理一次。
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, normalizer=None):
+        self.max_bytes = max_bytes
+        self.normalizer = normalizer
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def parse_data_uri(self, uri):
+        """解析 data URI，返回 (mime_type, MediaData)；格式错误时抛出 ValueError"""
+        comma = uri.find(',', 0, MAX_HEADER_LENGTH)
+        if not uri.startswith('data:') or comma < 0:
+            raise ValueError("invalid data URI")
+
+        mime_type, is_base64 = parse_data_uri_header(uri[5:comma])
+
+        raw = uri.encode('utf-8')
+        payload = memoryview(raw)[comma + 1:]
+        digest = new_digest(mime_type)
+        digest.update(payload)
+        digest = digest.hexdigest()
+
+        data = self.get(digest)
+        if data is None:
+            try:
+                decoded = binascii.a2b_base64(payload) if is_base64 else unquote_to_bytes(payload.tobytes())
+            except binascii.Error as e:
+                raise ValueError(str(e))
+            data = self.store(mime_type, digest, decoded)
+        return data.mime_type, data
+
+    def store(self, mime_type, digest, decoded):
+        """登记一份已解码的内容（必要时先预处理），返回 MediaData；已存在时直接返回已有对象"""
+        data = self.get(digest)
+        if data is not None:
+            return data
+        original_size = len(decoded)
+        if self.normalizer is not None:
+            mime_type, decoded = self.normalizer(mime_type, decoded)
+        return self.put(digest, MediaData(decoded, digest, mime_type, original_size))
+
+    def get(self, digest):
+        with self._lock:
+            data = self._entries.get(digest)
+            if data is not None:
+                self._entries.move_to_end(digest)
+            return data
+
+    def put(self, digest, data):
+        if len(data) > self.max_bytes:
+            return data
+        with self._lock:
+            existing = self._entries.get(digest)
+            if existing is not None:
+                return existing
+            self._entries[digest] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+        return data
@@ -0,0 +1,182 @@
+import bisect
+import hashlib
+import threading
+
+# 延迟类直方图的默认分桶（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """按标签分组的直方图，每次 observe 只做一次二分查找和几次加法"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # [各分桶计数 ..., +Inf 分桶计数, 总和]
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labelvalues, list(series)) for labelvalues, series in self._series.items())
+        for labelvalues, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """在抓取时调用 callback 取值的 gauge；callback 返回数值，或 {标签值元组: 数值}"""
+
+    def __init__(self, name, documentation, callback, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.callback()
+        except Exception:
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labelvalues, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback, labelnames=()):
+        return self._register(Gauge(name, documentation, callback, labelnames))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus 文本格式"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def key_label(api_key):
+    """指标和请求记录中用 key 的摘要区分各个 key，不暴露 key 本身的任何部分；启动日志中列出各 key 对应的摘要"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:8] if api_key else ""
+
+
+REGISTRY = Registry()
+
+requests_total = REGISTRY.counter(
+    "gemini_proxy_requests_total", "客户端请求数（按最终状态码）", ("model", "stream", "status"))
+request_duration = REGISTRY.histogram(
+    "gemini_proxy_request_duration_seconds", "请求处理耗时，流式请求为开始输出前的耗时", ("model", "stream"))
+request_attempts = REGISTRY.histogram(
+    "gemini_proxy_request_attempts", "每个请求的上游尝试次数", ("model",), buckets=(1, 2, 3, 4, 5, 8, 10))
+upstream_attempts_total = REGISTRY.counter(
+    "gemini_proxy_upstream_attempts_total", "上游调用次数", ("model", "key"))
+upstream_latency = REGISTRY.histogram(
+    "gemini_proxy_upstream_latency_seconds", "上游调用耗时，流式为拿到响应流的耗时", ("model", "stream"))
+upstream_errors_total = REGISTRY.counter(
+    "gemini_proxy_upstream_errors_total", "上游错误数（按错误类型）", ("key", "error"))
+ttft = REGISTRY.histogram(
+    "gemini_proxy_time_to_first_token_seconds", "流式请求从收到请求到输出第一段文本的耗时", ("model",))
+stream_duration = REGISTRY.histogram(
+    "gemini_proxy_stream_duration_seconds", "流式输出持续时间", ("model",))
+streams_total = REGISTRY.counter(
+    "gemini_proxy_streams_total", "流式输出结果（completed / truncated）", ("model", "result"))
+stream_resumes_total = REGISTRY.counter(
+    "gemini_proxy_stream_resumes_total", "流式输出中途断开后换 key 续写的结果（resumed / failed）", ("model", "result"))
+key_acquired_total = REGISTRY.counter(
+    "gemini_proxy_key_acquired_total", "每个 key 被调度的次数", ("key",))
+key_rate_limited_total = REGISTRY.counter(
+    "gemini_proxy_key_rate_limited_total", "key 用满本地限额窗口的次数", ("key",))
+key_cooldowns_total = REGISTRY.counter(
+    "gemini_proxy_key_cooldowns_total", "key 因出错被暂时禁用的次数", ("key",))
+key_probes_total = REGISTRY.counter(
+    "gemini_proxy_key_probes_total", "后台 key 健康探测结果（reinstated / retired / failed）", ("result",))
+no_key_available_total = REGISTRY.counter(
+    "gemini_proxy_no_key_available_total", "没有可用 key 的次数")
+admission_rejected_total = REGISTRY.counter(
+    "gemini_proxy_admission_rejected_total", "在准入队列中等待超时或队列已满而返回 429 的请求数")
+embedding_batch_size = REGISTRY.histogram(
+    "gemini_proxy_embedding_batch_size", "每次 BatchEmbedContents 合并的输入条数", ("model",),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 100))
+coalesced_requests_total = REGISTRY.counter(
+    "gemini_proxy_coalesced_requests_total", "与进行中的相同请求合并、没有单独调用上游的请求数", ("model", "stream"))
+response_cache_total = REGISTRY.counter(
+    "gemini_proxy_response_cache_total", "响应缓存查询结果（hit / miss）", ("result",))
+tokens_total = REGISTRY.counter(
+    "gemini_proxy_tokens_total", "上游返回的 token 用量（prompt / completion）", ("model", "type"))
+media_bytes_total = REGISTRY.counter(
+    "gemini_proxy_media_bytes_total", "请求中的媒体字节数（in 为原始大小，out 为实际发送大小）", ("direction",))
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def model_id(name):
+    """'models/gemini-1.5-flash' 和 'gemini-1.5-flash' 视为同一个模型"""
+    return name.split("/", 1)[-1] if name.startswith("models/") else name
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match 中包含当前 ETag（或 *）时客户端的缓存仍然有效"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+
+class CatalogSnapshot:
+    """某一时刻的模型列表，/v1/models 和首页都已序列化好，请求时直接返回"""
+
+    def __init__(self, models, render_index):
+        self.models = models
+        self.models_body = json.dumps(
+            {"object": "list", "data": [{"id": model, "object": "model", "owned_by": "google"} for model in models]},
+            ensure_ascii=False).encode("utf-8")
+        self.models_etag = '"' + hashlib.sha256(self.models_body).hexdigest()[:16] + '"'
+        self.index_body = render_index(models).encode("utf-8")
+        self.index_etag = '"' + hashlib.sha256(self.index_body).hexdigest()[:16] + '"'
+
+
+class ModelCatalog:
+    """
+    在后台定期（每 ttl 秒）用每个 key 调用 ListModels，记录每个 key 能用哪些模型。
+    对外的模型列表是所有 key 可用模型的并集；还没有获取成功时使用 fallback_models。
+    某个 key 获取失败时保留它上一次的结果，从未成功的 key 不参与判断。
+    """
+
+    def __init__(self, fetch_models, fallback_models, render_index, ttl=3600, retry_interval=60, max_workers=8):
+        self.fetch_models = fetch_models
+        self.render_index = render_index
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.max_workers = max_workers
+        self.updated_at = None
+        self._key_models = {}
+        self._unsupported = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.snapshot = CatalogSnapshot(list(fallback_models), render_index)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def keys_without(self, model):
+        """
+        已知不能使用该模型的 key，选 key 时排除；
+        没有任何 key 列出该模型时（实验模型、别名或列表还没获取到）不排除任何 key
+        """
+        return self._unsupported.get(model_id(model), frozenset())
+
+    def refresh(self, api_keys):
+        """获取所有 key 的模型列表，返回获取成功的 key 数"""
+        def fetch(api_key):
+            try:
+                return api_key, {model_id(name) for name in self.fetch_models(api_key)}
+            except Exception as e:
+                logger.warning("%s → 获取模型列表失败: %s", api_key[:11], e)
+                return api_key, None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(api_keys)))) as executor:
+            results = list(executor.map(fetch, api_keys))
+
+        with self._lock:
+            for api_key, models in results:
+                if models is not None:
+                    self._key_models[api_key] = models
+            key_models = {key: self._key_models[key] for key in api_keys if key in self._key_models}
+
+        succeeded = sum(1 for _, models in results if models is not None)
+        if not key_models:
+            return succeeded
+
+        all_models = sorted(set().union(*key_models.values()))
+        self._unsupported = {
+            model: frozenset(key for key, models in key_models.items() if model not in models)
+            for model in all_models
+        }
+        if all_models != self.snapshot.models:
+            self.snapshot = CatalogSnapshot(all_models, self.render_index)
+            logger.info("模型列表已更新: %d 个模型（%d/%d 个 key 获取成功）", len(all_models), succeeded, len(api_keys))
+        self.updated_at = time.time()
+        return succeeded
+
+    def start(self, get_api_keys):
+        """启动后台刷新线程；get_api_keys 返回当前配置的全部 key"""
+        with self._lock:
+            if self._thread is not None or not self.enabled:
+                return
+            self._thread = threading.Thread(target=self._run, args=(get_api_keys,), name="model-catalog", daemon=True)
+            self._thread.start()
+
+    def _run(self, get_api_keys):
+        while True:
+            api_keys = list(get_api_keys())
+            succeeded = self.refresh(api_keys) if api_keys else 0
+            time.sleep(self.ttl if succeeded else min(self.retry_interval, self.ttl))
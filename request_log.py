@@ -0,0 +1,138 @@
+import contextvars
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import time
+
+# 附加到每条日志上的请求字段，JSON 格式时原样输出
+CONTEXT_FIELDS = ('request_id', 'model', 'key', 'attempt', 'latency_ms')
+
+_context = contextvars.ContextVar('request_log_context', default=None)
+_ids = itertools.count(1)
+# 多个 worker 进程生成的请求 ID 不重复
+_id_prefix = os.urandom(3).hex()
+_valid_request_id = re.compile(r'[A-Za-z0-9._:-]{1,64}')
+
+
+def begin(request_id=None, sample_rate=1.0):
+    """
+    开始记录一个请求：生成（或沿用客户端传入的合法 X-Request-ID）请求 ID，并决定本次请求的
+    info 级日志是否被采样；warning 及以上的日志总是输出。返回请求 ID。
+    """
+    if not request_id or not _valid_request_id.fullmatch(request_id):
+        request_id = f"{_id_prefix}-{next(_ids):x}"
+    _context.set({
+        'request_id': request_id,
+        'start': time.monotonic(),
+        'sampled': sample_rate >= 1 or random.random() < sample_rate,
+    })
+    return request_id
+
+
+def bind(**fields):
+    """给当前请求补充字段（模型、key 前缀、尝试次数），之后的日志都会带上"""
+    context = _context.get()
+    if context is not None:
+        context.update(fields)
+
+
+def end():
+    """请求（流式请求为整个流）结束，之后同一线程中的日志不再带有该请求的字段"""
+    _context.set(None)
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行 JSON：时间、级别、消息和请求字段"""
+
+    def format(self, record):
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'msg': record.getMessage().strip(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """
+    请求线程 / 协程只做级别过滤、采样和附加请求字段，然后把日志记录放进有界队列；
+    格式化和写入都在后台线程中完成。输出端卡住时队列写满，新的日志被丢弃而不是阻塞请求。
+    """
+
+    def __init__(self, target, max_queue=10000):
+        super().__init__(queue.Queue(maxsize=max_queue))
+        self.dropped = 0
+        self._listener = _DropReportingListener(self.queue, target, self)
+        self._listener.start()
+
+    def filter(self, record):
+        context = _context.get()
+        if context is not None:
+            if not context['sampled'] and record.levelno < logging.WARNING:
+                return False
+            for field in CONTEXT_FIELDS[:-1]:
+                setattr(record, field, context.get(field))
+            record.latency_ms = round((time.monotonic() - context['start']) * 1000, 1)
+        return super().filter(record)
+
+    def prepare(self, record):
+        # 默认实现会在调用方线程中格式化消息，这里原样交给后台线程处理
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """写完队列中剩余的日志（进程退出时调用）"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        super().close()
+
+
+class _DropReportingListener(logging.handlers.QueueListener):
+    def __init__(self, log_queue, target, source):
+        super().__init__(log_queue, target, respect_handler_level=True)
+        self.source = source
+
+    def handle(self, record):
+        if self.source.dropped:
+            dropped, self.source.dropped = self.source.dropped, 0
+            super().handle(logging.makeLogRecord({
+                'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': '日志输出过慢，队列已满，丢弃了 %d 条日志', 'args': (dropped,),
+            }))
+        super().handle(record)
+
+
+def setup_logging(level='INFO', log_format='text', max_queue=10000):
+    """
+    把日志输出改为异步：text 格式与原来相同（只输出消息），json 格式每行一条带请求字段的 JSON。
+    handler 挂在根 logger 上，app 以及 state_backend、key_health 等各模块的 logger 都经由它输出。
+    低于 level 的日志在调用处就被跳过，不做任何格式化；采样比例由 begin() 的 sample_rate 决定。返回 AsyncLogHandler，退出时调用其 close()。
+    """
+    target = logging.StreamHandler()
+    target.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter('%(message)s'))
+    handler = AsyncLogHandler(target, max_queue)
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        if isinstance(existing, AsyncLogHandler):
+            root.removeHandler(existing)
+            existing.close()
+    root.addHandler(handler)
+    root.setLevel(logging.getLevelName(str(level).upper()) if isinstance(level, str) else level)
+    return handler
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from media_store import json_default
+
+# 磁盘缓存每隔多少秒清理一次过期条目并核对总大小
+DISK_CLEANUP_INTERVAL = 60
+
+
+def cache_key(model, gemini_history, user_message, temperature, max_tokens):
+    """对 (模型, 处理后的消息, temperature, max_tokens) 做规范化 JSON 后取 sha256"""
+    payload = json.dumps(
+        [model, gemini_history, user_message, temperature, max_tokens],
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=json_default
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CachedResponse:
+    """把缓存的结果包装成与 Gemini 响应相同的接口，既可以取 .text，也可以当作流逐块迭代"""
+
+    def __init__(self, text):
+        self.text = text
+
+    def __iter__(self):
+        yield self
+
+    async def __aiter__(self):
+        yield self
+
+
+class ResponseCache:
+    """
+    确定性请求 (temperature == 0) 的响应缓存。
+    内存中是带 TTL、按条数和字节数限制的 LRU；配置了 path 时再加一层 SQLite 磁盘缓存，重启后仍然有效。
+    磁盘缓存总大小不超过 disk_max_bytes，超出时先删除最早过期的条目；过期条目定期清理。
+    """
+
+    def __init__(self, ttl=600, max_entries=1000, max_bytes=64 * 1024 * 1024, path=None,
+                 disk_max_bytes=256 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires_at REAL, value TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at)")
+            self._cleanup_disk(time.time())
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def cacheable(self, temperature):
+        return self.enabled and temperature == 0
+
+    def _store(self, key, expires_at, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old[1])
+        self._entries[key] = (expires_at, value)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    return json.loads(value)
+                del self._entries[key]
+                self._bytes -= len(value)
+
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT expires_at, value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] <= now:
+                return None
+            self._store(key, row[0], row[1])
+            return json.loads(row[1])
+
+    def put(self, key, data):
+        expires_at = time.time() + self.ttl
+        value = json.dumps(data, ensure_ascii=False)
+        with self._lock:
+            self._store(key, expires_at, value)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, expires_at, value))
+                # 两次核对之间按写入量估计总大小（覆盖写入会多算，只会让清理提前）
+                self._disk_bytes += len(value.encode("utf-8"))
+                if self._disk_bytes > self.disk_max_bytes or time.time() >= self._next_cleanup:
+                    self._cleanup_disk(time.time())
+                self._db.commit()
+
+    def _cleanup_disk(self, now):
+        """
+        删除过期条目；总大小超过 disk_max_bytes 时从最早过期的条目开始删除，直到不超过上限。
+        调用时已持有锁（或在初始化中）。多个 worker 共用同一个文件时各自核对，以文件中的实际大小为准
+        """
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM (SELECT key, SUM(length(CAST(value AS BLOB))) "
+            "OVER (ORDER BY expires_at DESC, key) AS total FROM responses) WHERE total > ?)",
+            (self.disk_max_bytes,))
+        self._db.commit()
+        self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(length(CAST(value AS BLOB))), 0) FROM responses").fetchone()[0]
+        self._next_cleanup = now + DISK_CLEANUP_INTERVAL
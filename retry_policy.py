@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+
+# 各错误类型的默认处理方式，可通过配置项 ErrorPolicy 按类名覆盖其中的任意字段：
+#   retry:        是否重试
+#   cooldown:     出错的 key 暂停调度的秒数 (0 表示不禁用)
+#   max_cooldown: 同一个 key 连续出同类错误时冷却时间翻倍，不超过该值 (秒)
+#   probe:        冷却期间是否由后台探测 key 是否已恢复（key 本身问题类的错误）
+#   backoff:      没有其他可用 key 时的退避基数 (秒)，按 2^失败次数 增长
+#   max_backoff:  退避上限 (秒)
+DEFAULT_ERROR_POLICY = {
+    "InvalidArgument": {"retry": True, "cooldown": 60, "max_cooldown": 3600, "probe": True, "backoff": 0, "max_backoff": 0},
+    "PermissionDenied": {"retry": True, "cooldown": 60, "max_cooldown": 3600, "probe": True, "backoff": 0, "max_backoff": 0},
+    "ResourceExhausted": {"retry": True, "cooldown": 10, "max_cooldown": 300, "probe": False, "backoff": 1, "max_backoff": 16},
+    "Aborted": {"retry": True, "cooldown": 0, "max_cooldown": 0, "probe": False, "backoff": 1, "max_backoff": 16},
+    "InternalServerError": {"retry": True, "cooldown": 0, "max_cooldown": 0, "probe": False, "backoff": 1, "max_backoff": 16},
+    "ServiceUnavailable": {"retry": True, "cooldown": 0, "max_cooldown": 0, "probe": False, "backoff": 1, "max_backoff": 16},
+    "StopCandidateException": {"retry": True, "cooldown": 0, "max_cooldown": 0, "probe": False, "backoff": 0, "max_backoff": 0},
+}
+
+
+def load_error_policy(overrides):
+    """合并默认策略与配置中的 ErrorPolicy（dict 或 JSON 字符串）"""
+    policy = {name: dict(rule) for name, rule in DEFAULT_ERROR_POLICY.items()}
+    if isinstance(overrides, str):
+        overrides = json.loads(overrides) if overrides.strip() else {}
+    for name, rule in (overrides or {}).items():
+        policy.setdefault(name, dict(DEFAULT_ERROR_POLICY["InternalServerError"])).update(rule)
+    return policy
+
+
+class RetryBudget:
+    """
+    进程级重试预算（令牌桶）：每个请求存入 ratio 个令牌，每次重试消耗 1 个，
+    另外每秒补充 min_per_second 个，保证低流量时也能重试。
+    上游大面积故障时限制重试放大流量，避免把所有 key 的配额都耗在重试上。
+    initial_tokens 为初始令牌数，默认装满 (max_tokens)。
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=1.0, max_tokens=100, initial_tokens=None):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+
+        self._lock = threading.Lock()
+        self._tokens = float(max_tokens if initial_tokens is None else initial_tokens)
+        self._last_refill = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._last_refill) * self.min_per_second)
+        self._last_refill = now
+
+    def record_request(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts, deadline, error_policy, budget):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.error_policy = error_policy
+        self.budget = budget
+
+    def rule_for(self, error):
+        for cls in type(error).__mro__:
+            rule = self.error_policy.get(cls.__name__)
+            if rule is not None:
+                return cls.__name__, rule
+        return None, None
+
+    def backoff(self, rule, failures):
+        return min(rule["backoff"] * (2 ** failures), rule["max_backoff"])
+
+    def start(self):
+        self.budget.record_request()
+        return RetryState(self)
+
+
+class RetryState:
+    """单个请求的重试状态：截止时间、已尝试过的 key 和失败次数"""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.deadline = time.monotonic() + policy.deadline
+        self.tried_keys = set()
+        self.failures = 0
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def can_wait(self, seconds):
+        return seconds < self.remaining()
+
+    def allow_retry(self):
+        """消耗一次重试预算；预算耗尽时返回 False，调用方应直接失败"""
+        return self.policy.budget.try_spend()
@@ -0,0 +1,85 @@
+"""
+生产环境启动入口：python serve.py
+
+使用 uvicorn 运行 asgi.py（每条 SSE 流只占一个协程），按 CPU 数和预期的并发流数量
+确定 worker 进程数和每个 worker 的线程池大小；配置只在主进程加载一次，再传给各个 worker。
+收到 SIGTERM 时停止接受新连接，等待正在输出的流式响应结束（最多 DrainTimeout 秒）后退出。
+"""
+import json
+import logging
+import math
+import os
+import tempfile
+
+import uvicorn
+
+from settings import CONFIG_SNAPSHOT_ENV, load_config, valid_api_keys
+
+logger = logging.getLogger("serve")
+logger.setLevel(logging.INFO)
+_handler = logging.StreamHandler()
+_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+logger.addHandler(_handler)
+# 单 worker 时 asgi 在本进程中导入并在根 logger 上配置输出，避免同一条日志输出两次
+logger.propagate = False
+
+# 单个 worker（一个事件循环）计划承载的并发流数量；流式输出基本不占 CPU，瓶颈在 JSON 编解码和 TLS
+STREAMS_PER_WORKER = 200
+# 每个 worker 的线程池（媒体解码、共享状态存储等阻塞操作）按每 8 条流一个线程估算
+STREAMS_PER_THREAD = 8
+MAX_THREADS = 64
+
+
+def cpu_count():
+    """容器中优先使用 CPU 亲和性得到实际可用的核数"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count() or 1
+
+
+def plan_capacity(config):
+    """返回 (worker 数, 每个 worker 的线程数, 预期并发流数)；Workers / Threads 已配置时直接使用"""
+    cpus = cpu_count()
+    expected_streams = int(config.get("ExpectedStreams") or 100)
+    workers = int(config.get("Workers") or 0) or max(1, min(cpus, math.ceil(expected_streams / STREAMS_PER_WORKER)))
+    threads = int(config.get("Threads") or 0) or min(
+        MAX_THREADS, max(cpus + 4, math.ceil(expected_streams / workers / STREAMS_PER_THREAD)))
+    return workers, threads, expected_streams
+
+
+def main():
+    config = load_config()
+    workers, threads, expected_streams = plan_capacity(config)
+    drain_timeout = float(config.get("DrainTimeout") or 30)
+    port = int(config.get("PORT") or os.environ.get("PORT") or 3000)
+
+    # 多个 worker 各自计数会超出每个 key 的限额，未配置共享存储时自动使用本机 SQLite
+    if workers > 1 and (config.get("StateBackend") or "memory") == "memory":
+        path = os.path.join(tempfile.gettempdir(), f"gemini-proxy-{port}", "keys.db")
+        config["StateBackend"] = "sqlite:///" + path
+        logger.info(f"多个 worker 共用限额状态: {config['StateBackend']}")
+
+    config["Threads"] = threads
+    # worker 收到的是校验过的配置，不再各自过滤 key
+    config["KeyArray"] = valid_api_keys(config.get("KeyArray"))
+    os.environ[CONFIG_SNAPSHOT_ENV] = json.dumps(config)
+
+    logger.info(f"CPU 核数: {cpu_count()}，预期并发流/ExpectedStreams: {expected_streams}")
+    logger.info(f"worker 进程/Workers: {workers}，每个 worker 线程池/Threads: {threads}，"
+                f"约可承载 {workers * STREAMS_PER_WORKER} 条并发流")
+    logger.info(f"监听端口: {port}，SIGTERM 后最多等待 {drain_timeout:g} 秒让进行中的请求完成/DrainTimeout")
+
+    uvicorn.run(
+        "asgi:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        timeout_graceful_shutdown=drain_timeout,
+        backlog=max(2048, expected_streams * 2),
+        access_log=False,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import json
+import os
+import re
+
+# 可以通过环境变量 / .env 设置的配置项，未设置的不覆盖 env.json
+CONFIG_KEYS = ["KeyArray", "MaxRetries", "MaxRequests", "LimitWindow", "password", "PORT",
+               "UpstreamEndpoint", "UpstreamTransport", "ErrorPolicy", "RequestDeadline", "RetryBudget",
+               "HedgeModels", "HedgePercentile", "HedgeMinDelay", "HedgeDefaultDelay", "HedgeBudget",
+               "ResponseCacheTTL", "ResponseCacheMaxEntries", "ResponseCacheMaxMB", "ResponseCachePath",
+               "ResponseCacheDiskMaxMB", "ContextCache", "ContextCacheMinKB", "ContextCacheMinReuse", "ContextCacheTTL",
+               "MediaStoreMaxMB",
+               "ImageMaxPixels", "ImageFormat", "ImageQuality", "ImageWorkers",
+               "MaxBodyMB", "MaxPartMB", "StreamBodyMinKB",
+               "StreamFlushMs", "StreamFlushBytes", "MaxInputTokens", "AdmissionQueueSize", "AdmissionMaxWait",
+               "AdmissionSyncWait", "StateBackend", "Workers", "Threads", "ExpectedStreams", "DrainTimeout",
+               "CapturePath", "CaptureText", "CaptureSampleRate", "LogLevel", "LogFormat", "LogSampleRate",
+               "LogQueueSize", "FastStartup", "ModelCatalogTTL", "KeyStatePath", "KeyProbeInterval",
+               "KeyProbeModel", "KeyRetireCooldown", "CoalesceRequests", "EmbeddingModel",
+               "EmbeddingBatchWindow", "EmbeddingMaxBatch", "StreamResumeAttempts", "MetricsToken"]
+
+# 保存已加载配置（JSON）的环境变量，由 serve.py 设置后传给各个 worker 进程
+CONFIG_SNAPSHOT_ENV = "GEMINI_PROXY_CONFIG"
+
+API_KEY_PATTERN = re.compile(r"AIzaSy[a-zA-Z0-9_-]{33}")
+
+_loaded_config = None
+
+
+def valid_api_keys(key_array):
+    """KeyArray 中格式正确的 key（列表或按行分隔的字符串）"""
+    if isinstance(key_array, str):
+        key_array = key_array.splitlines()
+    if not isinstance(key_array, list):
+        return []
+    return [key for key in key_array if API_KEY_PATTERN.match(key)]
+
+
+def load_config():
+    """加载并校验配置；同一进程中只加载一次，之后返回同一份结果"""
+    global _loaded_config
+    if _loaded_config is None:
+        _loaded_config = _load_config()
+    return _loaded_config
+
+
+# 从 env.json 或 .env 加载环境变量
+def _load_config():
+    # serve.py 在启动 worker 前已经加载并校验过配置（KeyArray 中只保留格式正确的 key），worker 直接使用同一份结果
+    snapshot = os.environ.get(CONFIG_SNAPSHOT_ENV)
+    if snapshot:
+        return json.loads(snapshot)
+
+    config = {}
+    key_array_from_json = None
+    key_array_from_env = None
+
+    # 尝试从 env.json 加载
+    try:
+        with open("env.json", "r") as f:
+            config_json = json.load(f)
+            if "KeyArray" in config_json:
+                key_array_from_json = config_json["KeyArray"]
+                if isinstance(key_array_from_json, str):
+                    key_array_from_json = key_array_from_json.splitlines()
+                config.update(config_json)  # 使用 update 合并配置
+    except FileNotFoundError:
+        pass
+
+    # 尝试从 .env 加载
+    from dotenv import load_dotenv
+    load_dotenv()
+    config_env = {key: os.environ.get(key) for key in CONFIG_KEYS}
+    config_env = {key: value for key, value in config_env.items() if value is not None}  # 未设置的环境变量不覆盖 env.json
+    if "KeyArray" in config_env and config_env["KeyArray"]:
+        key_array_from_env = config_env["KeyArray"].splitlines()
+    config.update(config_env)  # 使用 update 合并配置
+
+    # 检查 KeyArray 是否都为 "your_key" 或缺失
+    if (key_array_from_json == "your_key" or (isinstance(key_array_from_json, list) and all(
+            k.strip() == "your_key" for k in key_array_from_json)) or key_array_from_json is None) and \
+            (key_array_from_env == "your_key" or (isinstance(key_array_from_env, list) and all(
+                k.strip() == "your_key" for k in key_array_from_env)) or key_array_from_env is None):
+        print("错误：请在 env.json 或 .env 文件中将 KeyArray 的值替换为您的 Google API 密钥。或检查是否有这两个文件。")
+        input("按 Enter 键退出...")
+        exit(1)
+
+    # 确保 KeyArray 是一个列表
+    if "KeyArray" in config and isinstance(config["KeyArray"], str):
+        config["KeyArray"] = config["KeyArray"].splitlines()
+
+    return config
@@ -0,0 +1,246 @@
+import asyncio
+import functools
+import threading
+import time
+
+
+class FlightAbandoned(Exception):
+    """共享的流式响应在结束前所有订阅者都已断开，上游调用已放弃"""
+
+
+class Flight:
+    """
+    一次进行中的上游调用（同步版本，Flask 使用）。发起者拿到上游响应后调用 resolve()，
+    等待中的相同请求随即共享该响应。流式响应的分块保存在共享缓冲区中：每个订阅者（包括发起者）
+    各自迭代本对象，先重放已收到的分块，再轮流由其中一个订阅者向上游读取下一个分块。
+    """
+
+    def __init__(self, on_done):
+        self._on_done = on_done
+        self._cond = threading.Condition()
+        self.response = None
+        self._resolved = False
+        self._cancelled = False
+        self._source = None
+        self._chunks = []
+        self._pulling = False
+        self._finished = False
+        self._error = None
+        self._subscribers = 0
+
+    def resolve(self, response, stream=False):
+        with self._cond:
+            self.response = response
+            self._resolved = True
+            if stream:
+                self._source = iter(response)
+            else:
+                self._finished = True
+            self._cond.notify_all()
+        # 非流式响应已经完整，之后到达的相同请求不再合并到这里
+        if not stream:
+            self._on_done(self)
+
+    def cancel(self):
+        """发起者没有拿到上游响应就结束时调用，等待者各自重新发起；已 resolve 时无效"""
+        with self._cond:
+            if self._resolved or self._cancelled:
+                return
+            self._cancelled = True
+            self._cond.notify_all()
+        self._on_done(self)
+
+    def wait(self, timeout):
+        """等待发起者的结果，拿到上游响应时返回 True，发起者失败或超时返回 False"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._resolved or self._cancelled, max(timeout, 0))
+            return self._resolved
+
+    def __iter__(self):
+        with self._cond:
+            self._subscribers += 1
+        index = 0
+        try:
+            while True:
+                with self._cond:
+                    while index >= len(self._chunks) and not self._finished and self._pulling:
+                        self._cond.wait()
+                    if index < len(self._chunks):
+                        chunk = self._chunks[index]
+                    elif self._finished:
+                        if self._error is not None:
+                            raise self._error
+                        return
+                    else:
+                        self._pulling = True
+                        chunk = None
+                if chunk is None:
+                    self._pull()
+                    continue
+                index += 1
+                yield chunk
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+                abandoned = not self._subscribers and not self._finished
+                if abandoned:
+                    self._finished = True
+                    self._error = FlightAbandoned()
+            if abandoned:
+                self._on_done(self)
+
+    def _pull(self):
+        chunk, finished, error = None, False, None
+        try:
+            chunk = next(self._source)
+        except StopIteration:
+            finished = True
+        except Exception as e:
+            finished, error = True, e
+        with self._cond:
+            self._pulling = False
+            if finished:
+                self._finished = True
+                self._error = error
+            else:
+                self._chunks.append(chunk)
+            self._cond.notify_all()
+        if finished:
+            self._on_done(self)
+
+
+class AsyncFlight:
+    """
+    异步版本（asgi.py 使用）：流式响应由一个独立的任务读取到共享缓冲区，
+    订阅者只在缓冲区上等待，某个客户端断开时不会中断其他订阅者正在等待的上游读取。
+    """
+
+    def __init__(self, on_done):
+        self._on_done = on_done
+        self._ready = asyncio.Event()
+        self.response = None
+        self._resolved = False
+        self._chunks = []
+        self._finished = False
+        self._error = None
+        self._changed = asyncio.Event()
+        self._pump = None
+        self._subscribers = 0
+
+    def resolve(self, response, stream=False):
+        self.response = response
+        self._resolved = True
+        if stream:
+            self._pump = asyncio.ensure_future(self._run(response))
+        else:
+            self._finished = True
+            self._on_done(self)
+        self._ready.set()
+
+    def cancel(self):
+        if self._ready.is_set():
+            return
+        self._ready.set()
+        self._on_done(self)
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._ready.wait(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+        return self._resolved
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _run(self, response):
+        try:
+            async for chunk in response:
+                self._chunks.append(chunk)
+                self._notify()
+        except Exception as e:
+            self._error = e
+        finally:
+            self._finished = True
+            self._notify()
+            self._on_done(self)
+
+    async def __aiter__(self):
+        self._subscribers += 1
+        index = 0
+        try:
+            while True:
+                if index < len(self._chunks):
+                    index += 1
+                    yield self._chunks[index - 1]
+                elif self._finished:
+                    if self._error is not None:
+                        raise self._error
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            self._subscribers -= 1
+            if not self._subscribers and not self._finished:
+                self._finished = True
+                self._error = FlightAbandoned()
+                self._pump.cancel()
+                self._on_done(self)
+
+
+class SingleFlight:
+    """
+    相同请求（规范化请求的哈希）的合并：同一时间只有第一个请求（发起者）去选 key、调用上游，
+    其余相同的请求等待并共享它的结果，不再各自占用 key 的限额和上游配额。
+    流式请求在整个流结束前都可以加入，加入时从头重放已输出的内容。
+    调用方负责在 key 中带上客户端身份，不同客户端的请求不会合并。
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._flights)
+
+    def coalescable(self, temperature):
+        """只合并 temperature 为 0 的确定性请求：采样请求各自应得到不同的结果"""
+        return self.enabled and temperature == 0
+
+    def _join(self, key, flight_class):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = flight_class(functools.partial(self._discard, key))
+            return flight, True
+
+    def _discard(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def join(self, key, timeout):
+        """
+        返回 (flight, 是否为发起者)。不是发起者时已等到发起者拿到上游响应（flight.response）；
+        发起者失败时重新竞争发起者；超时返回 (None, False)。发起者结束时必须调用 resolve() 或 cancel()。
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            flight, leader = self._join(key, Flight)
+            if leader or flight.wait(deadline - time.monotonic()):
+                return flight, leader
+            if time.monotonic() >= deadline:
+                return None, False
+
+    async def join_async(self, key, timeout):
+        """join() 的异步版本，在协程中等待"""
+        deadline = time.monotonic() + timeout
+        while True:
+            flight, leader = self._join(key, AsyncFlight)
+            if leader or await flight.wait(deadline - time.monotonic()):
+                return flight, leader
+            if time.monotonic() >= deadline:
+                return None, False
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import time
+from json.encoder import encode_basestring_ascii
+
+# chat.completion.chunk 的固定部分预先编码成字节，每个分块只需转义 delta 文本；
+# 输出与 json.dumps(completion_chunk(text)) 逐字节一致
+DELTA_PREFIX = b'data: {"choices": [{"delta": {"content": '
+DELTA_SUFFIX = b'}, "finish_reason": null, "index": 0}], "object": "chat.completion.chunk"}\n\n'
+STOP_EVENT = b'data: {"choices": [{"delta": {}, "finish_reason": "stop", "index": 0}], "object": "chat.completion.chunk"}\n\n'
+
+
+def encode_delta(text):
+    return b''.join((DELTA_PREFIX, encode_basestring_ascii(text).encode('ascii'), DELTA_SUFFIX))
+
+
+def encode_stop(usage=None):
+    """结束事件；有用量信息时附带 OpenAI 格式的 usage 字段"""
+    if usage is None:
+        return STOP_EVENT
+    return b''.join((STOP_EVENT[:-3], b', "usage": ', json.dumps(usage).encode('ascii'), b'}\n\n'))
+
+
+def encode_event(data):
+    """非固定格式的事件（如错误信息）仍按普通方式编码"""
+    return f"data: {json.dumps(data)}\n\n".encode('ascii')
+
+
+def coalesce(texts, interval, max_bytes):
+    """
+    同步版本：把 interval 秒内陆续到达的小段文本合并成一段，累计超过 max_bytes 时立即输出。
+    同步迭代无法定时唤醒，攒着的文本最晚在下一个分块到达（或流结束）时输出。interval 为 0 时不合并。
+    """
+    if interval <= 0:
+        yield from texts
+        return
+
+    pending, size, deadline = [], 0, 0
+    try:
+        for text in texts:
+            if not pending:
+                deadline = time.monotonic() + interval
+            pending.append(text)
+            size += len(text)
+            if size >= max_bytes or time.monotonic() >= deadline:
+                yield ''.join(pending)
+                pending, size = [], 0
+    except Exception:
+        # 上游出错时也先把已收到的文本发出去
+        if pending:
+            yield ''.join(pending)
+        raise
+    if pending:
+        yield ''.join(pending)
+
+
+async def async_coalesce(texts, interval, max_bytes):
+    """
+    异步版本：攒着的文本在 interval 到期时准时输出，不必等下一个分块。
+    同一时间只向上游预读一个分块，下游（客户端）写不动时不会继续读上游，不会无限缓冲。
+    """
+    if interval <= 0:
+        async for text in texts:
+            yield text
+        return
+
+    iterator = texts.__aiter__()
+    pending, size, deadline = [], 0, 0
+    next_text = None
+    try:
+        while True:
+            if next_text is None:
+                next_text = asyncio.ensure_future(iterator.__anext__())
+            timeout = max(0, deadline - time.monotonic()) if pending else None
+            done, _ = await asyncio.wait((next_text,), timeout=timeout)
+            if not done:
+                yield ''.join(pending)
+                pending, size = [], 0
+                continue
+
+            try:
+                text = next_text.result()
+            except StopAsyncIteration:
+                next_text = None
+                break
+            except Exception:
+                next_text = None
+                if pending:
+                    yield ''.join(pending)
+                raise
+            next_text = None
+            if not pending:
+                deadline = time.monotonic() + interval
+            pending.append(text)
+            size += len(text)
+            if size >= max_bytes:
+                yield ''.join(pending)
+                pending, size = [], 0
+        if pending:
+            yield ''.join(pending)
+    finally:
+        if next_text is not None and not next_text.done():
+            next_text.cancel()
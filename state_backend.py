@@ -0,0 +1,631 @@
+import hashlib
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from urllib.parse import unquote, urlparse
+
+from key_scheduler import KeyScheduler
+
+logger = logging.getLogger(__name__)
+
+# 一个 key 在共享存储中的状态：窗口内的请求 [(时间戳, token 数), ...]（按时间排序）和冷却截止时间
+KeyState = namedtuple('KeyState', 'entries cooldown_until')
+EMPTY_STATE = KeyState((), 0.0)
+
+# 预占名额时与其他进程冲突（名额被抢走）后的最多重选次数
+RESERVE_ATTEMPTS = 3
+
+# 所有 key 状态的本地快照的有效期（秒）：选候选 key 和 next_available_in 只读快照，过期后才整体重新读取
+SNAPSHOT_TTL = 0.5
+
+
+def key_id(api_key):
+    """共享存储中只保存 key 的摘要，不保存 key 本身"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+def new_entry_id(now):
+    return f"{now:.6f}-{random.getrandbits(48):012x}"
+
+
+class SqliteStateStore:
+    """
+    同一台机器上多个 worker 共用的 SQLite 状态文件（WAL 模式）。
+    预占名额时在一个 BEGIN IMMEDIATE 事务中只读写候选 key 自己的记录，检查和撤销都在同一事务内，天然是原子的。
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS key_requests "
+                         "(entry TEXT PRIMARY KEY, key TEXT, ts REAL, tokens INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS key_requests_ts ON key_requests (ts)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS key_requests_key ON key_requests (key, ts)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS key_cooldowns (key TEXT PRIMARY KEY, until REAL)")
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def load(self, ids, since):
+        with self._lock:
+            self._db.execute("DELETE FROM key_requests WHERE ts <= ?", (since,))
+            entries = {key: [] for key in ids}
+            for key, ts, tokens in self._db.execute("SELECT key, ts, tokens FROM key_requests ORDER BY ts"):
+                if key in entries:
+                    entries[key].append((ts, tokens))
+            cooldowns = dict(self._db.execute("SELECT key, until FROM key_cooldowns"))
+            return {key: KeyState(entries[key], cooldowns.get(key, 0.0)) for key in ids}
+
+    def reserve(self, key, now, tokens, since):
+        """写入一条预占记录，返回 (记录 ID, 该 key 预占后的状态)；只访问这一个 key 的记录"""
+        entry = new_entry_id(now)
+        with self._lock:
+            self._db.execute("DELETE FROM key_requests WHERE key = ? AND ts <= ?", (key, since))
+            self._db.execute("INSERT INTO key_requests VALUES (?, ?, ?, ?)", (entry, key, now, tokens))
+            rows = self._db.execute("SELECT ts, tokens FROM key_requests WHERE key = ? AND ts > ? ORDER BY ts",
+                                    (key, since)).fetchall()
+            row = self._db.execute("SELECT until FROM key_cooldowns WHERE key = ?", (key,)).fetchone()
+        return entry, KeyState(rows, row[0] if row else 0.0)
+
+    def release(self, key, entry):
+        with self._lock:
+            self._db.execute("DELETE FROM key_requests WHERE entry = ?", (entry,))
+
+    def update_tokens(self, key, entry, now, tokens):
+        with self._lock:
+            self._db.execute("UPDATE key_requests SET tokens = ? WHERE entry = ?", (tokens, entry))
+        return entry
+
+    def set_cooldown(self, key, until):
+        with self._lock:
+            self._db.execute("INSERT INTO key_cooldowns VALUES (?, ?) "
+                             "ON CONFLICT(key) DO UPDATE SET until = max(until, excluded.until)", (key, until))
+
+    def clear_cooldown(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM key_cooldowns WHERE key = ?", (key,))
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection:
+    """最小的 RESP2 客户端，只实现流水线执行命令，不依赖 redis 库"""
+
+    def __init__(self, host, port, password=None, db=0, timeout=5):
+        self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rb')
+        setup = []
+        if password:
+            setup.append(('AUTH', password))
+        if db:
+            setup.append(('SELECT', db))
+        if setup:
+            self.pipeline(setup)
+
+    @staticmethod
+    def _encode(command):
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Redis 连接已关闭")
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b'+':
+            return body.decode('utf-8')
+        if prefix == b'-':
+            return RedisError(body.decode('utf-8'))
+        if prefix == b':':
+            return int(body)
+        if prefix == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            data = self._file.read(length + 2)
+            return data[:-2].decode('utf-8')
+        if prefix == b'*':
+            length = int(body)
+            if length < 0:
+                return None
+            return [self._read() for _ in range(length)]
+        raise RedisError(f"无法解析的 Redis 响应: {line!r}")
+
+    def pipeline(self, commands):
+        """一次发送所有命令，再按顺序读取全部响应；命令出错时抛出 RedisError"""
+        self._sock.sendall(b''.join(self._encode(command) for command in commands))
+        replies = [self._read() for _ in commands]
+        for reply in replies:
+            # MULTI 中命令的执行错误（如 WRONGTYPE）不在入队时报告，而是作为 EXEC 响应数组的元素返回
+            for item in reply if isinstance(reply, list) else (reply,):
+                if isinstance(item, RedisError):
+                    raise item
+        return replies
+
+    def close(self):
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+
+class RedisClient:
+    """线程安全的连接池：每次执行占用一个空闲连接，出错的连接直接丢弃"""
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self._args = dict(
+            host=parsed.hostname or 'localhost',
+            port=parsed.port or 6379,
+            password=unquote(parsed.password) if parsed.password else None,
+            db=int(parsed.path.lstrip('/') or 0),
+        )
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def pipeline(self, commands, transaction=False):
+        if transaction:
+            commands = [('MULTI',)] + list(commands) + [('EXEC',)]
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            connection = RedisConnection(**self._args)
+        try:
+            replies = connection.pipeline(commands)
+        except Exception:
+            connection.close()
+            raise
+        with self._lock:
+            self._idle.append(connection)
+        # MULTI/EXEC 中各命令的结果在 EXEC 的响应里
+        return replies[-1] if transaction else replies
+
+
+class FakeRedis:
+    """
+    进程内的 Redis 替身，只实现 RedisStateStore 用到的命令，语义与 Redis 一致。
+    多个调度器共用同一个 FakeRedis 实例即可模拟多节点部署，用于本地测试
+    """
+
+    _instances = {}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._zsets = {}
+        self._strings = {}
+        self._expires = {}
+
+    @classmethod
+    def named(cls, name):
+        """fake://name 形式的地址：同名的返回同一个实例"""
+        return cls._instances.setdefault(name, cls())
+
+    def pipeline(self, commands, transaction=False):
+        # 整个流水线在一把锁内执行，MULTI/EXEC 的原子性自然成立；
+        # 与 Redis 一样出错的命令不影响其余命令执行，全部执行完后再抛出第一个错误
+        with self._lock:
+            replies = []
+            for command in commands:
+                try:
+                    replies.append(self._execute(*command))
+                except RedisError as e:
+                    replies.append(e)
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def _expire_check(self, name):
+        expires_at = self._expires.get(name)
+        if expires_at is not None and expires_at <= time.time():
+            self._zsets.pop(name, None)
+            self._strings.pop(name, None)
+            del self._expires[name]
+
+    def _execute(self, command, *args):
+        command = command.upper()
+        for name in args[:1] if command != 'MGET' else args:
+            self._expire_check(name)
+        if command.startswith('Z') and args[0] in self._strings or command == 'GET' and args[0] in self._zsets:
+            raise RedisError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        if command == 'ZADD':
+            zset = self._zsets.setdefault(args[0], {})
+            added = 0
+            for score, member in zip(args[1::2], args[2::2]):
+                added += member not in zset
+                zset[member] = float(score)
+            return added
+        if command == 'ZREM':
+            zset = self._zsets.get(args[0], {})
+            return sum(zset.pop(member, None) is not None for member in args[1:])
+        if command == 'ZREMRANGEBYSCORE':
+            zset = self._zsets.get(args[0], {})
+            low, high = self._score_bound(args[1]), self._score_bound(args[2])
+            removed = [member for member, score in zset.items() if low(score, 'min') and high(score, 'max')]
+            for member in removed:
+                del zset[member]
+            return len(removed)
+        if command == 'ZRANGE':
+            items = sorted(self._zsets.get(args[0], {}).items(), key=lambda item: (item[1], item[0]))
+            start, stop = int(args[1]), int(args[2])
+            items = items[start:] if stop == -1 else items[start:stop + 1]
+            if 'WITHSCORES' in args[3:]:
+                return [value for member, score in items for value in (member, repr(score))]
+            return [member for member, _ in items]
+        if command == 'PEXPIRE':
+            self._expires[args[0]] = time.time() + int(args[1]) / 1000
+            return 1
+        if command == 'SET':
+            self._zsets.pop(args[0], None)
+            self._strings[args[0]] = str(args[1])
+            if 'PX' in args[2:]:
+                self._expires[args[0]] = time.time() + int(args[args.index('PX') + 1]) / 1000
+            else:
+                self._expires.pop(args[0], None)
+            return 'OK'
+        if command == 'GET':
+            return self._strings.get(args[0])
+        if command == 'DEL':
+            removed = 0
+            for name in args:
+                self._expire_check(name)
+                removed += (self._zsets.pop(name, None) is not None) + (self._strings.pop(name, None) is not None)
+                self._expires.pop(name, None)
+            return removed
+        if command == 'MGET':
+            return [self._strings.get(name) for name in args]
+        raise RedisError(f"FakeRedis 不支持的命令: {command}")
+
+    @staticmethod
+    def _score_bound(bound):
+        bound = str(bound)
+        exclusive = bound.startswith('(')
+        value = float(bound.lstrip('(').replace('+inf', 'inf'))
+
+        def check(score, side):
+            if side == 'min':
+                return score > value if exclusive else score >= value
+            return score < value if exclusive else score <= value
+        return check
+
+
+class RedisStateStore:
+    """
+    多节点共用的 Redis 状态：每个 key 一个有序集合记录窗口内的请求（成员为 “请求ID:token 数”，分数为时间戳），
+    冷却截止时间存成带过期时间的字符串。读取所有 key 的状态是一次流水线往返；
+    预占名额是一个只涉及该 key 的 MULTI 块（清理过期记录、写入、读回窗口和冷却时间），
+    超出限额（被其他节点抢先）时撤销并重选，不依赖 Lua 脚本
+    """
+
+    def __init__(self, client, namespace='gemini-proxy', window=60):
+        self.client = client
+        self.namespace = namespace
+        self.window = window
+
+    def _requests_key(self, key):
+        return f"{self.namespace}:requests:{key}"
+
+    def _cooldown_key(self, key):
+        return f"{self.namespace}:cooldown:{key}"
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+    @staticmethod
+    def _parse_entries(reply):
+        entries = []
+        for member, score in zip(reply[::2], reply[1::2]):
+            entries.append((float(score), int(member.rsplit(':', 1)[1])))
+        return entries
+
+    def load(self, ids, since):
+        commands = []
+        for key in ids:
+            commands.append(('ZREMRANGEBYSCORE', self._requests_key(key), '-inf', since))
+            commands.append(('ZRANGE', self._requests_key(key), 0, -1, 'WITHSCORES'))
+        commands.append(('MGET',) + tuple(self._cooldown_key(key) for key in ids))
+        replies = self.client.pipeline(commands)
+        cooldowns = replies[-1]
+        return {key: KeyState(self._parse_entries(replies[2 * i + 1]), float(cooldowns[i] or 0))
+                for i, key in enumerate(ids)}
+
+    def reserve(self, key, now, tokens, since):
+        entry = new_entry_id(now)
+        name = self._requests_key(key)
+        replies = self.client.pipeline([
+            ('ZREMRANGEBYSCORE', name, '-inf', since),
+            ('ZADD', name, now, f"{entry}:{tokens}"),
+            ('PEXPIRE', name, int(self.window * 1000) + 1000),
+            ('ZRANGE', name, 0, -1, 'WITHSCORES'),
+            ('GET', self._cooldown_key(key)),
+        ], transaction=True)
+        return f"{entry}:{tokens}", KeyState(self._parse_entries(replies[3]), float(replies[4] or 0))
+
+    def release(self, key, entry):
+        self.client.pipeline([('ZREM', self._requests_key(key), entry)])
+
+    def update_tokens(self, key, entry, now, tokens):
+        name = self._requests_key(key)
+        self.client.pipeline([
+            ('ZREM', name, entry),
+            ('ZADD', name, now, f"{entry.rsplit(':', 1)[0]}:{tokens}"),
+        ], transaction=True)
+        return f"{entry.rsplit(':', 1)[0]}:{tokens}"
+
+    def set_cooldown(self, key, until):
+        ttl = int((until - time.time()) * 1000)
+        if ttl > 0:
+            self.client.pipeline([('SET', self._cooldown_key(key), repr(until), 'PX', ttl)])
+
+    def clear_cooldown(self, key):
+        self.client.pipeline([('DEL', self._cooldown_key(key))])
+
+
+class SharedKeyScheduler:
+    """
+    与 KeyScheduler 接口相同，但滑动窗口、token 用量和冷却状态保存在共享存储中，
+    多个 worker / 副本按同一份限额调度。时间使用 time.time()，多节点部署需要同步时钟。
+
+    所有 key 的状态每 SNAPSHOT_TTL 秒才整体读取一次，作为本地快照用于挑选候选 key 和只读查询；
+    取 key 时只对选中的候选 key 做一次原子预占（读回该 key 的真实窗口，超限则换下一个），
+    开销与 key 的数量无关。共享存储不可用时退回进程内调度，保证请求不中断。
+    """
+
+    def __init__(self, api_keys, max_requests, window, max_tokens=0, store=None):
+        self.max_requests = max_requests
+        self.window = window
+        self.max_tokens = max_tokens
+        self.store = store
+        self._keys = list(api_keys)
+        self._ids = {key: key_id(key) for key in self._keys}
+        self._lock = threading.Lock()
+        self._states = {key: EMPTY_STATE for key in self._keys}
+        self._loaded_at = 0.0
+        self._refresh_lock = threading.Lock()
+        # 本进程发出的请求 [时间戳, 存储中的记录 ID, token 数, ticket]，用于按 ticket 修正 token 用量
+        self._own_entries = {key: deque() for key in self._keys}
+        self._fallback = KeyScheduler(self._keys, max_requests, window, max_tokens)
+        self._store_failed = False
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _store_call(self, func, *args):
+        """调用共享存储；失败时记录日志并返回 None，由调用方退回进程内调度"""
+        try:
+            result = func(*args)
+        except (OSError, sqlite3.Error, RedisError) as e:
+            if not self._store_failed:
+                logger.warning(f"共享状态存储不可用，暂时使用进程内调度: {e}")
+            self._store_failed = True
+            return None
+        if self._store_failed:
+            logger.info("共享状态存储已恢复")
+            self._store_failed = False
+        return result
+
+    def _load(self, now):
+        states = self.store.load([self._ids[key] for key in self._keys], now - self.window)
+        self._states = {key: states[self._ids[key]] for key in self._keys}
+        self._loaded_at = now
+        return self._states
+
+    def _snapshot(self, now):
+        """
+        返回所有 key 状态的本地快照，超过 SNAPSHOT_TTL 时重新读取一次共享存储。
+        同一时间只有一个线程去读取，其他线程继续使用旧快照，不在这里排队
+        """
+        if now - self._loaded_at < SNAPSHOT_TTL or not self._refresh_lock.acquire(blocking=False):
+            return self._states
+        try:
+            if now - self._loaded_at < SNAPSHOT_TTL:
+                return self._states
+            return self._load(now)
+        finally:
+            self._refresh_lock.release()
+
+    def _ready_at(self, state, now, tokens):
+        """与 KeyScheduler 相同的规则：请求数、冷却和 token 余额都满足的最早时间"""
+        ready_at = max(state.cooldown_until, now)
+        entries = state.entries
+        if len(entries) >= self.max_requests:
+            ready_at = max(ready_at, entries[len(entries) - self.max_requests][0] + self.window)
+        if self.max_tokens:
+            used = sum(amount for _, amount in entries)
+            excess = used + tokens - self.max_tokens
+            if excess > 0 and used > 0:
+                freed = 0
+                for timestamp, amount in entries:
+                    freed += amount
+                    if freed >= excess or freed >= used:
+                        ready_at = max(ready_at, timestamp + self.window)
+                        break
+        return ready_at
+
+    def _fits(self, entries):
+        """预占后读回的窗口（已包含本次请求）是否仍在限额内"""
+        if len(entries) > self.max_requests:
+            return False
+        if self.max_tokens and len(entries) > 1 and sum(amount for _, amount in entries) > self.max_tokens:
+            return False
+        return True
+
+    def _candidates(self, states, now, tokens, exclude):
+        """
+        按快照列出现在就有余量的 key，最久没被使用的在前；
+        返回 (候选列表, 没有候选时最早可用还需等待的秒数)
+        """
+        ready, wait = [], None
+        for key in self._keys:
+            if key in exclude:
+                continue
+            state = states[key]
+            ready_at = self._ready_at(state, now, tokens)
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                continue
+            ready.append((state.entries[-1][0] if state.entries else 0, key))
+        ready.sort(key=lambda item: item[0])
+        return [key for _, key in ready], wait
+
+    def _reserve(self, key, now, tokens, ticket):
+        """原子地预占一个 key 的名额（只读写这一个 key），成功返回 True；超出限额或正在冷却时撤销预占"""
+        with self.store.transaction():
+            entry, state = self.store.reserve(self._ids[key], now, tokens, now - self.window)
+            if self._fits(state.entries) and state.cooldown_until <= now:
+                self._record_own(key, now, entry, tokens, ticket)
+                self._states[key] = state
+                return True
+            # 其他进程在上次读取快照之后用掉了这个 key 的名额，或者让它进入了冷却
+            self.store.release(self._ids[key], entry)
+        entries = list(state.entries)
+        if (now, tokens) in entries:
+            entries.remove((now, tokens))
+        self._states[key] = KeyState(entries, state.cooldown_until)
+        return False
+
+    def _acquire(self, exclude, tokens, ticket):
+        now = time.time()
+        candidates, wait = self._candidates(self._snapshot(now), now, tokens, exclude)
+        if not candidates:
+            # 快照可能已经过时（其他进程释放了名额），最晚在快照过期、重新读取后再试
+            if wait is not None:
+                wait = min(wait, max(self._loaded_at + SNAPSHOT_TTL - now, 0.01))
+            return None, wait
+        for key in candidates[:RESERVE_ATTEMPTS]:
+            if self._reserve(key, now, tokens, ticket):
+                return key, 0
+        # 快照与共享存储差别较大，下次取 key 时重新读取
+        self._loaded_at = 0.0
+        return None, 0.05
+
+    def _record_own(self, key, now, entry, tokens, ticket):
+        with self._lock:
+            own = self._own_entries[key]
+            while own and own[0][0] <= now - self.window:
+                own.popleft()
+            if self.max_tokens:
+                own.append([now, entry, tokens, ticket])
+
+    def acquire(self, exclude=(), tokens=0, ticket=None):
+        """返回 (key, 0)、(None, 最早可用还需等待的秒数) 或 (None, None)，语义同 KeyScheduler.acquire"""
+        if not any(key not in exclude for key in self._keys):
+            return None, None
+        result = self._store_call(self._acquire, exclude, tokens, ticket)
+        if result is None:
+            return self._fallback.acquire(exclude, tokens, ticket)
+        return result
+
+    def try_acquire(self, key, tokens=0, ticket=None):
+        if key not in self._ids:
+            return False
+        now = time.time()
+        states = self._store_call(self._snapshot, now)
+        if states is None:
+            return self._fallback.try_acquire(key, tokens, ticket)
+        if self._ready_at(states[key], now, tokens) > now:
+            return False
+        result = self._store_call(self._reserve, key, now, tokens, ticket)
+        if result is None:
+            return self._fallback.try_acquire(key, tokens, ticket)
+        return result
+
+    def adjust_tokens(self, key, ticket, actual):
+        """按 ticket 找到本进程记下的那条记录并修正共享存储中的 token 数，语义同 KeyScheduler.adjust_tokens"""
+        if not self.max_tokens or ticket is None:
+            return
+        with self._lock:
+            own = self._own_entries.get(key) or ()
+            match = next((item for item in reversed(own) if item[3] == ticket), None)
+            if match is not None and match[2] != actual:
+                match[2] = actual
+                entry = self._store_call(self.store.update_tokens, self._ids[key], match[1], match[0], actual)
+                if entry is not None:
+                    match[1] = entry
+        # 存储不可用期间由进程内调度发出的请求记在 fallback 中
+        self._fallback.adjust_tokens(key, ticket, actual)
+
+    def next_available_in(self, exclude=()):
+        """按本地快照计算（最多 SNAPSHOT_TTL 秒前的状态），不在每次调用时读取共享存储"""
+        now = time.time()
+        states = self._store_call(self._snapshot, now)
+        if states is None:
+            return self._fallback.next_available_in(exclude)
+        waits = [self._ready_at(states[key], now, 1) - now for key in self._keys if key not in exclude]
+        return max(min(waits), 0) if waits else None
+
+    def cooldown(self, key, seconds):
+        if key not in self._ids:
+            return
+        until = time.time() + seconds
+        self._fallback.cooldown(key, seconds)
+        state = self._states[key]
+        self._states[key] = KeyState(state.entries, max(state.cooldown_until, until))
+        self._store_call(self.store.set_cooldown, self._ids[key], until)
+
+    def reinstate(self, key):
+        if key not in self._ids:
+            return
+        self._fallback.reinstate(key)
+        state = self._states[key]
+        self._states[key] = KeyState(state.entries, 0.0)
+        self._store_call(self.store.clear_cooldown, self._ids[key])
+
+    def is_saturated(self, key):
+        state = self._states.get(key)
+        return state is not None and len(state.entries) >= self.max_requests
+
+    def cooling_down_count(self):
+        now = time.time()
+        return sum(1 for state in self._states.values() if state.cooldown_until > now)
+
+    def is_cooling_down(self, key):
+        state = self._states.get(key)
+        return state is not None and state.cooldown_until > time.time()
+
+
+def create_key_scheduler(api_keys, max_requests, window, max_tokens=0, backend=None):
+    """
+    按 StateBackend 配置创建调度器：
+    为空或 memory 时使用进程内的 KeyScheduler；
+    sqlite:///路径 供同一台机器上的多个 worker 共用；
+    redis://[:密码@]主机:端口/库号 供多个节点共用；fake://名称 为进程内的 Redis 替身，用于测试
+    """
+    if not backend or backend == 'memory':
+        return KeyScheduler(api_keys, max_requests, window, max_tokens)
+
+    parsed = urlparse(backend)
+    if parsed.scheme == 'sqlite':
+        # 与 SQLAlchemy 相同：sqlite:///state.db 为相对路径，sqlite:////var/lib/state.db 为绝对路径
+        store = SqliteStateStore(unquote(backend[len('sqlite:///'):]))
+    elif parsed.scheme in ('redis', 'fake'):
+        client = RedisClient(backend) if parsed.scheme == 'redis' else FakeRedis.named(parsed.netloc or 'default')
+        store = RedisStateStore(client, window=window)
+    else:
+        raise ValueError(f"不支持的 StateBackend: {backend}")
+    return SharedKeyScheduler(api_keys, max_requests, window, max_tokens, store)
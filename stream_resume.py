@@ -0,0 +1,66 @@
+def chunk_text(chunk):
+    """分块没有文本（如只带结束原因或用量）时返回空字符串，不抛出异常"""
+    try:
+        return chunk.text or ''
+    except Exception:
+        return ''
+
+
+def continuation_contents(gemini_history, user_message, partial_text):
+    """续写请求：原对话加上已经输出的部分作为 model 回复的开头，上游从该处继续生成"""
+    return list(gemini_history) + [user_message, {"role": "model", "parts": [partial_text]}]
+
+
+class ResumableStream:
+    """
+    包装上游的流式响应（同步版本），记录已经收到的文本。上游中途断开时调用
+    resume(已收到的文本, 异常) 取得从该处继续生成的新响应并接着输出，
+    迭代方看到的是一条不间断的流；resume 返回 None 或续写次数用完时原样抛出异常。
+    """
+
+    def __init__(self, response, resume, max_resumes=2):
+        self.response = response
+        self.resume = resume
+        self.max_resumes = max_resumes
+        self.resumes = 0
+
+    def __iter__(self):
+        texts = []
+        response = self.response
+        while True:
+            try:
+                for chunk in response:
+                    texts.append(chunk_text(chunk))
+                    yield chunk
+                return
+            except Exception as e:
+                if self.resumes >= self.max_resumes:
+                    raise
+                response = self.resume(''.join(texts), e)
+                if response is None:
+                    raise
+                self.resumes += 1
+
+
+class AsyncResumableStream(ResumableStream):
+    """异步版本，resume 为协程函数"""
+
+    def __iter__(self):
+        raise TypeError("AsyncResumableStream 只能用 async for 迭代")
+
+    async def __aiter__(self):
+        texts = []
+        response = self.response
+        while True:
+            try:
+                async for chunk in response:
+                    texts.append(chunk_text(chunk))
+                    yield chunk
+                return
+            except Exception as e:
+                if self.resumes >= self.max_resumes:
+                    raise
+                response = await self.resume(''.join(texts), e)
+                if response is None:
+                    raise
+                self.resumes += 1
@@ -0,0 +1,54 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 模块都在仓库根目录下（不是包），mock_upstream 在 benchmarks 目录下
+for path in (ROOT, os.path.join(ROOT, "benchmarks")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture(scope="session")
+def upstream():
+    import mock_upstream
+    from harness import KEYS, MockGemini
+
+    mock = MockGemini(chunks=8, chunk_interval=0.01)
+    server, port = mock_upstream.start(mock)
+    os.environ.update(
+        KeyArray="\n".join(KEYS), password="test-password", UpstreamEndpoint=f"http://127.0.0.1:{port}",
+        MaxRequests="1000", ResponseCacheTTL="0", ModelCatalogTTL="0", CoalesceRequests="true",
+    )
+    yield mock
+    server.stop(0)
+
+
+@pytest.fixture
+def mock(upstream):
+    upstream.reset()
+    return upstream
+
+
+@pytest.fixture(scope="session")
+def proxy(upstream):
+    # 配置在导入时读取，必须在模拟上游启动、环境变量设置之后导入；app 在整个测试进程中只导入一次
+    import app
+    return app
+
+
+@pytest.fixture(scope="session")
+def asgi_app(proxy):
+    import asgi
+    return asgi.app
+
+
+@pytest.fixture(scope="session")
+def loop():
+    # 异步的上游客户端按 key 缓存并绑定在创建它的事件循环上，与实际运行时一样所有请求共用一个循环
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
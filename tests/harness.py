@@ -0,0 +1,127 @@
+"""端到端测试共用的模拟上游和请求工具，fixture 见 conftest.py"""
+import asyncio
+import json
+import threading
+import time
+
+import grpc
+import httpx
+
+import mock_upstream
+
+KEYS = ["AIzaSy" + c * 35 for c in "AB"]
+HEADERS = {"Authorization": "Bearer test-password"}
+
+
+class MockGemini(mock_upstream.MockGemini):
+    """
+    可以指定接下来的若干次流式调用在中途断开、个别 key 的额外延迟和模型列表，以及让创建上下文缓存失败；
+    记录收到的生成请求，引用不存在的 cachedContents 时与官方一样返回 NOT_FOUND
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.disconnects = 0
+        self.key_latency = {}
+        self.key_models = {}
+        self.fail_cache_creation = False
+        self.requests = []
+
+    def reset(self):
+        self.latency, self.disconnects = 0.0, 0
+        self.errors, self.key_latency, self.key_models = {}, {}, {}
+        self.fail_cache_creation = False
+        self.models = mock_upstream.DEFAULT_MODELS
+        self.calls.clear()
+        self.calls_by_key.clear()
+        self.requests.clear()
+
+    def generate_content(self, request, context):
+        self.requests.append(request)
+        if request.cached_content and request.cached_content not in self.caches:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"{request.cached_content} not found")
+        return super().generate_content(request, context)
+
+    def list_models(self, request, context):
+        api_key = dict(context.invocation_metadata()).get("x-goog-api-key", "")
+        models = self.key_models.get(api_key, self.models)
+        return mock_upstream.types.ListModelsResponse(models=[self._model(name) for name in models])
+
+    def create_cached_content(self, request, context):
+        if self.fail_cache_creation:
+            context.abort(grpc.StatusCode.INTERNAL, "mock upstream injected cache failure")
+        return super().create_cached_content(request, context)
+
+    def _begin(self, method, context):
+        api_key = dict(context.invocation_metadata()).get("x-goog-api-key", "")
+        if self.key_latency.get(api_key):
+            time.sleep(self.key_latency[api_key])
+        result = super()._begin(method, context)
+        if method == "StreamGenerateContent" and self.disconnects > 0:
+            self.disconnects -= 1
+            return "midstream"
+        return result
+
+
+def chat_body(stream, temperature=0, user=None):
+    body = {"model": "gemini-1.5-flash", "messages": [{"role": "user", "content": "hi"}],
+            "stream": stream, "temperature": temperature}
+    if user:
+        body["user"] = user
+    return body
+
+
+def stream_text(data):
+    """拼出 SSE 流中的全部文本；错误事件记为 <error>"""
+    text = ""
+    for line in data.decode("utf-8").splitlines():
+        if not line.startswith("data: {"):
+            continue
+        event = json.loads(line[6:])
+        if "choices" in event:
+            text += event["choices"][0]["delta"].get("content") or ""
+        else:
+            text += "<error>"
+    return text
+
+
+def upstream_calls(mock, method):
+    return sum(count for (name, _), count in mock.calls.items() if name == method)
+
+
+def post_concurrently(proxy, bodies):
+    client = proxy.app.test_client()
+    results = [None] * len(bodies)
+
+    def send(index):
+        response = client.post("/v1/chat/completions", json=bodies[index], headers=HEADERS)
+        results[index] = (response.status_code, response.data)
+
+    threads = [threading.Thread(target=send, args=(index,)) for index in range(len(bodies))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def asgi_post_concurrently(loop, asgi_app, bodies):
+    async def main():
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as client:
+            responses = await asyncio.gather(*(client.post("/v1/chat/completions", json=body, headers=HEADERS)
+                                               for body in bodies))
+        return [(response.status_code, response.content) for response in responses]
+
+    return loop.run_until_complete(main())
+
+
+
+
+def asgi_request(loop, asgi_app, method, url, **kwargs):
+    async def main():
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as client:
+            return await client.request(method, url, **kwargs)
+
+    return loop.run_until_complete(main())
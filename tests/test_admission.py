@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+
+from admission import AdmissionQueue
+
+
+class Keys:
+    """acquire 的替身：available 个名额用完后返回 (None, wait)"""
+
+    def __init__(self, available=0, wait=5.0):
+        self.available = available
+        self.wait = wait
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.available:
+                self.available -= 1
+                return "key", 0
+        return None, self.wait
+
+    def release(self, queue):
+        with self.lock:
+            self.available += 1
+        queue.notify()
+
+
+def test_key_available_immediately():
+    queue = AdmissionQueue(max_size=10, max_wait=5)
+    assert queue.admit("client", Keys(available=1).acquire) == ("key", None)
+
+
+def test_no_keys_at_all():
+    queue = AdmissionQueue(max_size=10, max_wait=5)
+    assert queue.admit("client", lambda: (None, None)) == (None, None)
+
+
+def test_deadline_returns_retry_after():
+    queue = AdmissionQueue(max_size=10, max_wait=5)
+    start = time.monotonic()
+    key, retry_after = queue.admit("client", Keys(wait=30).acquire, max_wait=0.1)
+    assert key is None
+    assert retry_after >= 1
+    assert 0.1 <= time.monotonic() - start < 1
+    assert len(queue) == 0
+
+
+def test_full_queue_rejects_without_waiting():
+    queue = AdmissionQueue(max_size=0, max_wait=5)
+    start = time.monotonic()
+    assert queue.admit("client", Keys(wait=3).acquire) == (None, 3)
+    assert time.monotonic() - start < 0.1
+
+
+def test_waiter_is_served_when_a_key_frees_up():
+    queue = AdmissionQueue(max_size=10, max_wait=5)
+    keys = Keys(wait=0.05)
+    threading.Timer(0.05, keys.release, args=(queue,)).start()
+    assert queue.admit("client", keys.acquire) == ("key", None)
+
+
+def test_async_deadline_and_cancel():
+    queue = AdmissionQueue(max_size=10, max_wait=5)
+
+    async def main():
+        key, retry_after = await queue.admit_async("client", Keys(wait=30).acquire, max_wait=0.1)
+        assert key is None and retry_after >= 1
+
+        task = asyncio.ensure_future(queue.admit_async("client", Keys(wait=30).acquire))
+        await asyncio.sleep(0.05)
+        assert len(queue) == 1
+        task.cancel()
+        await asyncio.sleep(0)
+        assert len(queue) == 0
+
+    asyncio.run(main())
+
+
+def test_offload_runs_first_attempt_off_the_loop():
+    queue = AdmissionQueue(max_size=10, max_wait=5, offload=True)
+    threads = []
+
+    def acquire():
+        threads.append(threading.current_thread())
+        return "key", 0
+
+    async def main():
+        return await queue.admit_async("client", acquire)
+
+    assert asyncio.run(main()) == ("key", None)
+    assert threads[0] is not threading.main_thread()
@@ -0,0 +1,71 @@
+import os
+import socket
+
+import pytest
+
+import mock_upstream
+from client_pool import UpstreamClientPool
+from harness import KEYS, MockGemini
+
+GENERATION_CONFIG = {"temperature": 0.0}
+
+
+def non_loopback_address():
+    # UDP 的 connect 不发送数据，只借路由表选出本机对外的地址
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.connect(("192.0.2.1", 80))
+        except OSError:
+            return None
+        address = sock.getsockname()[0]
+    return None if address.startswith("127.") else address
+
+
+def test_clients_are_reused_per_key(mock):
+    pool = UpstreamClientPool(endpoint=os.environ["UpstreamEndpoint"])
+
+    first = pool.get_client(KEYS[0])
+    assert pool.get_client(KEYS[0]) is first
+    assert pool.get_client(KEYS[1]) is not first
+    assert pool.get_client(KEYS[0], service="model") is not first
+
+    for key in (KEYS[0], KEYS[0], KEYS[1]):
+        pool.get_model(key, "gemini-1.5-flash", GENERATION_CONFIG, None).generate_content("hi")
+    # 每个请求都带着所选 key 的元数据，而不是最后一次配置的全局 key
+    assert mock.calls_by_key == {KEYS[0]: 2, KEYS[1]: 1}
+
+
+def test_models_are_evicted_least_recently_used_first(upstream):
+    pool = UpstreamClientPool(endpoint=os.environ["UpstreamEndpoint"], max_models=2)
+
+    flash = pool.get_model(KEYS[0], "gemini-1.5-flash", GENERATION_CONFIG, None)
+    pro = pool.get_model(KEYS[0], "gemini-1.5-pro", GENERATION_CONFIG, None)
+    assert pool.get_model(KEYS[0], "gemini-1.5-flash", GENERATION_CONFIG, None) is flash
+    pool.get_model(KEYS[1], "gemini-1.5-flash", GENERATION_CONFIG, None)
+
+    assert len(pool._models) == 2
+    assert pool.get_model(KEYS[0], "gemini-1.5-flash", GENERATION_CONFIG, None) is flash
+    assert pool.get_model(KEYS[0], "gemini-1.5-pro", GENERATION_CONFIG, None) is not pro
+    assert pool.get_model(KEYS[0], "gemini-1.5-flash", GENERATION_CONFIG, None, cached_content="cachedContents/1") is not flash
+
+
+def test_plaintext_endpoint_on_a_non_loopback_address(loop):
+    address = non_loopback_address()
+    if address is None:
+        pytest.skip("没有非回环地址")
+    mock = MockGemini(chunks=2)
+    server, port = mock_upstream.start(mock, host=address)
+    try:
+        pool = UpstreamClientPool(endpoint=f"http://{address}:{port}")
+        model = pool.get_model(KEYS[0], "gemini-1.5-flash", GENERATION_CONFIG, None)
+        assert model.generate_content("hi").text
+
+        async def stream():
+            gen_model = pool.get_model(KEYS[1], "gemini-1.5-flash", GENERATION_CONFIG, None, use_async=True)
+            response = await gen_model.generate_content_async("hi", stream=True)
+            return [chunk.text async for chunk in response]
+
+        assert len(loop.run_until_complete(stream())) == 2
+        assert mock.calls_by_key == {KEYS[0]: 1, KEYS[1]: 1}
+    finally:
+        server.stop(0)
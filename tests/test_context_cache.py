@@ -0,0 +1,88 @@
+"""上下文缓存：相同的长前缀第二次出现时创建 cachedContents，之后只发送前缀之后的消息"""
+import uuid
+
+import pytest
+
+from harness import HEADERS, upstream_calls
+
+
+@pytest.fixture
+def context_cache(proxy, monkeypatch):
+    cache = proxy.context_cache
+    monkeypatch.setattr(cache, "enabled", True)
+    monkeypatch.setattr(cache, "min_bytes", 4096)
+    monkeypatch.setattr(cache, "min_reuse", 2)
+    return cache
+
+
+def conversation(question):
+    """每个测试用不同的长前缀，互不影响前缀计数"""
+    prefix = f"{uuid.uuid4()} " + "long shared system prompt " * 400
+    return lambda q=question: {
+        "model": "gemini-1.5-flash", "temperature": 0.7, "stream": False,
+        "messages": [{"role": "user", "content": prefix}, {"role": "assistant", "content": "ok"},
+                     {"role": "user", "content": q}],
+    }
+
+
+def send(proxy, body):
+    response = proxy.app.test_client().post("/v1/chat/completions", json=body, headers=HEADERS)
+    assert response.status_code == 200
+    return response
+
+
+def sent_texts(request):
+    return [part.text for content in request.contents for part in content.parts]
+
+
+def test_second_request_sends_only_the_suffix(proxy, mock, context_cache):
+    body = conversation("first")
+    send(proxy, body())
+    assert not mock.requests[-1].cached_content and len(mock.requests[-1].contents) == 3
+
+    send(proxy, body("second"))
+    request = mock.requests[-1]
+    assert request.cached_content.startswith("cachedContents/")
+    assert sent_texts(request) == ["second"]
+    # 缓存的正是前两条消息
+    assert len(mock.caches[request.cached_content].contents) == 2
+    assert upstream_calls(mock, "GenerateContent") == 2
+
+
+def test_expired_handle_is_replaced(proxy, mock, context_cache):
+    body = conversation("q")
+    send(proxy, body())
+    send(proxy, body())
+    first_name = mock.requests[-1].cached_content
+    for handle in list(context_cache._handles.values()):
+        handle.expires_at = 0
+
+    send(proxy, body())
+    request = mock.requests[-1]
+    assert request.cached_content.startswith("cachedContents/") and request.cached_content != first_name
+    assert sent_texts(request) == ["q"]
+
+
+def test_stale_cache_falls_back_and_recreates(proxy, mock, context_cache):
+    body = conversation("q")
+    send(proxy, body())
+    send(proxy, body())
+    stale = mock.requests[-1].cached_content
+    # 上游已经删除了该缓存（例如过期），第一次尝试返回 NOT_FOUND，代理丢弃条目后重试
+    mock.caches.pop(stale)
+    mock.requests.clear()
+
+    send(proxy, body())
+    assert mock.requests[0].cached_content == stale
+    assert mock.requests[-1].cached_content != stale
+    assert all(handle.name != stale for handle in context_cache._handles.values())
+
+
+def test_failed_creation_sends_the_full_history(proxy, mock, context_cache):
+    mock.fail_cache_creation = True
+    body = conversation("q")
+    send(proxy, body())
+    send(proxy, body())
+    request = mock.requests[-1]
+    assert not request.cached_content and len(request.contents) == 3
+
@@ -0,0 +1,105 @@
+import base64
+import struct
+import threading
+
+import pytest
+
+from embedding_batcher import EmbeddingBatcher, EmbeddingError
+from harness import HEADERS, upstream_calls
+
+
+class Recorder:
+    """embed_batch 的替身：记录每一批的文本，返回 [文本长度]；设置 error 时整批失败"""
+
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def __call__(self, group, texts):
+        self.batches.append((group, list(texts)))
+        if self.error is not None:
+            raise self.error
+        return [[float(len(text))] for text in texts]
+
+
+def test_batches_are_split_at_max_batch():
+    recorder = Recorder()
+    batcher = EmbeddingBatcher(recorder, window=0.05, max_batch=3)
+    futures = [batcher.submit(("m", None), "x" * n) for n in range(1, 8)]
+    assert [future.result(timeout=2) for future in futures] == [[float(n)] for n in range(1, 8)]
+    assert sorted(len(texts) for _, texts in recorder.batches) == [1, 3, 3]
+
+
+def test_groups_are_not_mixed():
+    recorder = Recorder()
+    batcher = EmbeddingBatcher(recorder, window=0.05)
+    futures = [batcher.submit(group, "text") for group in (("a", None), ("b", None), ("a", 256))]
+    for future in futures:
+        future.result(timeout=2)
+    assert sorted(str(group) for group, _ in recorder.batches) == ["('a', 256)", "('a', None)", "('b', None)"]
+
+
+def test_batch_error_reaches_every_waiter():
+    error = EmbeddingError({"error": {"message": "boom"}}, 503, {"Retry-After": "3"})
+    batcher = EmbeddingBatcher(Recorder(error), window=0.05)
+    futures = [batcher.submit(("m", None), text) for text in ("a", "b", "c")]
+    for future in futures:
+        with pytest.raises(EmbeddingError) as info:
+            future.result(timeout=2)
+        assert info.value is error
+
+
+def test_wrong_number_of_vectors_fails_the_batch():
+    batcher = EmbeddingBatcher(lambda group, texts: [[0.0]], window=0.01)
+    futures = [batcher.submit(("m", None), text) for text in ("a", "b")]
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(timeout=2)
+
+
+def embed(client, inputs, **kwargs):
+    response = client.post("/v1/embeddings", json={"model": "text-embedding-004", "input": inputs, **kwargs},
+                           headers=HEADERS)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_concurrent_requests_share_one_upstream_call(proxy, mock, monkeypatch):
+    monkeypatch.setattr(proxy.embedding_batcher, "window", 0.2)
+    client = proxy.app.test_client()
+    inputs = [[f"text {i}-{j}" for j in range(i + 1)] for i in range(4)]
+    results = [None] * len(inputs)
+
+    def send(index):
+        results[index] = embed(client, inputs[index])
+
+    threads = [threading.Thread(target=send, args=(index,)) for index in range(len(inputs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert upstream_calls(mock, "BatchEmbedContents") == 1
+
+    # 拆回各请求的结果与单独请求每条输入的结果相同，且顺序一致
+    monkeypatch.setattr(proxy.embedding_batcher, "window", 0.0)
+    for texts, result in zip(inputs, results):
+        assert [item["index"] for item in result["data"]] == list(range(len(texts)))
+        assert [item["embedding"] for item in result["data"]] == \
+               [embed(client, text)["data"][0]["embedding"] for text in texts]
+
+
+def test_base64_encoding_matches_float(proxy, mock):
+    client = proxy.app.test_client()
+    floats = embed(client, ["hello"])["data"][0]["embedding"]
+    encoded = embed(client, ["hello"], encoding_format="base64")["data"][0]["embedding"]
+    data = base64.b64decode(encoded)
+    decoded = struct.unpack(f"<{len(data) // 4}f", data)
+    assert len(decoded) == len(floats)
+    assert all(abs(a - b) < 1e-6 for a, b in zip(decoded, floats))
+
+
+def test_invalid_embedding_request_is_rejected(proxy):
+    client = proxy.app.test_client()
+    for body in ({"input": []}, {"input": [1, 2]}, {"input": "x", "encoding_format": "int8"},
+                 {"input": "x", "dimensions": 0}):
+        assert client.post("/v1/embeddings", json=body, headers=HEADERS).status_code == 400
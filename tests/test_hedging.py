@@ -0,0 +1,103 @@
+"""对冲请求：在模拟上游上给主 key 加延迟，检查对冲发出、先成功者胜出，以及对冲预算"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from harness import KEYS
+from hedging import HedgePolicy, async_hedged_call, hedged_call
+from retry_policy import RetryBudget
+
+SLOW, FAST = KEYS
+
+
+def new_policy(ratio):
+    budget = RetryBudget(ratio=ratio, min_per_second=0, max_tokens=10, initial_tokens=0)
+    return HedgePolicy(["gemini-1.5-flash"], 95, 0.05, 0.05, budget)
+
+
+def sync_request(proxy, finished):
+    def do_request(key):
+        model = proxy.client_pool.get_model(key, "gemini-1.5-flash", {}, proxy.safety_settings)
+        response = model.generate_content("hi")
+        finished.append(key)
+        return 1, (key, response.text), 0
+    return do_request
+
+
+def async_request(proxy, finished):
+    async def do_request(key):
+        model = proxy.client_pool.get_model(key, "gemini-1.5-flash", {}, proxy.safety_settings, use_async=True)
+        response = await model.generate_content_async("hi")
+        finished.append(key)
+        return 1, (key, response.text), 0
+    return do_request
+
+
+def test_hedge_wins_when_the_primary_is_slow(proxy, mock):
+    mock.key_latency = {SLOW: 1.0}
+    finished, hedged = [], []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        start = time.monotonic()
+        success, (key, text), _ = hedged_call(executor, sync_request(proxy, finished), SLOW,
+                                              lambda: hedged.append(FAST) or FAST, 0.1)
+        elapsed = time.monotonic() - start
+        assert (success, key, hedged) == (1, FAST, [FAST])
+        assert text and elapsed < 0.8
+    # 同步调用无法中断，落败的一方执行完后结果被丢弃
+    assert finished == [FAST, SLOW]
+
+
+def test_no_hedge_when_the_primary_answers_in_time(proxy, mock):
+    finished, hedged = [], []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        success, (key, _), _ = hedged_call(executor, sync_request(proxy, finished), FAST,
+                                           lambda: hedged.append(SLOW) or SLOW, 0.5)
+    assert (success, key, hedged, finished) == (1, FAST, [], [FAST])
+
+
+def test_hedge_without_budget_waits_for_the_primary(proxy, mock):
+    mock.key_latency = {SLOW: 0.3}
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        success, (key, _), _ = hedged_call(executor, sync_request(proxy, []), SLOW, lambda: None, 0.05)
+    assert (success, key) == (1, SLOW)
+
+
+def test_async_hedge_cancels_the_loser(loop, proxy, mock):
+    mock.key_latency = {SLOW: 1.0}
+    finished = []
+    start = time.monotonic()
+    success, (key, _), _ = loop.run_until_complete(
+        async_hedged_call(async_request(proxy, finished), SLOW, lambda: FAST, 0.1))
+    assert (success, key) == (1, FAST)
+    assert time.monotonic() - start < 0.8
+    # 落败的协程已被取消，不会再返回结果
+    loop.run_until_complete(asyncio.sleep(1.0))
+    assert finished == [FAST]
+
+
+def test_budget_caps_hedges_relative_to_requests():
+    policy = new_policy(0.1)
+    hedges = 0
+    for _ in range(200):
+        assert policy.start("gemini-1.5-flash", {})
+        hedges += policy.allow_hedge()
+    # 令牌按浮点数累积，允许一次误差
+    assert 19 <= hedges <= 20
+
+    # 没有开启对冲的请求不累积预算
+    policy = new_policy(0.1)
+    for _ in range(200):
+        assert not policy.start("gemini-1.5-pro", {})
+    assert not policy.allow_hedge()
+
+
+def test_zero_budget_never_hedges():
+    policy = new_policy(0)
+    for _ in range(100):
+        policy.start("gemini-1.5-flash", {"hedge": True})
+        assert not policy.allow_hedge()
+
+
+def test_app_hedge_budget_starts_empty(proxy):
+    assert proxy.hedge_policy.budget.ratio == proxy.HEDGE_BUDGET == 0.1
+    assert not proxy.hedge_policy.allow_hedge()
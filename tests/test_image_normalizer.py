@@ -0,0 +1,88 @@
+from io import BytesIO
+import random
+
+import pytest
+
+from media_store import ImageNormalizer
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def normalize_image(proxy):
+    # func 在导入时读取 password，须等 conftest 设置好环境变量后再通过 app 导入
+    return proxy.func.normalize_image
+
+
+def encode(image, image_format, **kwargs):
+    output = BytesIO()
+    image.save(output, format=image_format, **kwargs)
+    return output.getvalue()
+
+
+def noise_image(width, height):
+    # 随机噪声几乎不可压缩，缩小后的编码结果一定明显变小
+    return Image.frombytes("RGB", (width, height), random.Random(width * height).randbytes(width * height * 3))
+
+
+def test_large_image_is_downscaled_and_reencoded(normalize_image):
+    data = encode(noise_image(800, 600), "PNG")
+
+    mime_type, output = normalize_image(data, max_pixels=120000)
+
+    assert mime_type == "image/webp"
+    assert len(output) < len(data)
+    image = Image.open(BytesIO(output))
+    assert image.format == "WEBP"
+    assert image.width * image.height <= 120000
+    assert abs(image.width / image.height - 800 / 600) < 0.01
+
+
+def test_image_under_the_limit_keeps_its_size(normalize_image):
+    data = encode(noise_image(200, 100), "PNG")
+
+    mime_type, output = normalize_image(data, max_pixels=120000, image_format="JPEG")
+
+    assert mime_type == "image/jpeg"
+    assert Image.open(BytesIO(output)).size == (200, 100)
+
+
+def test_reencoding_that_does_not_shrink_keeps_the_original(normalize_image):
+    data = encode(Image.new("RGB", (64, 64), (255, 0, 0)), "PNG")
+
+    assert normalize_image(data, max_pixels=120000, image_format="PNG") is None
+
+
+def test_exif_orientation_is_applied_and_stripped(normalize_image):
+    exif = Image.Exif()
+    exif[0x0112] = 6  # 顺时针旋转 90 度后显示
+    data = encode(noise_image(300, 200), "JPEG", exif=exif, quality=100)
+
+    mime_type, output = normalize_image(data, max_pixels=1000000, image_format="JPEG", quality=50)
+
+    image = Image.open(BytesIO(output))
+    assert image.size == (200, 300)
+    assert 0x0112 not in image.getexif()
+
+
+def test_animated_image_is_left_alone(normalize_image):
+    frames = [noise_image(64, 64), Image.new("RGB", (64, 64))]
+    output = BytesIO()
+    frames[0].save(output, format="GIF", save_all=True, append_images=frames[1:])
+
+    assert normalize_image(output.getvalue(), max_pixels=100) is None
+
+
+def test_normalizer_falls_back_to_the_original_when_pillow_fails(normalize_image):
+    normalizer = ImageNormalizer(normalize_image, max_pixels=120000, workers=1)
+    try:
+        assert normalizer("image/png", b"not an image") == ("image/png", b"not an image")
+
+        data = encode(noise_image(800, 600), "PNG")
+        mime_type, output = normalizer("image/png", data)
+        assert mime_type == "image/webp"
+        assert len(output) < len(data)
+
+        assert normalizer("application/pdf", data) == ("application/pdf", data)
+    finally:
+        normalizer.shutdown()
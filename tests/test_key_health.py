@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+
+from google.api_core import exceptions
+
+from key_health import KeyHealth
+from key_scheduler import KeyScheduler
+from retry_policy import RetryBudget, RetryPolicy, load_error_policy
+
+KEYS = ["key-a", "key-b"]
+POLICY = RetryPolicy(3, 30, load_error_policy(None), RetryBudget())
+
+
+def make_health(probe=lambda key: None, path=None):
+    scheduler = KeyScheduler(KEYS, max_requests=10, window=60)
+    classify = lambda error: POLICY.rule_for(error)[0]
+    return scheduler, KeyHealth(scheduler, probe, classify, probe_interval=0, path=path)
+
+
+def fail(health, scheduler, key, error_name):
+    duration = health.record_failure(key, error_name, POLICY.error_policy[error_name])
+    scheduler.cooldown(key, duration)
+    return duration
+
+
+def test_cooldown_doubles_for_repeated_errors():
+    scheduler, health = make_health()
+    assert [fail(health, scheduler, "key-a", "PermissionDenied") for _ in range(3)] == [60, 120, 240]
+    # 换了错误类型重新计数，成功一次后清零
+    assert fail(health, scheduler, "key-a", "ResourceExhausted") == 10
+    health.record_success("key-a")
+    assert fail(health, scheduler, "key-a", "ResourceExhausted") == 10
+
+
+def test_probe_reinstates_or_retires():
+    results = {"key-a": None, "key-b": exceptions.PermissionDenied("revoked")}
+
+    def probe(key):
+        if results[key] is not None:
+            raise results[key]
+
+    scheduler, health = make_health(probe)
+    for key in KEYS:
+        fail(health, scheduler, key, "PermissionDenied")
+    assert health.probe_due() == {"key-a": "reinstated", "key-b": "retired"}
+    assert not scheduler.is_cooling_down("key-a")
+    assert scheduler.is_cooling_down("key-b")
+    assert health.retired_count() == 1
+
+
+def test_state_survives_restart(tmp_path):
+    path = str(tmp_path / "keys.json")
+    scheduler, health = make_health(path=path)
+    fail(health, scheduler, "key-a", "PermissionDenied")
+    health.save()
+
+    scheduler, restored = make_health(path=path)
+    restored.restore(KEYS)
+    assert scheduler.is_cooling_down("key-a")
+    assert not scheduler.is_cooling_down("key-b")
+    assert "key-a" not in open(path, encoding="utf-8").read()
+
+
+def test_concurrent_saves_never_leave_a_partial_file(tmp_path):
+    path = str(tmp_path / "keys.json")
+    healths = [make_health(path=path) for _ in range(4)]
+
+    def save(scheduler, health):
+        for _ in range(50):
+            fail(health, scheduler, "key-a", "ResourceExhausted")
+            health.save()
+            with open(path, encoding="utf-8") as f:
+                assert json.load(f)["version"] == 1
+
+    threads = [threading.Thread(target=save, args=pair) for pair in healths]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert os.listdir(tmp_path) == ["keys.json"]
@@ -0,0 +1,84 @@
+import time
+
+from key_scheduler import KeyScheduler
+
+KEYS = ["key-a", "key-b"]
+
+
+def test_window_limits_requests_per_key():
+    scheduler = KeyScheduler(KEYS, max_requests=2, window=0.2)
+    issued = [scheduler.acquire()[0] for _ in range(4)]
+    assert sorted(issued) == ["key-a", "key-a", "key-b", "key-b"]
+
+    key, wait = scheduler.acquire()
+    assert key is None
+    assert 0 < wait <= 0.2
+    assert scheduler.is_saturated("key-a")
+
+    time.sleep(wait + 0.01)
+    # 已滑出窗口的请求不再计入
+    assert not scheduler.is_saturated("key-a")
+    assert scheduler.acquire()[0] in KEYS
+
+
+def test_round_robin_between_ready_keys():
+    scheduler = KeyScheduler(KEYS, max_requests=10, window=60)
+    first, second = scheduler.acquire()[0], scheduler.acquire()[0]
+    assert {first, second} == set(KEYS)
+
+
+def test_exclude_and_no_candidates():
+    scheduler = KeyScheduler(KEYS, max_requests=10, window=60)
+    assert scheduler.acquire(exclude={"key-a"})[0] == "key-b"
+    assert scheduler.acquire(exclude=set(KEYS)) == (None, None)
+    assert scheduler.next_available_in(exclude=set(KEYS)) is None
+
+
+def test_cooldown_and_reinstate():
+    scheduler = KeyScheduler(KEYS, max_requests=10, window=60)
+    scheduler.cooldown("key-a", 30)
+    assert scheduler.is_cooling_down("key-a")
+    assert scheduler.cooling_down_count() == 1
+    assert [scheduler.acquire()[0] for _ in range(3)] == ["key-b"] * 3
+    assert scheduler.next_available_in(exclude={"key-b"}) > 29
+
+    scheduler.reinstate("key-a")
+    assert not scheduler.is_cooling_down("key-a")
+    assert scheduler.next_available_in(exclude={"key-b"}) == 0
+    assert scheduler.try_acquire("key-a")
+
+
+def test_token_budget_and_adjustment():
+    scheduler = KeyScheduler(["key-a"], max_requests=10, window=60, max_tokens=100)
+    assert scheduler.acquire(tokens=60, ticket=1)[0] == "key-a"
+    key, wait = scheduler.acquire(tokens=60, ticket=2)
+    assert key is None and wait > 0
+    assert not scheduler.try_acquire("key-a", tokens=60, ticket=2)
+
+    # 实际用量比估计少时退回多扣的部分；不认识的 ticket 不改动任何记录
+    scheduler.adjust_tokens("key-a", 3, 10)
+    assert not scheduler.try_acquire("key-a", tokens=60, ticket=2)
+    scheduler.adjust_tokens("key-a", 1, 10)
+    assert scheduler.try_acquire("key-a", tokens=60, ticket=2)
+
+
+def test_adjustment_targets_the_request_with_equal_estimates():
+    scheduler = KeyScheduler(["key-a"], max_requests=10, window=0.3, max_tokens=100)
+    assert scheduler.acquire(tokens=40, ticket="first")[0] == "key-a"
+    time.sleep(0.15)
+    assert scheduler.acquire(tokens=40, ticket="second")[0] == "key-a"
+
+    # 第一个请求实际用了 90：在它过期之前没有余额，过期后只剩第二个请求的 40
+    scheduler.adjust_tokens("key-a", "first", 90)
+    scheduler.adjust_tokens("key-a", "second", 5)
+    assert not scheduler.try_acquire("key-a", tokens=20)
+    time.sleep(0.17)
+    assert scheduler.try_acquire("key-a", tokens=90)
+
+
+def test_oversized_request_waits_for_empty_window():
+    scheduler = KeyScheduler(["key-a"], max_requests=10, window=0.1, max_tokens=100)
+    assert scheduler.acquire(tokens=500)[0] == "key-a"
+    assert scheduler.acquire(tokens=500)[0] is None
+    time.sleep(0.12)
+    assert scheduler.acquire(tokens=500)[0] == "key-a"
@@ -0,0 +1,82 @@
+import pytest
+
+from harness import HEADERS, KEYS, asgi_request
+from model_catalog import ModelCatalog, etag_matches
+
+ALL_MODELS = ["gemini-1.5-flash", "gemini-1.5-pro", "text-embedding-004"]
+
+
+@pytest.fixture
+def catalog(proxy, mock, monkeypatch):
+    """与 app 相同地对接模拟上游，替换掉 app 中（ModelCatalogTTL=0 未启用的）模型列表"""
+    mock.key_models = {KEYS[0]: ["gemini-1.5-flash", "text-embedding-004"], KEYS[1]: ALL_MODELS}
+    catalog = ModelCatalog(proxy.fetch_key_models, ["fallback-model"], proxy.render_index_html, ttl=60)
+    monkeypatch.setattr(proxy, "model_catalog", catalog)
+    return catalog
+
+
+def test_refresh_builds_union_and_unsupported_keys(catalog):
+    assert catalog.snapshot.models == ["fallback-model"]
+    assert catalog.refresh(KEYS) == 2
+    assert catalog.snapshot.models == ALL_MODELS
+    assert catalog.keys_without("gemini-1.5-pro") == {KEYS[0]}
+    assert catalog.keys_without("models/gemini-1.5-pro") == {KEYS[0]}
+    assert catalog.keys_without("gemini-1.5-flash") == frozenset()
+    # 没有任何 key 列出的模型（实验模型、别名）不排除任何 key
+    assert catalog.keys_without("gemini-exp-1206") == frozenset()
+
+
+def test_failed_fetch_keeps_the_previous_result(proxy, catalog, mock):
+    catalog.refresh(KEYS)
+    etag = catalog.snapshot.models_etag
+
+    def fetch(api_key):
+        if api_key == KEYS[1]:
+            raise RuntimeError("network down")
+        return proxy.fetch_key_models(api_key)
+
+    catalog.fetch_models = fetch
+    assert catalog.refresh(KEYS) == 1
+    assert catalog.snapshot.models_etag == etag
+    assert catalog.keys_without("gemini-1.5-pro") == {KEYS[0]}
+
+    # 新模型上线后列表和 ETag 随之更新
+    catalog.fetch_models = proxy.fetch_key_models
+    mock.key_models[KEYS[0]] = ALL_MODELS + ["gemini-2.0-flash-exp"]
+    catalog.refresh(KEYS)
+    assert "gemini-2.0-flash-exp" in catalog.snapshot.models
+    assert catalog.snapshot.models_etag != etag
+
+
+def test_models_endpoint_answers_304_for_a_matching_etag(loop, proxy, asgi_app, catalog):
+    catalog.refresh(KEYS)
+    client = proxy.app.test_client()
+    response = client.get("/v1/models")
+    etag = response.headers["ETag"]
+    assert [model["id"] for model in response.get_json()["data"]] == ALL_MODELS
+    assert client.get("/v1/models", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/", headers={"If-None-Match": etag}).status_code == 200
+    assert asgi_request(loop, asgi_app, "GET", "/v1/models", headers={"If-None-Match": etag}).status_code == 304
+
+    # 列表变化后旧的 ETag 不再匹配
+    catalog.fetch_models = lambda api_key: ["gemini-1.5-flash"]
+    catalog.refresh(KEYS)
+    response = client.get("/v1/models", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+
+
+def test_etag_matching():
+    assert etag_matches('"a", "b"', '"b"')
+    assert etag_matches('W/"b"', '"b"')
+    assert etag_matches("*", '"b"')
+    assert not etag_matches(None, '"b"')
+    assert not etag_matches('"a"', '"b"')
+
+
+def test_keys_without_the_model_are_skipped(proxy, catalog, mock):
+    catalog.refresh(KEYS)
+    client = proxy.app.test_client()
+    for _ in range(4):
+        body = {"model": "gemini-1.5-pro", "temperature": 0.7, "messages": [{"role": "user", "content": "hi"}]}
+        assert client.post("/v1/chat/completions", json=body, headers=HEADERS).status_code == 200
+    assert mock.calls_by_key == {KEYS[1]: 4}
@@ -0,0 +1,116 @@
+"""通过 benchmarks/mock_upstream.py 的模拟上游，端到端测试 Flask 和 ASGI 两种运行方式"""
+import json
+import time
+
+from harness import HEADERS, KEYS, asgi_post_concurrently, asgi_request, chat_body, post_concurrently, stream_text, \
+    upstream_calls
+
+
+def test_flask_coalesces_identical_requests(proxy, mock):
+    mock.latency = 0.3
+    results = post_concurrently(proxy, [chat_body(False)] * 3)
+    assert [status for status, _ in results] == [200] * 3
+    assert len({json.loads(data)["choices"][0]["message"]["content"] for _, data in results}) == 1
+    assert upstream_calls(mock, "GenerateContent") == 1
+
+
+def test_flask_does_not_coalesce_across_clients_or_sampling(proxy, mock):
+    mock.latency = 0.3
+    post_concurrently(proxy, [chat_body(False, user=user) for user in ("a", "b", "c")])
+    assert upstream_calls(mock, "GenerateContent") == 3
+    mock.calls.clear()
+    post_concurrently(proxy, [chat_body(False, temperature=0.7)] * 3)
+    assert upstream_calls(mock, "GenerateContent") == 3
+
+
+def test_asgi_stream_fan_out(loop, asgi_app, mock):
+    mock.latency = 0.3
+    results = asgi_post_concurrently(loop, asgi_app, [chat_body(True)] * 3)
+    texts = {stream_text(data) for _, data in results}
+    assert len(texts) == 1 and "<error>" not in texts.pop()
+    assert upstream_calls(mock, "StreamGenerateContent") == 1
+
+
+def test_flask_stream_resumes_on_another_key(proxy, mock):
+    client = proxy.app.test_client()
+    expected = stream_text(client.post("/v1/chat/completions", json=chat_body(True), headers=HEADERS).data)
+
+    mock.disconnects = 1
+    mock.calls.clear()
+    resumed = stream_text(client.post("/v1/chat/completions", json=chat_body(True), headers=HEADERS).data)
+    assert resumed == expected
+    assert upstream_calls(mock, "StreamGenerateContent") == 2
+
+
+def test_flask_stream_reports_error_after_too_many_disconnects(proxy, mock):
+    client = proxy.app.test_client()
+    mock.disconnects = 10
+    text = stream_text(client.post("/v1/chat/completions", json=chat_body(True), headers=HEADERS).data)
+    assert text.endswith("<error>")
+
+
+def test_asgi_stream_resumes_on_another_key(loop, asgi_app, mock):
+    expected = stream_text(asgi_post_concurrently(loop, asgi_app, [chat_body(True)])[0][1])
+    mock.disconnects = 2
+    resumed = stream_text(asgi_post_concurrently(loop, asgi_app, [chat_body(True)])[0][1])
+    assert resumed == expected
+    assert upstream_calls(mock, "StreamGenerateContent") == 4
+
+
+def test_malformed_json_is_rejected_in_both_engines(loop, proxy, asgi_app):
+    headers = {**HEADERS, "Content-Type": "application/json"}
+    # 合法但不是对象的 JSON 同样是 400
+    for body in (b"{bad", b"[]", b'"x"', b"null"):
+        for path in ("/v1/chat/completions", "/v1/embeddings"):
+            response = proxy.app.test_client().post(path, data=body, headers=headers)
+            assert response.status_code == 400, (path, body)
+            response = asgi_request(loop, asgi_app, "POST", path, content=body, headers=headers)
+            assert response.status_code == 400, (path, body)
+
+
+def test_malformed_content_length_is_rejected(loop, asgi_app):
+    for content_length in ("abc", "-1"):
+        headers = {**HEADERS, "Content-Type": "application/json", "Content-Length": content_length}
+        response = asgi_request(loop, asgi_app, "POST", "/v1/chat/completions", content=b"{}", headers=headers)
+        assert response.status_code == 400
+
+
+def test_metrics_require_authorization_and_hide_keys(loop, proxy, asgi_app):
+    client = proxy.app.test_client()
+    assert client.get("/metrics").status_code == 401
+    response = client.get("/metrics", headers=HEADERS)
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert "gemini_proxy_upstream_attempts_total" in body
+    assert not any(key[:11] in body for key in KEYS)
+
+    assert [asgi_request(loop, asgi_app, "GET", "/metrics", headers=headers).status_code
+            for headers in ({}, HEADERS)] == [401, 200]
+
+
+def test_key_probe_does_not_depend_on_a_model(proxy, mock):
+    mock.models = ["gemini-2.0-flash-exp"]
+    proxy.probe_key(KEYS[0])
+
+
+def test_flask_does_not_wait_for_a_key_but_asgi_queues(loop, proxy, asgi_app, mock, monkeypatch):
+    free_at = time.monotonic() + 0.3
+    acquire_key = proxy.acquire_key
+
+    def acquire_later(retry_state, *args, **kwargs):
+        if time.monotonic() < free_at:
+            return None, free_at - time.monotonic()
+        return acquire_key(retry_state, *args, **kwargs)
+
+    monkeypatch.setattr(proxy, "acquire_key", acquire_later)
+    start = time.monotonic()
+    response = proxy.app.test_client().post("/v1/chat/completions", json=chat_body(False, user="sync"),
+                                            headers=HEADERS)
+    assert response.status_code == 429 and response.headers["Retry-After"] == "1"
+    assert time.monotonic() - start < 0.2
+    assert len(proxy.admission_queue) == 0
+
+    response = asgi_request(loop, asgi_app, "POST", "/v1/chat/completions", json=chat_body(False, user="async"),
+                            headers=HEADERS)
+    assert response.status_code == 200
+    assert time.monotonic() >= free_at
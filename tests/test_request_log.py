@@ -0,0 +1,45 @@
+import io
+import json
+import logging
+
+import pytest
+
+import request_log
+
+
+@pytest.fixture
+def handler():
+    root = logging.getLogger()
+    level = root.level
+    handler = request_log.setup_logging(level="INFO", log_format="json")
+    stream = io.StringIO()
+    handler._listener.handlers[0].setStream(stream)
+    yield handler, stream
+    root.removeHandler(handler)
+    handler.close()
+    root.setLevel(level)
+
+
+def test_module_loggers_share_the_async_handler(handler):
+    handler, stream = handler
+    logging.getLogger("state_backend").info("共享状态存储已恢复")
+    logging.getLogger("key_health").debug("低于 LogLevel 的日志不输出")
+    handler._listener.stop()
+    handler._listener = None
+
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(record["level"], record["msg"]) for record in records] == [("info", "共享状态存储已恢复")]
+
+
+def test_request_fields_are_attached(handler):
+    handler, stream = handler
+    request_id = request_log.begin("req-1")
+    request_log.bind(model="gemini-1.5-flash")
+    logging.getLogger("app").warning("上游出错")
+    request_log.end()
+    handler._listener.stop()
+    handler._listener = None
+
+    record = json.loads(stream.getvalue())
+    assert record["request_id"] == request_id == "req-1"
+    assert record["model"] == "gemini-1.5-flash"
@@ -0,0 +1,100 @@
+import sqlite3
+
+import pytest
+
+import response_cache
+from harness import HEADERS, asgi_request, upstream_calls
+from response_cache import ResponseCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache.time, "time", clock.time)
+    return clock
+
+
+def disk_rows(path):
+    with sqlite3.connect(path) as db:
+        return [row[0] for row in db.execute("SELECT key FROM responses ORDER BY expires_at")]
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = ResponseCache(ttl=10)
+    cache.put("a", {"text": "x"})
+    clock.now += 9
+    assert cache.get("a") == {"text": "x"}
+    clock.now += 2
+    assert cache.get("a") is None
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = ResponseCache(ttl=60, max_entries=2)
+    cache.put("a", {"text": "a"})
+    cache.put("b", {"text": "b"})
+    cache.get("a")
+    cache.put("c", {"text": "c"})
+    assert [cache.get(key) is not None for key in "abc"] == [True, False, True]
+
+    cache = ResponseCache(ttl=60, max_bytes=40)
+    cache.put("a", {"text": "a" * 15})
+    cache.put("b", {"text": "b" * 15})
+    assert cache.get("a") is None and cache.get("b") is not None
+
+
+def test_disk_tier_survives_restart(tmp_path, clock):
+    path = str(tmp_path / "responses.db")
+    ResponseCache(ttl=60, path=path).put("a", {"text": "你好"})
+    assert ResponseCache(ttl=60, path=path).get("a") == {"text": "你好"}
+    # 重启时已过期的条目被清理
+    clock.now += 61
+    assert ResponseCache(ttl=60, path=path).get("a") is None
+    assert disk_rows(path) == []
+
+
+def test_disk_tier_is_bounded(tmp_path, clock):
+    path = str(tmp_path / "responses.db")
+    cache = ResponseCache(ttl=60, max_entries=1, path=path, disk_max_bytes=100)
+    for index in range(10):
+        clock.now += 1
+        cache.put(str(index), {"text": "x" * 20})
+    # 每条 JSON 约 30 字节，只保留最新的几条
+    assert disk_rows(path) == ["7", "8", "9"]
+
+
+def test_expired_disk_rows_are_cleaned_up_periodically(tmp_path, clock):
+    path = str(tmp_path / "responses.db")
+    cache = ResponseCache(ttl=10, path=path)
+    cache.put("old", {"text": "x"})
+    clock.now += response_cache.DISK_CLEANUP_INTERVAL
+    cache.put("new", {"text": "y"})
+    assert disk_rows(path) == ["new"]
+
+
+def test_only_deterministic_requests_are_cached(loop, proxy, asgi_app, mock, monkeypatch):
+    monkeypatch.setattr(proxy, "response_cache", ResponseCache(ttl=60))
+    client = proxy.app.test_client()
+    body = {"model": "gemini-1.5-flash", "messages": [{"role": "user", "content": "cache me"}]}
+
+    for _ in range(2):
+        assert client.post("/v1/chat/completions", json={**body, "temperature": 0.7}, headers=HEADERS).status_code == 200
+    assert upstream_calls(mock, "GenerateContent") == 2
+
+    responses = [client.post("/v1/chat/completions", json={**body, "temperature": 0}, headers=HEADERS)
+                 for _ in range(2)]
+    assert upstream_calls(mock, "GenerateContent") == 3
+    assert responses[0].get_json()["choices"] == responses[1].get_json()["choices"]
+
+    # ASGI 模式共用同一个缓存，命中时不再调用上游
+    response = asgi_request(loop, asgi_app, "POST", "/v1/chat/completions", json={**body, "temperature": 0},
+                            headers=HEADERS)
+    assert response.json()["choices"] == responses[0].get_json()["choices"]
+    assert upstream_calls(mock, "GenerateContent") == 3
@@ -0,0 +1,54 @@
+from google.api_core import exceptions
+
+from retry_policy import RetryBudget, RetryPolicy, load_error_policy
+
+
+class QuotaError(exceptions.ResourceExhausted):
+    pass
+
+
+def make_policy(overrides=None, budget=None, deadline=30):
+    return RetryPolicy(3, deadline, load_error_policy(overrides), budget or RetryBudget())
+
+
+def test_errors_are_classified_by_class_hierarchy():
+    policy = make_policy()
+    assert policy.rule_for(exceptions.ResourceExhausted("quota"))[0] == "ResourceExhausted"
+    assert policy.rule_for(exceptions.InternalServerError("boom"))[0] == "InternalServerError"
+    assert policy.rule_for(exceptions.PermissionDenied("key"))[1]["probe"] is True
+    # 没有配置的子类按最近的父类处理
+    assert policy.rule_for(QuotaError("daily quota"))[0] == "ResourceExhausted"
+    assert policy.rule_for(exceptions.BadGateway("proxy")) == (None, None)
+    assert policy.rule_for(ValueError("not an API error")) == (None, None)
+
+
+def test_overrides_from_json_string():
+    policy = make_policy('{"ResourceExhausted": {"retry": false}, "DeadlineExceeded": {"backoff": 2}}')
+    name, rule = policy.rule_for(exceptions.ResourceExhausted("quota"))
+    assert rule["retry"] is False and rule["cooldown"] == 10
+    # 新增的错误类型以 InternalServerError 的默认值为基础
+    name, rule = policy.rule_for(exceptions.DeadlineExceeded("slow"))
+    assert name == "DeadlineExceeded" and rule["backoff"] == 2 and rule["max_backoff"] == 16
+
+
+def test_backoff_doubles_up_to_the_limit():
+    policy = make_policy()
+    rule = policy.error_policy["ResourceExhausted"]
+    assert [policy.backoff(rule, failures) for failures in range(6)] == [1, 2, 4, 8, 16, 16]
+
+
+def test_retry_budget_limits_retries():
+    budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2)
+    assert budget.try_spend() and budget.try_spend()
+    assert not budget.try_spend()
+    budget.record_request()
+    assert not budget.try_spend()
+    budget.record_request()
+    assert budget.try_spend()
+
+
+def test_retry_state_deadline():
+    state = make_policy(budget=RetryBudget(min_per_second=0, max_tokens=1), deadline=1).start()
+    assert 0.9 < state.remaining() <= 1
+    assert state.can_wait(0.5) and not state.can_wait(2)
+    assert state.allow_retry()
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+
+import pytest
+
+from single_flight import FlightAbandoned, SingleFlight
+
+
+def test_disabled_by_default_and_only_for_temperature_zero():
+    assert not SingleFlight().coalescable(0)
+    flights = SingleFlight(enabled=True)
+    assert flights.coalescable(0)
+    assert not flights.coalescable(0.7)
+
+
+def test_followers_share_the_leader_response():
+    flights = SingleFlight(enabled=True)
+    leader_flight, leader = flights.join("req", 5)
+    assert leader
+    results = []
+
+    def follower():
+        flight, is_leader = flights.join("req", 5)
+        results.append((is_leader, flight.response))
+
+    threads = [threading.Thread(target=follower) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    leader_flight.resolve("response")
+    for thread in threads:
+        thread.join()
+
+    assert results == [(False, "response")] * 3
+    assert len(flights) == 0
+
+
+def test_cancelled_leader_lets_a_follower_take_over():
+    flights = SingleFlight(enabled=True)
+    first, _ = flights.join("req", 5)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(flights.join("req", 5)))
+    thread.start()
+    first.cancel()
+    thread.join()
+    flight, leader = result[0]
+    assert leader and flight is not first
+    flight.cancel()
+
+
+def test_join_times_out():
+    flights = SingleFlight(enabled=True)
+    flights.join("req", 5)
+    assert flights.join("req", 0.05) == (None, False)
+
+
+def test_stream_fan_out_replays_and_shares_chunks():
+    flights = SingleFlight(enabled=True)
+    flight, _ = flights.join("req", 5)
+    flight.resolve(iter(["a", "b", "c"]), stream=True)
+
+    first = iter(flight)
+    assert next(first) == "a"
+    # 后加入的订阅者先重放已读取的分块
+    follower, leader = flights.join("req", 5)
+    assert not leader and follower is flight
+    assert list(follower) == ["a", "b", "c"]
+    assert list(first) == ["b", "c"]
+    assert len(flights) == 0
+
+
+def test_stream_abandoned_when_all_subscribers_leave():
+    flights = SingleFlight(enabled=True)
+    flight, _ = flights.join("req", 5)
+    flight.resolve(iter(["a", "b"]), stream=True)
+    subscriber = iter(flight)
+    next(subscriber)
+    subscriber.close()
+    assert len(flights) == 0
+    with pytest.raises(FlightAbandoned):
+        list(flight)
+
+
+def test_async_stream_fan_out():
+    flights = SingleFlight(enabled=True)
+
+    async def upstream():
+        for text in ("a", "b", "c"):
+            await asyncio.sleep(0.01)
+            yield text
+
+    async def subscribe():
+        flight, leader = await flights.join_async("req", 5)
+        if leader:
+            flight.resolve(upstream(), stream=True)
+        return leader, [chunk async for chunk in flight]
+
+    async def main():
+        return await asyncio.gather(*(subscribe() for _ in range(3)))
+
+    results = asyncio.run(main())
+    assert sorted(leader for leader, _ in results) == [False, False, True]
+    assert all(chunks == ["a", "b", "c"] for _, chunks in results)
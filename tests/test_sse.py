@@ -0,0 +1,63 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import sse
+
+
+def test_coalesce_disabled_passes_chunks_through():
+    texts = ["a", "b", "c"]
+    assert list(sse.coalesce(iter(texts), 0, 100)) == texts
+
+
+def test_coalesce_merges_until_max_bytes():
+    texts = ["ab", "cd", "ef", "g"]
+    assert list(sse.coalesce(iter(texts), 60, 4)) == ["abcd", "efg"]
+
+
+def test_coalesce_flushes_after_interval():
+    def slow():
+        for text in ("a", "b", "c"):
+            yield text
+            time.sleep(0.03)
+
+    # 同步版本没有定时器：攒着的文本在下一段到达、发现已超过 interval 时随之输出
+    assert list(sse.coalesce(slow(), 0.01, 100)) == ["ab", "c"]
+
+
+def test_coalesce_flushes_pending_text_before_error():
+    def failing():
+        yield "a"
+        yield "b"
+        raise RuntimeError("upstream closed")
+
+    output = []
+    with pytest.raises(RuntimeError):
+        for text in sse.coalesce(failing(), 60, 100):
+            output.append(text)
+    assert output == ["ab"]
+
+
+def test_async_coalesce_flushes_on_timer():
+    async def texts():
+        yield "a"
+        yield "b"
+        await asyncio.sleep(0.1)
+        yield "c"
+
+    async def collect():
+        return [text async for text in sse.async_coalesce(texts(), 0.02, 100)]
+
+    assert asyncio.run(collect()) == ["ab", "c"]
+
+
+def test_encoded_events_match_json_dumps():
+    text = '引号 " 反斜杠 \\ 换行\n'
+    event = sse.encode_delta(text)
+    assert event.startswith(b"data: ") and event.endswith(b"\n\n")
+    assert json.loads(event[6:]) == {"choices": [{"delta": {"content": text}, "finish_reason": None, "index": 0}],
+                                     "object": "chat.completion.chunk"}
+    usage = {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3}
+    assert json.loads(sse.encode_stop(usage)[6:])["usage"] == usage
@@ -0,0 +1,130 @@
+import socket
+import threading
+import uuid
+from collections import Counter
+
+import time
+
+import pytest
+
+import state_backend
+from key_scheduler import KeyScheduler
+from state_backend import SharedKeyScheduler, create_key_scheduler
+
+KEYS = ["key-a", "key-b", "key-c"]
+
+
+@pytest.fixture(autouse=True)
+def short_snapshot_ttl(monkeypatch):
+    monkeypatch.setattr(state_backend, "SNAPSHOT_TTL", 0.05)
+
+
+def wait_for_snapshot():
+    time.sleep(state_backend.SNAPSHOT_TTL + 0.01)
+
+
+@pytest.fixture(params=["fake", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "fake":
+        return f"fake://{uuid.uuid4().hex}"
+    return f"sqlite:///{tmp_path}/state.db"
+
+
+def test_memory_backend_uses_in_process_scheduler():
+    assert isinstance(create_key_scheduler(KEYS, 2, 60), KeyScheduler)
+    assert isinstance(create_key_scheduler(KEYS, 2, 60, backend="fake://memory-test"), SharedKeyScheduler)
+    with pytest.raises(ValueError):
+        create_key_scheduler(KEYS, 2, 60, backend="mysql://localhost")
+
+
+def test_two_schedulers_never_over_issue(backend):
+    nodes = [create_key_scheduler(KEYS, 3, 60, backend=backend) for _ in range(2)]
+    issued = []
+    lock = threading.Lock()
+
+    def worker(scheduler):
+        for _ in range(20):
+            key, _ = scheduler.acquire()
+            if key is not None:
+                with lock:
+                    issued.append(key)
+
+    threads = [threading.Thread(target=worker, args=(node,)) for node in nodes * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert Counter(issued) == {key: 3 for key in KEYS}
+    for node in nodes:
+        assert node.acquire()[0] is None
+        assert node.next_available_in() > 0
+
+
+def test_cooldown_is_shared(backend):
+    first = create_key_scheduler(KEYS, 10, 60, backend=backend)
+    second = create_key_scheduler(KEYS, 10, 60, backend=backend)
+    assert second.next_available_in() == 0
+    first.cooldown("key-a", 30)
+
+    # 另一个节点的快照还没刷新时，预占也会读回冷却状态并拒绝该 key
+    assert not second.try_acquire("key-a")
+    assert second.is_cooling_down("key-a")
+    assert {second.acquire()[0] for _ in range(4)} == {"key-b", "key-c"}
+
+    first.reinstate("key-a")
+    wait_for_snapshot()
+    assert second.try_acquire("key-a")
+
+
+def test_token_budget_is_shared(backend):
+    first = create_key_scheduler(["key-a"], 100, 60, max_tokens=100, backend=backend)
+    second = create_key_scheduler(["key-a"], 100, 60, max_tokens=100, backend=backend)
+    assert first.acquire(tokens=60, ticket=1)[0] == "key-a"
+    assert not second.try_acquire("key-a", tokens=60)
+
+    first.adjust_tokens("key-a", 1, 10)
+    wait_for_snapshot()
+    assert second.try_acquire("key-a", tokens=60)
+
+
+def test_token_adjustment_follows_the_ticket(backend):
+    scheduler = create_key_scheduler(["key-a"], 100, 60, max_tokens=100, backend=backend)
+    assert scheduler.acquire(tokens=30, ticket="first")[0] == "key-a"
+    assert scheduler.acquire(tokens=30, ticket="second")[0] == "key-a"
+    scheduler.adjust_tokens("key-a", "second", 5)
+    own = {ticket: tokens for _, _, tokens, ticket in scheduler._own_entries["key-a"]}
+    assert own == {"first": 30, "second": 5}
+    wait_for_snapshot()
+    assert scheduler.try_acquire("key-a", tokens=65)
+    assert not scheduler.try_acquire("key-a", tokens=1)
+
+
+def test_falls_back_to_in_process_scheduler_when_store_is_down():
+    # 没有监听的端口：连接被拒绝时退回进程内调度，请求不中断
+    scheduler = create_key_scheduler(KEYS, 2, 60, backend="redis://127.0.0.1:1/0")
+    issued = [scheduler.acquire()[0] for _ in range(6)]
+    assert Counter(issued) == {key: 2 for key in KEYS}
+    assert scheduler.acquire()[0] is None
+
+
+def test_error_inside_exec_is_raised():
+    # EXEC 的响应数组里夹带的错误不能当作普通结果返回
+    server, client = socket.socketpair()
+    connection = object.__new__(state_backend.RedisConnection)
+    connection._sock, connection._file = client, client.makefile("rb")
+    server.sendall(b"+OK\r\n+QUEUED\r\n+QUEUED\r\n*2\r\n:1\r\n-WRONGTYPE Operation against a key\r\n")
+    try:
+        with pytest.raises(state_backend.RedisError, match="WRONGTYPE"):
+            connection.pipeline([("MULTI",), ("ZADD", "z", 1, "a"), ("GET", "z"), ("EXEC",)])
+    finally:
+        connection.close()
+        server.close()
+
+
+def test_fake_redis_reports_command_errors_like_redis():
+    redis = state_backend.FakeRedis()
+    with pytest.raises(state_backend.RedisError, match="WRONGTYPE"):
+        redis.pipeline([("ZADD", "z", 1, "a"), ("GET", "z"), ("SET", "s", "v")], transaction=True)
+    # 与 Redis 的 MULTI/EXEC 一样，出错的命令不影响其余命令
+    assert redis.pipeline([("ZRANGE", "z", 0, -1), ("GET", "s")]) == [["a"], "v"]
@@ -0,0 +1,70 @@
+from io import BytesIO
+
+from PIL import Image
+
+from harness import HEADERS
+from key_scheduler import KeyScheduler
+from media_store import MediaData
+from token_estimator import TOKENS_PER_IMAGE_TILE, TOKENS_PER_MESSAGE, estimate_text_tokens, estimate_tokens
+
+
+def png(width, height):
+    buffer = BytesIO()
+    Image.new("RGB", (width, height)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_text_estimate():
+    assert estimate_text_tokens("") == 0
+    assert estimate_text_tokens("abcdefgh") == 2
+    assert estimate_text_tokens("abcde") == 2
+    # 非 ASCII 字符按每个字符一个 token
+    assert estimate_text_tokens("你好ab") == 3
+
+
+def test_image_estimate_uses_tiles():
+    small = {"inline_data": {"mime_type": "image/png", "data": png(300, 200)}}
+    large = {"inline_data": {"mime_type": "image/png", "data": png(1600, 800)}}
+    history = [{"role": "user", "parts": ["看图", small]}]
+    assert estimate_tokens(history, {"role": "user", "parts": [large]}) == \
+        2 * TOKENS_PER_MESSAGE + 2 + TOKENS_PER_IMAGE_TILE + 3 * 2 * TOKENS_PER_IMAGE_TILE
+
+
+def test_media_estimate_is_cached_on_the_object():
+    data = MediaData(png(1000, 1000), "digest", "image/png")
+    message = {"role": "user", "parts": [{"inline_data": {"mime_type": "image/png", "data": data}}]}
+    assert estimate_tokens([], message) == TOKENS_PER_MESSAGE + 4 * TOKENS_PER_IMAGE_TILE
+    assert data.estimated_tokens == 4 * TOKENS_PER_IMAGE_TILE
+
+
+def test_undecodable_image_and_files():
+    parts = [{"inline_data": {"mime_type": "image/png", "data": b"not an image"}},
+             {"inline_data": {"mime_type": "application/pdf", "data": b"x" * 1024 * 1024}}]
+    assert estimate_tokens([], {"role": "user", "parts": parts}) == \
+        TOKENS_PER_MESSAGE + TOKENS_PER_IMAGE_TILE + 4096
+
+
+def test_tpm_budget_blocks_acquisition():
+    scheduler = KeyScheduler(["key-a", "key-b"], max_requests=100, window=60, max_tokens=1000)
+    assert scheduler.acquire(tokens=800, ticket=1)[0] is not None
+    assert scheduler.acquire(tokens=800, ticket=2)[0] is not None
+    key, wait = scheduler.acquire(tokens=800, ticket=3)
+    assert key is None and 59 < wait <= 60
+    # 余额够小请求的 key 仍然可以用
+    assert scheduler.acquire(tokens=100, ticket=4)[0] is not None
+
+
+def test_usage_metadata_corrects_the_estimate(proxy, mock, monkeypatch):
+    scheduler = KeyScheduler(proxy.key_manager.api_keys, max_requests=100, window=60, max_tokens=10000)
+    monkeypatch.setattr(proxy.key_manager, "scheduler", scheduler)
+    monkeypatch.setattr(proxy, "MAX_INPUT_TOKENS", 10000)
+    client = proxy.app.test_client()
+    text = "你好" * 100
+    body = {"model": "gemini-1.5-flash", "temperature": 0.7, "messages": [{"role": "user", "content": text}]}
+
+    for stream in (False, True):
+        response = client.post("/v1/chat/completions", json={**body, "stream": stream}, headers=HEADERS)
+        assert response.status_code == 200
+        response.get_data()
+    # 发送前按每个中文字符一个 token 估计为 204，模拟上游报告的实际输入为 len(text) // 4 = 50
+    assert sum(scheduler._token_used.values()) == 2 * (len(text) // 4)
@@ -0,0 +1,85 @@
+import base64
+import json
+import threading
+import time
+
+from media_store import MediaStore
+import traffic_capture
+from traffic_capture import TrafficCapture
+
+
+def image_request(size):
+    uri = "data:image/png;base64," + base64.b64encode(b"\x89PNG" * (size // 4)).decode("ascii")
+    _, media = MediaStore().parse_data_uri(uri)
+    content = [{"type": "text", "text": "hi"},
+               {"type": "image_url", "image_url": {"url": uri}},
+               {"type": "image_url", "image_url": {"url": media}}]
+    return {"model": "gemini-1.5-flash", "messages": [{"role": "user", "content": content}], "user": "alice"}, media
+
+
+def test_queued_records_do_not_keep_media(tmp_path):
+    capture = TrafficCapture(path=str(tmp_path / "capture.jsonl"))
+    capture._thread = object()  # 不启动后台线程，直接检查队列内容
+    request, media = image_request(100000)
+    capture.record({"request_id": "r1", "request": request, "body_bytes": 140000}, 200, time.monotonic())
+
+    queued = capture._queue.get_nowait()
+    parts = queued[3]["request"]["messages"][0]["content"]
+    assert parts[1]["image_url"]["url"]["sha256"] == media.digest
+    assert parts[2]["image_url"]["url"]["sha256"] == media.digest
+    assert queued[3]["request"]["user"] != "alice"
+    assert len(json.dumps(queued[3]["request"])) < 1000
+
+
+def test_queue_is_bounded_by_bytes(tmp_path):
+    capture = TrafficCapture(path=str(tmp_path / "capture.jsonl"), max_queue_bytes=250000)
+    capture._thread = object()
+    request, _ = image_request(1000)
+    for _ in range(3):
+        capture.record({"request": request, "body_bytes": 100000}, 200, time.monotonic())
+    assert capture._queue.qsize() == 2
+    assert capture.dropped == 1
+
+    capture._build(capture._queue.get_nowait())
+    capture.record({"request": request, "body_bytes": 100000}, 200, time.monotonic())
+    assert capture._queue.qsize() == 2
+
+
+def test_records_are_written(tmp_path):
+    path = tmp_path / "capture.jsonl"
+    capture = TrafficCapture(path=str(path), text_mode="hash")
+    request, media = image_request(1000)
+    capture.record({"request_id": "r1", "model": "gemini-1.5-flash", "request": request}, 200, time.monotonic())
+    capture.close()
+
+    record = json.loads(path.read_text(encoding="utf-8"))
+    assert record["request_id"] == "r1" and record["status"] == 200
+    text = record["request"]["messages"][0]["content"][0]["text"]
+    assert text["redacted"] == "text" and text["chars"] == 2
+
+
+def test_close_does_not_block_on_a_full_queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(traffic_capture, "BATCH_SIZE", 1)
+    path = tmp_path / "capture.jsonl"
+    capture = TrafficCapture(path=str(path), max_queue=2)
+    unblock = threading.Event()
+    build = capture._build
+    capture._build = lambda item: unblock.wait() and build(item)
+    request, _ = image_request(100)
+    # 每批一条：第一条被写线程取走后卡在序列化上，之后的两条填满队列
+    capture.record({"request_id": "r0", "request": request}, 200, time.monotonic())
+    while not capture._queue.empty():
+        time.sleep(0.01)
+    for index in (1, 2):
+        capture.record({"request_id": f"r{index}", "request": request}, 200, time.monotonic())
+    assert capture._queue.full()
+
+    started = time.monotonic()
+    capture.close(timeout=0.1)
+    assert time.monotonic() - started < 1
+
+    unblock.set()
+    capture._thread.join(timeout=5)
+    assert not capture._thread.is_alive()
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["request_id"] for line in lines] == ["r0", "r1", "r2"]
@@ -0,0 +1,69 @@
+import math
+from io import BytesIO
+
+
+from media_store import MediaData
+
+# Gemini 对图片按 768x768 分块计费，每块（以及不超过 384x384 的小图）约 258 个 token
+IMAGE_TILE_SIZE = 768
+IMAGE_SMALL_SIZE = 384
+TOKENS_PER_IMAGE_TILE = 258
+# 非图片文件（PDF 等）无法在本地快速得到页数，按大小粗略估计
+BYTES_PER_FILE_TOKEN = 256
+# 每条消息的角色、分隔符等固定开销
+TOKENS_PER_MESSAGE = 4
+
+
+def estimate_text_tokens(text):
+    """ASCII 约 4 个字符一个 token，其余字符（中文等）按每个字符一个 token 估计，宁多勿少"""
+    non_ascii = len(text) - len(text.encode('ascii', 'ignore'))
+    return math.ceil((len(text) - non_ascii) / 4) + non_ascii
+
+
+def estimate_image_tokens(data):
+    """只读取图片头部得到尺寸，不解码像素"""
+    from PIL import Image
+
+    try:
+        width, height = Image.open(BytesIO(data)).size
+    except Exception:
+        return TOKENS_PER_IMAGE_TILE
+    if width <= IMAGE_SMALL_SIZE and height <= IMAGE_SMALL_SIZE:
+        return TOKENS_PER_IMAGE_TILE
+    return math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE) * TOKENS_PER_IMAGE_TILE
+
+
+def estimate_media_tokens(mime_type, data):
+    # 同一份媒体在多轮对话中是同一个 MediaData 对象，估计结果缓存在对象上
+    tokens = getattr(data, 'estimated_tokens', None)
+    if tokens is not None:
+        return tokens
+    if mime_type.startswith('image/'):
+        tokens = estimate_image_tokens(data)
+    else:
+        tokens = max(TOKENS_PER_IMAGE_TILE, len(data) // BYTES_PER_FILE_TOKEN)
+    if isinstance(data, MediaData):
+        data.estimated_tokens = tokens
+    return tokens
+
+
+def estimate_part_tokens(part):
+    if isinstance(part, str):
+        return estimate_text_tokens(part)
+    if isinstance(part, dict):
+        if part.get('text') is not None:
+            return estimate_text_tokens(part['text'])
+        inline_data = part.get('inline_data')
+        if inline_data is not None:
+            return estimate_media_tokens(inline_data.get('mime_type', ''), inline_data.get('data', b''))
+    return 0
+
+
+def estimate_tokens(gemini_history, user_message):
+    """在发送前估计一次请求的输入 token 数，用于按 key 的 token 限额调度"""
+    total = 0
+    for message in list(gemini_history) + [user_message]:
+        total += TOKENS_PER_MESSAGE
+        for part in message.get('parts', ()):
+            total += estimate_part_tokens(part)
+    return total
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+from media_store import MediaData, new_digest, parse_data_uri_header
+
+logger = logging.getLogger(__name__)
+
+# 每批最多写入的记录数，以及没有攒满一批时最长多久写一次
+BATCH_SIZE = 256
+FLUSH_INTERVAL = 1.0
+
+
+def _sha256(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def redact_text(text, text_mode):
+    if text_mode == 'hash':
+        return {'redacted': 'text', 'chars': len(text), 'sha256': _sha256(text)}
+    return text
+
+
+def redact_url(url):
+    """data URI 只保留类型、大小和哈希；普通链接去掉查询参数（其中可能带有签名或令牌）"""
+    if isinstance(url, MediaData):
+        return {'redacted': 'media', 'mime_type': url.mime_type, 'bytes': url.original_size, 'sha256': url.digest}
+    if not isinstance(url, str):
+        return {'redacted': 'media'}
+    if url.startswith('data:'):
+        header, _, payload = url.partition(',')
+        mime_type, is_base64 = parse_data_uri_header(header[5:])
+        size = len(payload) * 3 // 4 if is_base64 else len(payload)
+        # 与 MediaStore 相同的哈希，同一份媒体无论是否经过流式解析记录的哈希都一致
+        digest = new_digest(mime_type)
+        digest.update(payload.encode('utf-8'))
+        return {'redacted': 'media', 'mime_type': mime_type, 'bytes': size, 'sha256': digest.hexdigest()}
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))
+
+
+def redact_content(content, text_mode):
+    if isinstance(content, str):
+        return redact_text(content, text_mode)
+    if not isinstance(content, list):
+        return content
+    redacted = []
+    for part in content:
+        if not isinstance(part, dict):
+            redacted.append(part)
+            continue
+        part = dict(part)
+        if isinstance(part.get('text'), str):
+            part['text'] = redact_text(part['text'], text_mode)
+        for field in ('image_url', 'file', 'input_audio'):
+            value = part.get(field)
+            if isinstance(value, dict):
+                value = dict(value)
+                for key in ('url', 'data', 'file_data'):
+                    if key in value:
+                        value[key] = redact_url(value[key])
+                part[field] = value
+            elif value is not None:
+                part[field] = redact_url(value)
+        redacted.append(part)
+    return redacted
+
+
+def redact_request(request_data, text_mode='full'):
+    """复制一份请求体：媒体只保留哈希，user 字段取哈希，text_mode 为 hash 时文本也只保留长度和哈希"""
+    if not isinstance(request_data, dict):
+        return None
+    redacted = dict(request_data)
+    if redacted.get('user'):
+        redacted['user'] = _sha256(str(redacted['user']))[:16]
+    messages = redacted.get('messages')
+    if isinstance(messages, list):
+        redacted['messages'] = [
+            dict(message, content=redact_content(message.get('content'), text_mode))
+            if isinstance(message, dict) else message
+            for message in messages
+        ]
+    return redacted
+
+
+class TrafficCapture:
+    """
+    把每个 /v1/chat/completions 请求（脱敏后）和结果追加写入 JSONL 文件。
+    请求线程先脱敏（媒体只剩哈希，不再引用解码后的图片等原始数据）再放进队列，
+    队列同时按条数和请求体字节数限制；序列化和写文件都在后台线程中批量完成，
+    队列满时丢弃记录而不是阻塞请求。
+    """
+
+    def __init__(self, path=None, text_mode='full', sample_rate=1.0, max_queue=10000,
+                 max_queue_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.text_mode = text_mode
+        self.sample_rate = sample_rate
+        self.max_queue_bytes = max_queue_bytes
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._queued_bytes = 0
+        self._thread = None
+        self._closing = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path) and self.sample_rate > 0
+
+    def record(self, request_info, status, start_time):
+        """在请求（流式请求为整个流）结束时调用；request_info 由请求处理过程填写"""
+        if not self.enabled or 'request' not in request_info:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        info = dict(request_info)
+        try:
+            info['request'] = redact_request(info.get('request'), self.text_mode)
+        except Exception as e:
+            logger.warning(f"请求记录脱敏失败: {e}")
+            return
+        # 脱敏后的请求不会比原始请求体大，按原始大小估算队列占用的内存
+        size = info.get('body_bytes') or 0
+        with self._lock:
+            if self._queued_bytes + size > self.max_queue_bytes:
+                self.dropped += 1
+                return
+            self._queued_bytes += size
+        try:
+            self._queue.put_nowait((time.time(), time.monotonic() - start_time, status, info, size))
+        except queue.Full:
+            self._release(size)
+            self.dropped += 1
+            return
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+                self._thread.start()
+
+    def _release(self, size):
+        with self._lock:
+            self._queued_bytes -= size
+
+    def _build(self, item):
+        now, elapsed, status, info, size = item
+        self._release(size)
+        record = {
+            'ts': round(now - elapsed, 3),
+            'request_id': info.get('request_id'),
+            'client': info.get('client'),
+            'model': info.get('model'),
+            'stream': info.get('stream', False),
+            'status': status,
+            'outcome': info.get('outcome') or ('ok' if status == 200 else 'error'),
+            'attempts': info.get('attempts', 0),
+            'key': info.get('key'),
+            'duration_ms': round(elapsed * 1000, 1),
+        }
+        if info.get('ttft') is not None:
+            record['ttft_ms'] = round(info['ttft'] * 1000, 1)
+        if info.get('body_bytes') is not None:
+            record['body_bytes'] = info['body_bytes']
+        record['request'] = info.get('request')
+        return json.dumps(record, ensure_ascii=False, default=str)
+
+    def close(self, timeout=5):
+        """把队列中剩余的记录写完（进程退出时调用），最多等待 timeout 秒"""
+        if self._thread is None:
+            return
+        self._closing.set()
+        try:
+            # 唤醒空闲等待中的写线程；队列已满时写线程不会阻塞在 get 上，写完这些记录后会看到停止标记
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=timeout)
+
+    def _run(self):
+        # 多个 worker 可能写同一个文件：每批记录用一次 O_APPEND 写入，行与行不会交错
+        with open(self.path, 'ab', buffering=0) as f:
+            closing = False
+            while not closing:
+                try:
+                    batch = [self._queue.get(timeout=FLUSH_INTERVAL)]
+                except queue.Empty:
+                    closing = self._closing.is_set()
+                    continue
+                deadline = time.monotonic() + FLUSH_INTERVAL
+                while len(batch) < BATCH_SIZE and batch[-1] is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(self._queue.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                if batch[-1] is None:
+                    closing = True
+                    batch.pop()
+                elif self._closing.is_set() and self._queue.empty():
+                    closing = True
+                lines = []
+                for item in batch:
+                    try:
+                        lines.append(self._build(item))
+                    except Exception as e:
+                        logger.warning(f"请求记录序列化失败: {e}")
+                if lines:
+                    try:
+                        f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                    except OSError as e:
+                        logger.warning(f"写入请求记录失败: {e}")
+                if self.dropped:
+                    logger.warning(f"请求记录队列已满（条数或字节数达到上限），丢弃了 {self.dropped} 条记录")
+                    self.dropped = 0